@@ -0,0 +1,58 @@
+"""
+Compares two e2e benchmark results, e.g. of two releases.
+
+Usage:
+
+    python -m benchmarks.compare baseline.json candidate.json [--threshold 10]
+
+Prints the relative change of the throughput, the stage and target latencies (p50/p95) and the peak resources. Exits
+with 1 when the throughput dropped, or a p95 latency or the peak RSS grew, by more than the threshold (percent).
+"""
+import argparse
+import json
+import sys
+
+
+def change(old: float, new: float) -> float:
+    return round((new - old) / old * 100, 1) if old else 0.0
+
+
+def compare(baseline: dict, candidate: dict) -> [(str, float, float, float, bool)]:
+    """Returns (metric, baseline, candidate, change %, higher is better) rows."""
+    rows = [("datasets-per-minute", baseline["datasets-per-minute"], candidate["datasets-per-minute"], True)]
+    for group in ("stages", "targets"):
+        for name, old in baseline[group].items():
+            new = candidate[group].get(name)
+            old_summary, new_summary = (old, new) if group == "stages" else (old["duration"], (new or {}).get("duration"))
+            if not new_summary or not old_summary.get("count") or not new_summary.get("count"):
+                continue
+            for p in ("p50", "p95"):
+                rows.append((f'{group}.{name}.{p}', old_summary[p], new_summary[p], False))
+    for key in ("peak-rss-bytes", "peak-threads"):
+        rows.append((f'resources.{key}', baseline["resources"][key], candidate["resources"][key], False))
+    return [(name, old, new, change(old, new), higher_is_better) for name, old, new, higher_is_better in rows]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('baseline')
+    parser.add_argument('candidate')
+    parser.add_argument('--threshold', type=float, default=10.0)
+    args = parser.parse_args()
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.candidate) as f:
+        candidate = json.load(f)
+
+    regressions = []
+    for name, old, new, pct, higher_is_better in compare(baseline, candidate):
+        regressed = (pct < -args.threshold) if higher_is_better else (pct > args.threshold)
+        # Latency regressions only count for the p95 figures and the peak RSS, p50 is informative.
+        if regressed and (name.endswith('.p95') or name in ('datasets-per-minute', 'resources.peak-rss-bytes')):
+            regressions.append(name)
+        print(f'{name:55} {old:>14} {new:>14} {pct:>+8.1f}%{"  REGRESSION" if name in regressions else ""}')
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,499 @@
+"""
+End-to-end throughput benchmark of the deposit pipeline, against local stand-ins of all external services.
+
+Usage (from the repository root, with the usual BASE_DIR / secrets environment):
+
+    python -m benchmarks.e2e --datasets 20 --files 5 --file-size-mb 10 --targets dataverse,swh-sword \
+        [--concurrency 4] [--workers 1] [--auth api-key|keycloak] [--profile benchmarks/profiles/production.json] \
+        [--rate 30 --duration 600] [--resubmit 2] [--output result.json]
+
+The stand-ins (benchmarks.standins) and the packaging service are started as separate processes, the service with
+its database and data directories in a temporary work directory and all service URLs pointing to the stand-ins.
+Every dataset goes through the real client flow: POST /inbox/dataset/PUBLISH, a tus upload (POST + PATCH /files)
+and PATCH /inbox/files/{dataset}/{upload} per file, then polling /dataset/{id} until every target reached a final
+deposit status.
+
+With --profile the stand-ins inject latency, errors, timeouts, bandwidth caps, dataset locks and slow tasks (see
+benchmarks.faults). The file is a single fault profile, or a script of profiles that are set at given seconds into
+the run: {"phases": [{"at": 0, "profile": {...}}, {"at": 120, "profile": {...}}]}.
+
+By default --datasets are submitted by --concurrency clients, each starting the next dataset when the previous one
+is deposited (closed loop). With --rate the run is a load test instead: datasets arrive at random (Poisson) times at
+the given number per minute during --duration seconds, whether earlier ones are done or not (open loop), and the
+running bridge threads and pending datasets are sampled from the service's /metrics. With --resubmit a dataset of
+which a target failed is resubmitted, like a client retrying, and the time until it is final again is the resubmit
+stage.
+
+The result is printed (or written to --output) as JSON: datasets per minute, latency percentiles per stage and per
+target, peak RSS and thread count of the service processes and the request and injected fault counts of the
+stand-ins. Compare two results with ``python -m benchmarks.compare old.json new.json``.
+"""
+import argparse
+import base64
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import psutil
+import requests
+from prometheus_client.parser import text_string_to_metric_families
+
+from benchmarks.stats import summarize
+
+FINAL_STATUSES = ('finish', 'accepted', 'success', 'error', 'failed', 'rejected')
+SUCCESS_STATUSES = ('finish', 'accepted', 'success')
+TARGETS = ('dataverse', 'zenodo', 'swh-api', 'swh-sword', 'filesystem')
+ASSISTANT_CONFIG_NAME = 'benchmark'
+APP_NAME = 'benchmark'
+AUTH_ENV_NAME = 'benchmark'
+BENCHMARK_API_KEY = 'benchmark-api-key'
+
+
+def target_config(name: str, standins_url: str, work_dir: str) -> dict:
+    """The assistant configuration of one target, pointing to the stand-ins."""
+    def transformed(*names: str, target_dir: str = 'metadata') -> dict:
+        return {"specification": ["benchmark"], "transformed-metadata": [
+            {"name": f'{n}.json', "transformer-url": f'{standins_url}/transformer/transform/{n}',
+             "target-dir": target_dir} for n in names]}
+
+    configs = {
+        'dataverse': {"bridge-module-class": "DataverseIngester", "base-url": f'{standins_url}/dataverse',
+                      "target-url": f'{standins_url}/dataverse/api/dataverses/root/datasets',
+                      "username": "API_KEY", "password": "benchmark",
+                      "metadata": transformed('dataverse-dataset', 'dataverse-files')},
+        'zenodo': {"bridge-module-class": "ZenodoApiDepositor", "base-url": f'{standins_url}/zenodo',
+                   "target-url": f'{standins_url}/zenodo/api/deposit/depositions',
+                   "username": "access_token", "password": "benchmark", "metadata": transformed('zenodo-dataset')},
+        'swh-api': {"bridge-module-class": "SwhApiDepositor", "base-url": f'{standins_url}/swh',
+                    "target-url": f'{standins_url}/swh/api/1/origin/save/git/url',
+                    "username": "benchmark", "password": "benchmark", "metadata": transformed()},
+        'swh-sword': {"bridge-module-class": "SwhSwordDepositor", "base-url": f'{standins_url}/swh-sword',
+                      "target-url": f'{standins_url}/swh-sword/1/benchmark/',
+                      "username": "benchmark", "password": "benchmark", "metadata": transformed('swh-sword'),
+                      "input": {"from-target-name": "benchmark.dataverse"}},
+        'filesystem': {"bridge-module-class": "FileSystem", "base-url": f'file://{work_dir}/filesystem',
+                       "target-url": f'file://{work_dir}/filesystem', "username": "benchmark",
+                       "password": "benchmark", "metadata": transformed('dataverse-dataset')},
+    }
+    config = configs[name]
+    config.update({"repo-name": f'benchmark.{name}', "repo-display-name": f'Benchmark {name}'})
+    return config
+
+
+def service_environment(args, work_dir: str, standins_url: str) -> dict:
+    env = dict(os.environ)
+    env.setdefault('BASE_DIR', os.getcwd())
+    env.update({
+        'DYNACONF_DB_URL': f'///{work_dir}/db/benchmark.db',
+        'DYNACONF_DATA_TMP_BASE_DIR': f'{work_dir}/tmp',
+        'DYNACONF_DATA_TMP_BASE_TUS_FILES_DIR': f'{work_dir}/tmp/tus-files',
+        'DYNACONF_TUS_BASE_URL': f'http://127.0.0.1:{args.service_port}',
+        'DYNACONF_ASSISTANT_CONFIG_URL': f'{standins_url}/assistant',
+        'DYNACONF_TRANSFORMER_URL': f'{standins_url}/transformer/transform',
+        'DYNACONF_DANS_PACKAGING_SERVICE_API_KEY': BENCHMARK_API_KEY,
+        'DYNACONF_SWH_ACCESS_TOKEN': 'benchmark',
+        'DYNACONF_SWH_SWORD_USERNAME': 'benchmark',
+        'DYNACONF_SWH_SWORD_PASSWORD': 'benchmark',
+        'DYNACONF_SWH_DELAY_POLLING': str(args.poll_delay),
+        'DYNACONF_SWH_DELAY_POLLING_SWORD': str(args.poll_delay),
+        'DYNACONF_SWH_API_MAX_RETRIES': '1000',
+        f'DYNACONF_KEYCLOAK_{AUTH_ENV_NAME.upper()}': '@json ' + json.dumps(
+            {"url": f'{standins_url}/keycloak', "realms": "benchmark", "client_id": "benchmark"}),
+        # send_mail reads the MAIL_* settings before it checks SEND_MAIL, a failed deposit needs both.
+        'DYNACONF_SENDMAIL_ENABLE': 'false',
+        'DYNACONF_SEND_MAIL': 'false',
+        'DYNACONF_MAIL_USR': 'benchmark@localhost',
+        'DYNACONF_MAIL_PASS': 'benchmark',
+        'DYNACONF_MAIL_TO': 'benchmark@localhost',
+        'DYNACONF_MELT_ENABLE': 'false',
+        'DYNACONF_ORPHAN_COLLECTOR_ENABLE': 'false',
+    })
+    for key in ('DANS_TRANSFORMER_SERVICE_API_KEY', 'DANS_REPO_ASSISTANT_SERVICE_API_KEY'):
+        env.setdefault(f'DYNACONF_{key}', 'benchmark')
+    if args.workers > 1:
+        env['PROMETHEUS_MULTIPROC_DIR'] = f'{work_dir}/prometheus'
+        os.makedirs(env['PROMETHEUS_MULTIPROC_DIR'])
+    return env
+
+
+def keycloak_token(standins_url: str) -> str:
+    rsp = requests.post(f'{standins_url}/keycloak/realms/benchmark/protocol/openid-connect/token',
+                        data={"grant_type": "client_credentials", "client_id": "benchmark"})
+    rsp.raise_for_status()
+    return rsp.json()["access_token"]
+
+
+def start_process(command: [str], url: str, env: dict = None, timeout: float = 60) -> subprocess.Popen:
+    process = subprocess.Popen(command, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f'{" ".join(command)} exited with {process.returncode}')
+        try:
+            if requests.get(url, timeout=1).status_code < 500:
+                return process
+        except requests.ConnectionError:
+            pass
+        time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError(f'{url} did not come up in {timeout} seconds')
+
+
+class ResourceSampler(threading.Thread):
+    """Samples the RSS and thread count of a process and its children (the uvicorn workers)."""
+
+    def __init__(self, pid: int, interval: float = 0.25):
+        super().__init__(name='resource-sampler', daemon=True)
+        self.process = psutil.Process(pid)
+        self.interval = interval
+        self.samples = []
+        self._done = threading.Event()
+
+    def run(self):
+        while not self._done.wait(self.interval):
+            rss, threads = 0, 0
+            for p in [self.process] + self.process.children(recursive=True):
+                try:
+                    rss += p.memory_info().rss
+                    threads += p.num_threads()
+                except psutil.NoSuchProcess:
+                    continue
+            self.samples.append((rss, threads))
+
+    def stop(self) -> dict:
+        self._done.set()
+        self.join()
+        rss = [s[0] for s in self.samples] or [0]
+        threads = [s[1] for s in self.samples] or [0]
+        return {"peak-rss-bytes": max(rss), "mean-rss-bytes": int(sum(rss) / len(rss)), "peak-threads": max(threads),
+                "samples": len(self.samples)}
+
+
+class MetricsSampler(threading.Thread):
+    """Samples the running bridge threads and pending datasets from the service's /metrics."""
+
+    def __init__(self, service_url: str, interval: float = 1.0):
+        super().__init__(name='metrics-sampler', daemon=True)
+        self.service_url = service_url
+        self.interval = interval
+        self.timeline = []
+        self._done = threading.Event()
+
+    def run(self):
+        start = time.monotonic()
+        while not self._done.wait(self.interval):
+            try:
+                families = {f.name: f for f in text_string_to_metric_families(
+                    requests.get(f'{self.service_url}/metrics', timeout=self.interval * 5).text)}
+            except requests.RequestException:
+                continue
+            threads = sum(s.value for s in families['ps_bridge_threads_running'].samples)
+            pending = sum(s.value for s in families['ps_datasets_pending'].samples
+                          if s.labels.get('state') == 'ready')
+            self.timeline.append((round(time.monotonic() - start, 1), int(threads), int(pending)))
+
+    def stop(self) -> dict:
+        self._done.set()
+        self.join()
+        return {"peak-bridge-threads": max((t[1] for t in self.timeline), default=0),
+                "peak-pending-datasets": max((t[2] for t in self.timeline), default=0),
+                "timeline": [{"seconds": t[0], "bridge-threads": t[1], "pending-datasets": t[2]}
+                             for t in self.timeline]}
+
+
+class ProfileScript(threading.Thread):
+    """Sets the phases of a fault profile script on the stand-ins at their time."""
+
+    def __init__(self, standins_url: str, script: dict):
+        super().__init__(name='profile-script', daemon=True)
+        self.standins_url = standins_url
+        self.phases = sorted(script["phases"] if "phases" in script else [{"at": 0, "profile": script}],
+                             key=lambda phase: phase["at"])
+        self._done = threading.Event()
+
+    def apply(self, profile: dict) -> type(None):
+        requests.put(f'{self.standins_url}/control/profile', json=profile).raise_for_status()
+
+    def run(self):
+        start = time.monotonic()
+        for phase in self.phases:
+            if self._done.wait(max(phase["at"] - (time.monotonic() - start), 0)):
+                return
+            self.apply(phase["profile"])
+
+    def stop(self) -> type(None):
+        self._done.set()
+
+
+class DatasetRun:
+    """Submits one dataset like the client does and records the latency of every stage."""
+    STAGES = ("metadata", "tus-upload", "file-registration", "deposit", "resubmit", "total")
+
+    def __init__(self, service_url: str, headers: dict, file_paths: [str], chunk_size: int, timeout: float,
+                 resubmits: int = 0, embargo_dates: int = 0):
+        self.service_url = service_url
+        self.headers = headers
+        self.file_paths = file_paths
+        self.chunk_size = chunk_size
+        self.timeout = timeout
+        self.resubmits = resubmits
+        self.embargo_dates = embargo_dates
+        self.resubmitted = 0
+        self.dataset_id = str(uuid.uuid4())
+        self.stages = {stage: [] for stage in self.STAGES}
+        self.targets = []
+        self.error = None
+
+    def _timed(self, stage: str, func, *args):
+        start = time.perf_counter()
+        result = func(*args)
+        self.stages[stage].append(time.perf_counter() - start)
+        return result
+
+    def run(self) -> 'DatasetRun':
+        start = time.perf_counter()
+        try:
+            self._timed('metadata', self._submit_metadata)
+            for i, path in enumerate(self.file_paths):
+                upload_url = self._timed('tus-upload', self._tus_upload, f'file-{i}.bin', path)
+                self._timed('file-registration', self._register_file, upload_url.rstrip('/').split('/')[-1])
+            self._timed('deposit', self._wait_for_deposit)
+            while not self.succeeded and self.resubmitted < self.resubmits:
+                self._timed('resubmit', self._resubmit)
+        except Exception as e:
+            self.error = f'{e.__class__.__name__}: {e}'
+        self.stages["total"].append(time.perf_counter() - start)
+        return self
+
+    def _submit_metadata(self):
+        md = {"id": self.dataset_id, "title": f'Benchmark dataset {self.dataset_id}',
+              "file-metadata": [dict({"name": f'file-{i}.bin', "private": False}, **(
+                  {"embargo": f'2030-01-{i % self.embargo_dates + 1:02d}'} if self.embargo_dates else {}))
+                  for i in range(len(self.file_paths))],
+              "metadata": [{"fields": [{"name": "repository_url", "value": "https://github.com/example/benchmark"}]}]}
+        headers = dict(self.headers, **{"assistant-config-name": ASSISTANT_CONFIG_NAME, "user-id": "benchmark",
+                                        "targets-credentials": "[]"})
+        requests.post(f'{self.service_url}/inbox/dataset/PUBLISH', json=md, headers=headers,
+                      timeout=self.timeout).raise_for_status()
+
+    def _tus_upload(self, file_name: str, path: str) -> str:
+        size = os.path.getsize(path)
+        metadata = ','.join(f'{k} {base64.b64encode(v.encode()).decode()}'
+                            for k, v in (("fileName", file_name), ("filetype", "application/octet-stream")))
+        rsp = requests.post(f'{self.service_url}/files', timeout=self.timeout, headers=dict(
+            self.headers, **{"Tus-Resumable": "1.0.0", "Upload-Length": str(size), "Upload-Metadata": metadata}))
+        rsp.raise_for_status()
+        upload_url = rsp.headers['Location']
+        offset = 0
+        with open(path, 'rb') as f:
+            while chunk := f.read(self.chunk_size):
+                rsp = requests.patch(upload_url, data=chunk, timeout=self.timeout, headers=dict(
+                    self.headers, **{"Tus-Resumable": "1.0.0", "Upload-Offset": str(offset),
+                                     "Content-Type": "application/offset+octet-stream"}))
+                rsp.raise_for_status()
+                offset += len(chunk)
+        return upload_url
+
+    def _register_file(self, upload_id: str):
+        requests.patch(f'{self.service_url}/inbox/files/{self.dataset_id}/{upload_id}', headers=self.headers,
+                       timeout=self.timeout).raise_for_status()
+
+    def _wait_for_deposit(self, previous: dict = None):
+        # After a resubmit, the resubmitted targets are final again once their deposit time changed.
+        previous = previous or {}
+        deadline = time.monotonic() + self.timeout
+        while time.monotonic() < deadline:
+            rsp = requests.get(f'{self.service_url}/dataset/{self.dataset_id}', timeout=self.timeout)
+            targets = rsp.json().get('targets', []) if rsp.status_code == 200 else []
+            if targets and all(t.get('deposit-status') in FINAL_STATUSES and
+                               previous.get(t.get('repo-name')) != t.get('deposit-time') for t in targets):
+                self.targets = targets
+                return
+            time.sleep(0.2)
+        raise TimeoutError(f'Deposit of {self.dataset_id} did not finish in {self.timeout} seconds')
+
+    def _resubmit(self):
+        """Resubmits the failed targets (POST /inbox/resubmit) and waits until they are final again."""
+        self.resubmitted += 1
+        previous = {t.get('repo-name'): t.get('deposit-time') for t in self.targets
+                    if t.get('deposit-status') not in SUCCESS_STATUSES}
+        requests.post(f'{self.service_url}/inbox/resubmit/{self.dataset_id}', headers=self.headers,
+                      timeout=self.timeout).raise_for_status()
+        self._wait_for_deposit(previous)
+
+    @property
+    def succeeded(self) -> bool:
+        return self.error is None and all(t.get('deposit-status') in SUCCESS_STATUSES for t in self.targets)
+
+
+def create_files(work_dir: str, number: int, size: int) -> [str]:
+    paths = []
+    for i in range(number):
+        path = os.path.join(work_dir, f'source-{i}.bin')
+        with open(path, 'wb') as f:
+            remaining = size
+            while remaining > 0:
+                n = min(remaining, 8 * 1024 * 1024)
+                f.write(os.urandom(n))
+                remaining -= n
+        paths.append(path)
+    return paths
+
+
+def run_closed_loop(args, new_run) -> [DatasetRun]:
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        return list(pool.map(lambda _: new_run().run(), range(args.datasets)))
+
+
+def run_open_loop(args, new_run) -> [DatasetRun]:
+    rng = random.Random(args.seed)
+    futures = []
+    # Every dataset gets its own client thread, late datasets must not wait for a free one.
+    with ThreadPoolExecutor(max_workers=max(int(args.rate * (args.duration + args.timeout) / 60) + 1, 1)) as pool:
+        start = time.monotonic()
+        next_arrival = rng.expovariate(args.rate / 60)
+        while next_arrival < args.duration:
+            time.sleep(max(next_arrival - (time.monotonic() - start), 0))
+            futures.append(pool.submit(new_run().run))
+            next_arrival += rng.expovariate(args.rate / 60)
+    return [f.result() for f in futures]
+
+
+def report(args, runs: [DatasetRun], wall: float, resources: dict, service_info: dict, standins: dict) -> dict:
+    stages = {stage: summarize([d for r in runs for d in r.stages[stage]]) for stage in DatasetRun.STAGES}
+    targets = {}
+    for run in runs:
+        for t in run.targets:
+            entry = targets.setdefault(t.get('repo-name'), {"statuses": {}, "durations": []})
+            entry["statuses"][t.get('deposit-status')] = entry["statuses"].get(t.get('deposit-status'), 0) + 1
+            entry["durations"].append(float(t.get('duration') or 0))
+    succeeded = sum(1 for r in runs if r.succeeded)
+    return {
+        "benchmark": "e2e",
+        "service": service_info,
+        "python": platform.python_version(),
+        "cpu-count": os.cpu_count(),
+        "parameters": {"mode": "load" if args.rate else "closed-loop",
+                       "datasets": None if args.rate else args.datasets,
+                       "files": args.files, "file-size-bytes": int(args.file_size_mb * 2 ** 20),
+                       "targets": args.targets, "concurrency": args.concurrency, "workers": args.workers,
+                       "auth": args.auth, "chunk-size-bytes": args.chunk_size_mb * 2 ** 20, "rate": args.rate,
+                       "duration": args.duration, "profile": args.profile, "seed": args.seed,
+                       "resubmit": args.resubmit, "embargo-dates": args.embargo_dates},
+        "wall-seconds": round(wall, 3),
+        "datasets": {"total": len(runs), "succeeded": succeeded, "failed": len(runs) - succeeded,
+                     "resubmits": sum(r.resubmitted for r in runs)},
+        "datasets-per-minute": round(succeeded / wall * 60, 3) if wall else 0,
+        "stages": stages,
+        "targets": {name: {"statuses": t["statuses"], "duration": summarize(t["durations"])}
+                    for name, t in targets.items()},
+        "resources": resources,
+        "standins": standins,
+        "errors": sorted({r.error for r in runs if r.error}),
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--datasets', type=int, default=10)
+    parser.add_argument('--files', type=int, default=3, help='files per dataset')
+    parser.add_argument('--file-size-mb', type=float, default=1.0)
+    parser.add_argument('--targets', default='dataverse', help=f'comma separated, of {", ".join(TARGETS)}')
+    parser.add_argument('--concurrency', type=int, default=1, help='datasets submitted in parallel')
+    parser.add_argument('--workers', type=int, default=1, help='uvicorn workers of the service')
+    parser.add_argument('--auth', choices=('api-key', 'keycloak'), default='api-key')
+    parser.add_argument('--chunk-size-mb', type=int, default=8, help='tus PATCH chunk size')
+    parser.add_argument('--poll-delay', type=float, default=0.5, help='SWH polling delay of the service')
+    parser.add_argument('--timeout', type=float, default=600, help='per request and per deposit, in seconds')
+    parser.add_argument('--profile', default=None, help='fault profile (script) JSON file for the stand-ins')
+    parser.add_argument('--rate', type=float, default=0, help='load test: datasets per minute (open loop)')
+    parser.add_argument('--duration', type=float, default=300, help='load test: seconds of arrivals')
+    parser.add_argument('--seed', type=int, default=None, help='seed of the load test arrivals')
+    parser.add_argument('--embargo-dates', type=int, default=0,
+                        help='embargo the files, spread over this many dates (dataverse)')
+    parser.add_argument('--resubmit', type=int, default=0,
+                        help='resubmit a failed dataset (POST /inbox/resubmit) up to this many times')
+    parser.add_argument('--service-port', type=int, default=10180)
+    parser.add_argument('--standins-port', type=int, default=10190)
+    parser.add_argument('--work-dir', default=None)
+    parser.add_argument('--output', default=None, help='write the JSON result to this file')
+    args = parser.parse_args(argv)
+    args.targets = [t.strip() for t in args.targets.split(',') if t.strip()]
+    unknown = set(args.targets) - set(TARGETS)
+    if unknown:
+        parser.error(f'Unknown target(s): {", ".join(sorted(unknown))}')
+    if 'swh-sword' in args.targets and ('dataverse' not in args.targets
+                                        or args.targets.index('dataverse') > args.targets.index('swh-sword')):
+        parser.error('swh-sword deposits the DOI of the dataverse target, list dataverse before it')
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    standins_url = f'http://127.0.0.1:{args.standins_port}'
+    service_url = f'http://127.0.0.1:{args.service_port}'
+    processes = []
+    with tempfile.TemporaryDirectory(dir=args.work_dir) as work_dir:
+        for d in ('db', 'tmp/tus-files', 'filesystem', 'sources'):
+            os.makedirs(os.path.join(work_dir, d))
+        try:
+            processes.append(start_process([sys.executable, '-m', 'uvicorn', 'benchmarks.standins:app', '--port',
+                                            str(args.standins_port), '--log-level', 'warning'],
+                                           f'{standins_url}/stats'))
+            requests.put(f'{standins_url}/assistant/{ASSISTANT_CONFIG_NAME}', data=json.dumps({
+                "assistant-config-name": ASSISTANT_CONFIG_NAME, "description": "Benchmark", "app-name": APP_NAME,
+                "app-config-url": f'{standins_url}/assistant/{ASSISTANT_CONFIG_NAME}',
+                "targets": [target_config(t, standins_url, work_dir) for t in args.targets]})).raise_for_status()
+            processes.append(start_process([sys.executable, '-m', 'uvicorn', 'src.main:app', '--port',
+                                            str(args.service_port), '--workers', str(args.workers),
+                                            '--log-level', 'warning'],
+                                           f'{service_url}/', env=service_environment(args, work_dir, standins_url)))
+            service_info = requests.get(f'{service_url}/').json()
+
+            file_paths = create_files(os.path.join(work_dir, 'sources'), args.files,
+                                      int(args.file_size_mb * 2 ** 20))
+            headers = {"Authorization": f'Bearer {BENCHMARK_API_KEY}'} if args.auth == 'api-key' else \
+                {"Authorization": f'Bearer {keycloak_token(standins_url)}', "auth-env-name": AUTH_ENV_NAME}
+            requests.delete(f'{standins_url}/stats')
+
+            samplers = [ResourceSampler(processes[-1].pid)] + ([MetricsSampler(service_url)] if args.rate else [])
+            if args.profile:
+                with open(args.profile) as f:
+                    samplers.append(ProfileScript(standins_url, json.load(f)))
+            for sampler in samplers:
+                sampler.start()
+            start = time.perf_counter()
+            new_run = lambda: DatasetRun(service_url, headers, file_paths, args.chunk_size_mb * 2 ** 20, args.timeout,
+                                         args.resubmit, args.embargo_dates)
+            runs = run_open_loop(args, new_run) if args.rate else run_closed_loop(args, new_run)
+            wall = time.perf_counter() - start
+            resources = samplers[0].stop()
+            load = samplers[1].stop() if args.rate else None
+            if args.profile:
+                samplers[-1].stop()
+            result = report(args, runs, wall, resources, service_info, requests.get(f'{standins_url}/stats').json())
+            if load:
+                result["load"] = load
+        finally:
+            for process in reversed(processes):
+                process.terminate()
+                process.wait(timeout=30)
+
+    output = json.dumps(result, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    print(output)
+    return result
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+"""
+Fault and latency injection for the stand-ins (see benchmarks.standins).
+
+A fault profile is a JSON document, set on the running stand-ins with ``PUT /control/profile`` or scripted over
+time by ``benchmarks.e2e --profile``:
+
+    {
+      "seed": 42,
+      "rules": [
+        {"service": "dataverse", "method": "POST", "path": "/api/datasets/:persistentId/add",
+         "latency": {"distribution": "lognormal", "median": 0.5, "sigma": 0.8},
+         "bandwidth": 10485760,
+         "error-rate": 0.05, "error-status": 502, "error-body": "<html>502 Bad Gateway</html>",
+         "timeout-rate": 0.01, "timeout-seconds": 900}
+      ],
+      "dataverse": {"lock-seconds": 3},
+      "swh": {"seconds-until-done": 180, "failure-rate": 0.1},
+      "swh-sword": {"seconds-until-done": 60, "failure-rate": 0.0}
+    }
+
+Every rule matches on the stand-in (``service``), and optionally the HTTP method and a regular expression that is
+searched in the path below the stand-in prefix. All matching rules apply: latencies add up, the lowest bandwidth
+cap wins, the first drawn error or timeout is answered. Latency distributions are ``fixed`` (seconds), ``uniform``
+(min, max), ``exponential`` (mean) and ``lognormal`` (median, sigma).
+
+The per stand-in sections are the behaviour of the simulated repositories themselves: the duration of the Dataverse
+dataset lock after a file was added (edits in that time get a 409), and how long Software Heritage save requests
+and SWORD deposits stay pending before they finish (or fail).
+"""
+import asyncio
+import math
+import random
+import re
+
+
+class FaultRule:
+    def __init__(self, rule: dict):
+        self.service = rule["service"]
+        self.method = rule.get("method", "").upper()
+        self.path = re.compile(rule["path"]) if rule.get("path") else None
+        self.latency = rule.get("latency")
+        self.bandwidth = rule.get("bandwidth")
+        self.error_rate = rule.get("error-rate", 0.0)
+        self.error_status = rule.get("error-status", 502)
+        self.error_body = rule.get("error-body", "<html><head><title>502 Bad Gateway</title></head></html>")
+        self.timeout_rate = rule.get("timeout-rate", 0.0)
+        self.timeout_seconds = rule.get("timeout-seconds", 900)
+
+    def matches(self, service: str, method: str, path: str) -> bool:
+        return (self.service == service and (not self.method or self.method == method)
+                and (self.path is None or self.path.search(path) is not None))
+
+
+class FaultInjector:
+    """The active fault profile of the stand-ins and the counts of the injected faults."""
+
+    def __init__(self):
+        self.profile = {}
+        self.rules = []
+        self.random = random.Random()
+        self.injected = {}
+
+    def load(self, profile: dict) -> type(None):
+        self.profile = profile
+        self.rules = [FaultRule(r) for r in profile.get("rules", [])]
+        self.random = random.Random(profile.get("seed"))
+
+    def reset(self) -> type(None):
+        self.load({})
+        self.injected = {}
+
+    def setting(self, service: str, name: str, default=None):
+        return self.profile.get(service, {}).get(name, default)
+
+    def chance(self, rate: float) -> bool:
+        return rate > 0 and self.random.random() < rate
+
+    def count(self, service: str, fault: str) -> type(None):
+        service_faults = self.injected.setdefault(service, {})
+        service_faults[fault] = service_faults.get(fault, 0) + 1
+
+    def sample_latency(self, latency: dict) -> float:
+        distribution = latency.get("distribution", "fixed")
+        if distribution == "uniform":
+            return self.random.uniform(latency.get("min", 0.0), latency.get("max", 0.0))
+        if distribution == "exponential":
+            return self.random.expovariate(1 / latency["mean"]) if latency.get("mean") else 0.0
+        if distribution == "lognormal":
+            return self.random.lognormvariate(math.log(latency["median"]), latency.get("sigma", 0.5))
+        return latency.get("seconds", 0.0)
+
+    def plan(self, service: str, method: str, path: str) -> dict:
+        """
+        Draws the faults of one request.
+
+        Returns:
+            dict: delay (seconds), bandwidth (bytes per second or None) and fault (None, 'error' or 'timeout', with
+            the status code and body of the response to give).
+        """
+        plan = {"delay": 0.0, "bandwidth": None, "fault": None}
+        for rule in (r for r in self.rules if r.matches(service, method, path)):
+            if rule.latency:
+                plan["delay"] += self.sample_latency(rule.latency)
+            if rule.bandwidth:
+                plan["bandwidth"] = min(plan["bandwidth"] or rule.bandwidth, rule.bandwidth)
+            if plan["fault"]:
+                continue
+            if self.chance(rule.timeout_rate):
+                plan.update(fault="timeout", delay=plan["delay"] + rule.timeout_seconds, status=504,
+                            body="<html><head><title>504 Gateway Time-out</title></head></html>")
+            elif self.chance(rule.error_rate):
+                plan.update(fault="error", status=rule.error_status, body=rule.error_body)
+        if plan["fault"]:
+            self.count(service, plan["fault"])
+        return plan
+
+
+async def throttled(stream, bandwidth: int = None):
+    """Yields the chunks of the stream, no faster than bandwidth bytes per second (if given)."""
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+    received = 0
+    async for chunk in stream:
+        received += len(chunk)
+        if bandwidth:
+            ahead = received / bandwidth - (loop.time() - start)
+            if ahead > 0:
+                await asyncio.sleep(ahead)
+        yield chunk
@@ -0,0 +1,76 @@
+"""
+Checks the cold import time of the service, what every worker pays at startup.
+
+Usage:
+
+    python -m benchmarks.import_time [--budget-ms 2000] [--runs 5] [--module src.main] [--top 15]
+
+Imports the module in fresh interpreters with ``-X importtime`` (the environment, e.g. BASE_DIR and the DYNACONF_
+overrides, is passed on), takes the median of the runs and prints the slowest imports. Exits with 1 when the median
+is over the budget or when one of the heavy modules that are only needed at the point of use (``--deferred``) was
+imported.
+"""
+import argparse
+import re
+import statistics
+import subprocess
+import sys
+from collections import defaultdict
+
+DEFERRED_MODULES = ('uvicorn', 'gunicorn', 'emoji', 'keycloak', 'jwcrypto.jwk', 'httpx', 'requests_toolbelt',
+                    'opentelemetry.instrumentation.fastapi', 'opentelemetry.exporter', 'opentelemetry.sdk', 'sword2',
+                    'src.modules')
+IMPORT_TIME_LINE = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)$')
+
+
+def import_times(module: str) -> [(int, str, int)]:
+    """Returns (depth, module, cumulative microseconds) of the imports of the module in a fresh interpreter."""
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f'Importing {module} failed:\n{result.stderr[-2000:]}')
+    times = [(len(m.group(3)) // 2, m.group(4), int(m.group(2)))
+             for m in map(IMPORT_TIME_LINE.match, result.stderr.splitlines()) if m]
+    # The imports are listed children first, the ones before the module's own children belong to the interpreter.
+    end = next(i for i, (depth, name, _) in enumerate(times) if depth == 0 and name == module)
+    start = max((i + 1 for i, (depth, _, _) in enumerate(times[:end]) if depth == 0), default=0)
+    return times[start:end + 1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--module', default='src.main')
+    parser.add_argument('--budget-ms', type=float, default=2000)
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--top', type=int, default=15)
+    parser.add_argument('--deferred', default=','.join(DEFERRED_MODULES),
+                        help='comma separated modules (and their submodules) that must not be imported')
+    args = parser.parse_args()
+
+    totals = []
+    cumulative = defaultdict(list)
+    imported = set()
+    for _ in range(args.runs):
+        times = import_times(args.module)
+        totals.append(times[-1][2] / 1000)
+        for depth, name, us in times:
+            imported.add(name)
+            if depth == 1:
+                cumulative[name].append(us / 1000)
+
+    median = statistics.median(totals)
+    print(f'{args.module}: median {median:.1f} ms, min {min(totals):.1f} ms, max {max(totals):.1f} ms '
+          f'over {args.runs} runs, budget {args.budget_ms:.0f} ms')
+    slowest = sorted(((statistics.median(ms), name) for name, ms in cumulative.items()), reverse=True)[:args.top]
+    for ms, name in slowest:
+        print(f'  {name:50} {ms:>9.1f} ms')
+
+    deferred = [d for d in args.deferred.split(',') if d]
+    early = sorted(d for d in deferred if any(name == d or name.startswith(f'{d}.') for name in imported))
+    if early:
+        print(f'Imported at startup but deferred to the point of use: {", ".join(early)}')
+    sys.exit(1 if median > args.budget_ms or early else 0)
+
+
+if __name__ == '__main__':
+    main()
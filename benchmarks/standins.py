@@ -0,0 +1,377 @@
+"""
+Local stand-ins for the external services of the packaging service, for benchmarks.
+
+One FastAPI application serves all of them, each under its own prefix:
+
+- ``/assistant``    repository assistant configuration service (``ASSISTANT_CONFIG_URL``)
+- ``/transformer``  metadata transformer (``transformer-url`` of the targets)
+- ``/dataverse``    Dataverse native API
+- ``/zenodo``       Zenodo deposition API
+- ``/swh``          Software Heritage save code now API
+- ``/swh-sword``    Software Heritage SWORD deposit
+- ``/keycloak``     Keycloak realm keys, token and userinfo
+
+The stand-ins answer like the real services do for the calls the bridges make, uploads are read completely (so
+the transfer is measured) but not stored. Latency, errors, timeouts, bandwidth caps, Dataverse dataset locks and slow
+Software Heritage tasks are injected according to the fault profile set with ``PUT /control/profile`` (see
+benchmarks.faults). Start them with:
+
+    python -m uvicorn benchmarks.standins:app --port 10190
+"""
+import asyncio
+import hashlib
+import itertools
+import json
+import time
+import uuid
+from datetime import datetime, timezone
+
+from fastapi import FastAPI, APIRouter, Request, Response
+from fastapi.responses import JSONResponse
+from jwcrypto import jwk, jwt
+
+from benchmarks.faults import FaultInjector, throttled
+
+ATOM_RECEIPT = '''<?xml version="1.0" encoding="utf-8"?>
+<entry xmlns="http://www.w3.org/2005/Atom" xmlns:sword="http://purl.org/net/sword/terms/">
+  <id>{deposit_id}</id>
+  <deposit_id>{deposit_id}</deposit_id>
+  <deposit_status>{status}</deposit_status>
+  <link rel="alternate" href="{status_url}"/>
+  <link rel="edit" href="{status_url}"/>
+</entry>
+'''
+
+ids = itertools.count(1)
+# Assistant configurations registered by the benchmark driver, by name.
+assistant_configs = {}
+# Software Heritage save requests and SWORD deposits, by id: (time it is done, whether it fails).
+swh_requests = {}
+sword_deposits = {}
+# Locked Dataverse datasets, by persistent id: time the lock is released.
+dataverse_locks = {}
+# Dataverse datasets of which the draft was deleted, by id.
+dataverse_deleted = set()
+faults = FaultInjector()
+# Number of requests and received bytes per stand-in, see GET /stats.
+stats = {}
+
+
+def count(service: str, received: int = 0) -> type(None):
+    service_stats = stats.setdefault(service, {"requests": 0, "received-bytes": 0})
+    service_stats["requests"] += 1
+    service_stats["received-bytes"] += received
+
+
+async def drain(request: Request, digest=None) -> int:
+    """
+    Reads the complete request body without keeping it (at the injected bandwidth), returns its size. The body is
+    added to digest (a hashlib object) when given.
+    """
+    size = 0
+    async for chunk in throttled(request.stream(), getattr(request.state, 'bandwidth', None)):
+        size += len(chunk)
+        if digest:
+            digest.update(chunk)
+    return size
+
+
+def pending_outcome(service: str) -> (float, bool):
+    # When a simulated long running task (save request, deposit) is done, and whether it fails.
+    return (time.monotonic() + faults.setting(service, "seconds-until-done", 0),
+            faults.chance(faults.setting(service, "failure-rate", 0.0)))
+
+
+def base_url(request: Request) -> str:
+    return str(request.base_url).rstrip('/')
+
+
+assistant = APIRouter()
+
+
+@assistant.put("/{name}")
+async def register_assistant_config(name: str, request: Request):
+    assistant_configs[name] = (await request.body()).decode()
+    return {"status": "ok", "name": name}
+
+
+@assistant.get("/{name}")
+async def get_assistant_config(name: str, request: Request):
+    count('assistant')
+    if name not in assistant_configs:
+        return JSONResponse(status_code=404, content={"detail": f'{name} not found'})
+    etag = f'"{hashlib.md5(assistant_configs[name].encode()).hexdigest()}"'
+    if request.headers.get('if-none-match') == etag:
+        return Response(status_code=304, headers={'ETag': etag})
+    # The real service returns the configuration as a JSON encoded string.
+    return JSONResponse(content=assistant_configs[name], headers={'ETag': etag})
+
+
+transformer = APIRouter()
+
+
+@transformer.post("/transform/{name}")
+async def transform(name: str, request: Request):
+    body = await request.body()
+    count('transformer', len(body))
+    md = json.loads(body)
+    files = md.get("file-metadata", [])
+    if name == 'dataverse-files':
+        result = json.dumps({f["name"]: dict({"description": "", "restrict": bool(f.get("private"))},
+                                             **({"embargo": f["embargo"]} if f.get("embargo") else {}))
+                             for f in files})
+    elif name == 'dataverse-dataset':
+        result = json.dumps({"datasetVersion": {"metadataBlocks": {"citation": {"fields": [
+            {"typeName": "title", "typeClass": "primitive", "multiple": False, "value": md.get("title", "")}]}}}})
+    elif name == 'zenodo-dataset':
+        result = json.dumps({"metadata": {"title": md.get("title", ""), "upload_type": "dataset"}})
+    elif name == 'swh-sword':
+        result = ('<?xml version="1.0"?><entry xmlns="http://www.w3.org/2005/Atom">'
+                  f'<title>{md.get("title", "")}</title></entry>')
+    else:
+        result = body.decode()
+    return {"result": result}
+
+
+dataverse = APIRouter()
+
+
+@dataverse.post("/api/dataverses/{alias}/datasets")
+async def dataverse_create_dataset(alias: str, request: Request):
+    count('dataverse', await drain(request))
+    dataset_id = next(ids)
+    return JSONResponse(status_code=201, content={"status": "OK", "data": {
+        "id": dataset_id, "persistentId": f'doi:10.5072/FK2/BENCH{dataset_id:06d}'}})
+
+
+def dataverse_locked(persistent_id: str) -> JSONResponse | None:
+    if dataverse_locks.get(persistent_id, 0) > time.monotonic():
+        faults.count('dataverse', 'lock')
+        return JSONResponse(status_code=409, content={"status": "ERROR",
+                                                      "message": "Dataset cannot be edited due to dataset lock."})
+    return None
+
+
+@dataverse.post("/api/datasets/:persistentId/add")
+async def dataverse_add_file(persistentId: str, request: Request):
+    count('dataverse', await drain(request))
+    locked = dataverse_locked(persistentId)
+    if locked:
+        return locked
+    # Dataverse locks the dataset while it ingests the added file.
+    if faults.setting('dataverse', 'lock-seconds'):
+        dataverse_locks[persistentId] = time.monotonic() + faults.setting('dataverse', 'lock-seconds')
+    return {"status": "OK", "data": {"files": [{"dataFile": {"id": next(ids)}}]}}
+
+
+@dataverse.delete("/api/files/{file_id}")
+async def dataverse_delete_file(file_id: int):
+    count('dataverse')
+    return {"status": "OK", "data": {"message": f"Deleted file {file_id}"}}
+
+
+@dataverse.get("/api/datasets/:persistentId/locks")
+async def dataverse_get_locks(persistentId: str):
+    count('dataverse')
+    if dataverse_locks.get(persistentId, 0) > time.monotonic():
+        return {"status": "OK", "data": [{"lockType": "Ingest", "date": datetime.now(timezone.utc).isoformat(),
+                                          "user": "benchmark", "dataset": persistentId}]}
+    return {"status": "OK", "data": []}
+
+
+@dataverse.post("/api/datasets/:persistentId/files/actions/:set-embargo")
+async def dataverse_set_embargo(persistentId: str, request: Request):
+    count('dataverse', await drain(request))
+    return dataverse_locked(persistentId) or {"status": "OK", "data": {"message": "Files were embargoed"}}
+
+
+@dataverse.post("/api/datasets/:persistentId/actions/:publish")
+async def dataverse_publish(persistentId: str):
+    count('dataverse')
+    return dataverse_locked(persistentId) or {"status": "OK", "data": {"persistentId": persistentId}}
+
+
+@dataverse.get("/api/datasets/{dataset_id}")
+async def dataverse_get_dataset(dataset_id: int):
+    count('dataverse')
+    if dataset_id in dataverse_deleted:
+        return JSONResponse(status_code=404, content={"status": "ERROR", "message": f"Dataset {dataset_id} not found"})
+    return {"status": "OK", "data": {"id": dataset_id, "persistentId": f'doi:10.5072/FK2/BENCH{dataset_id:06d}'}}
+
+
+@dataverse.delete("/api/datasets/{dataset_id}/versions/:draft")
+async def dataverse_delete_draft(dataset_id: int):
+    count('dataverse')
+    dataverse_deleted.add(dataset_id)
+    return {"status": "OK", "data": {"message": "Draft version of dataset deleted"}}
+
+
+zenodo = APIRouter()
+
+
+def zenodo_deposition(request: Request, deposition_id: int) -> dict:
+    url = f'{base_url(request)}/zenodo'
+    now = datetime.now(timezone.utc).isoformat()
+    links = {name: f'{url}/api/deposit/depositions/{deposition_id}' for name in
+             ("self", "latest_draft", "edit", "discard", "newversion", "registerconceptdoi", "files", "publish")}
+    links.update(html=f'{url}/deposit/{deposition_id}', latest_draft_html=f'{url}/deposit/{deposition_id}',
+                 badge=f'{url}/badge/doi/.svg', bucket=f'{url}/api/files/{uuid.uuid4()}')
+    return {"created": now, "modified": now, "id": deposition_id, "conceptrecid": str(deposition_id - 1),
+            "metadata": {"access_right": "open",
+                         "prereserve_doi": {"doi": f'10.5281/zenodo.{deposition_id}', "recid": deposition_id}},
+            "title": "", "links": links, "record_id": deposition_id, "owner": 1, "files": [], "state": "unsubmitted",
+            "submitted": False}
+
+
+@zenodo.post("/api/deposit/depositions")
+async def zenodo_create(request: Request):
+    count('zenodo', await drain(request))
+    return JSONResponse(status_code=201, content=zenodo_deposition(request, next(ids)))
+
+
+@zenodo.put("/api/deposit/depositions/{deposition_id}")
+async def zenodo_update(deposition_id: int, request: Request):
+    count('zenodo', await drain(request))
+    return zenodo_deposition(request, deposition_id)
+
+
+@zenodo.put("/api/files/{bucket}/{name:path}")
+async def zenodo_upload(bucket: str, name: str, request: Request):
+    md5 = hashlib.md5()
+    size = await drain(request, md5)
+    count('zenodo', size)
+    return JSONResponse(status_code=201, content={"key": name, "size": size, "bucket": bucket,
+                                                  "checksum": f'md5:{md5.hexdigest()}'})
+
+
+swh = APIRouter()
+
+
+@swh.post("/api/1/origin/save/{visit_type}/url/{origin:path}")
+async def swh_save(visit_type: str, origin: str, request: Request):
+    count('swh', await drain(request))
+    request_id = next(ids)
+    swh_requests[request_id] = pending_outcome('swh')
+    return {"id": request_id, "origin_url": origin, "save_request_status": "accepted", "save_task_status": "pending",
+            "request_url": f'{base_url(request)}/swh/api/1/origin/save/{request_id}/'}
+
+
+@swh.get("/api/1/origin/save/{request_id}/")
+async def swh_save_status(request_id: int):
+    count('swh')
+    done, fails = swh_requests.get(request_id, (0, False))
+    if done > time.monotonic():
+        return {"id": request_id, "save_request_status": "accepted", "save_task_status": "running"}
+    if fails:
+        return {"id": request_id, "save_request_status": "accepted", "save_task_status": "failed"}
+    return {"id": request_id, "save_request_status": "accepted", "save_task_status": "succeeded",
+            "snapshot_swhid": f'swh:1:snp:{request_id:040x}'}
+
+
+swh_sword = APIRouter()
+
+
+@swh_sword.post("/1/{collection}/")
+async def sword_deposit(collection: str, request: Request):
+    count('swh-sword', await drain(request))
+    deposit_id = next(ids)
+    sword_deposits[deposit_id] = pending_outcome('swh-sword')
+    status_url = f'{base_url(request)}/swh-sword/1/{collection}/{deposit_id}/status/'
+    return Response(status_code=201, media_type='application/atom+xml',
+                    content=ATOM_RECEIPT.format(deposit_id=deposit_id, status='partial', status_url=status_url))
+
+
+@swh_sword.get("/1/{collection}/{deposit_id}/status/")
+async def sword_status(collection: str, deposit_id: int, request: Request):
+    count('swh-sword')
+    done, fails = sword_deposits.get(deposit_id, (0, False))
+    deposit_status = 'partial' if done > time.monotonic() else 'rejected' if fails else 'deposited'
+    return Response(media_type='application/atom+xml', content=ATOM_RECEIPT.format(
+        deposit_id=deposit_id, status=deposit_status, status_url=str(request.url)))
+
+
+keycloak = APIRouter()
+keycloak_key = jwk.JWK.generate(kty='RSA', size=2048, kid='benchmark', use='sig', alg='RS256')
+
+
+@keycloak.get("/realms/{realm}/protocol/openid-connect/certs")
+async def keycloak_certs(realm: str):
+    count('keycloak')
+    return {"keys": [keycloak_key.export_public(as_dict=True)]}
+
+
+@keycloak.post("/realms/{realm}/protocol/openid-connect/token")
+async def keycloak_token(realm: str, request: Request):
+    """Issues a signed access token for the benchmark user, like a password or client credentials grant."""
+    count('keycloak')
+    now = int(time.time())
+    token = jwt.JWT(header={"alg": "RS256", "typ": "JWT", "kid": keycloak_key.key_id},
+                    claims={"iss": f'{str(request.base_url).rstrip("/")}/keycloak/realms/{realm}',
+                            "sub": "benchmark-user", "azp": "benchmark", "iat": now, "exp": now + 3600,
+                            "preferred_username": "benchmark"})
+    token.make_signed_token(keycloak_key)
+    return {"access_token": token.serialize(), "token_type": "Bearer", "expires_in": 3600}
+
+
+@keycloak.api_route("/realms/{realm}/protocol/openid-connect/userinfo", methods=["GET", "POST"])
+async def keycloak_userinfo(realm: str, request: Request):
+    count('keycloak')
+    if not request.headers.get('Authorization', '').startswith('Bearer '):
+        return JSONResponse(status_code=401, content={"error": "invalid_token"})
+    return {"sub": "benchmark-user", "preferred_username": "benchmark", "realm": realm}
+
+
+app = FastAPI(title="Packaging Service stand-ins")
+app.include_router(assistant, prefix="/assistant")
+app.include_router(transformer, prefix="/transformer")
+app.include_router(dataverse, prefix="/dataverse")
+app.include_router(zenodo, prefix="/zenodo")
+app.include_router(swh, prefix="/swh")
+app.include_router(swh_sword, prefix="/swh-sword")
+app.include_router(keycloak, prefix="/keycloak")
+SERVICES = ('assistant', 'transformer', 'dataverse', 'zenodo', 'swh', 'swh-sword', 'keycloak')
+
+
+@app.middleware("http")
+async def inject_faults(request: Request, call_next):
+    service, _, path = request.url.path.lstrip('/').partition('/')
+    if service not in SERVICES:
+        return await call_next(request)
+    plan = faults.plan(service, request.method, f'/{path}')
+    request.state.bandwidth = plan["bandwidth"]
+    if plan["delay"]:
+        await asyncio.sleep(plan["delay"])
+    if plan["fault"]:
+        # Like a proxy in front of the service: the request (upload) is received, then the error is returned.
+        count(service, await drain(request))
+        return Response(status_code=plan["status"], content=plan["body"], media_type='text/html')
+    return await call_next(request)
+
+
+@app.get("/stats")
+async def get_stats():
+    return {"requests": stats, "injected-faults": faults.injected}
+
+
+@app.delete("/stats")
+async def reset_stats():
+    stats.clear()
+    faults.injected.clear()
+    return {}
+
+
+@app.get("/control/profile")
+async def get_profile():
+    return faults.profile
+
+
+@app.put("/control/profile")
+async def set_profile(request: Request):
+    faults.load(await request.json())
+    return faults.profile
+
+
+@app.delete("/control/profile")
+async def reset_profile():
+    faults.reset()
+    return faults.profile
@@ -0,0 +1,19 @@
+"""Summary statistics shared by the benchmarks."""
+import math
+
+
+def percentile(sorted_values: [float], p: float) -> float:
+    """Nearest-rank percentile of an ascending list."""
+    if not sorted_values:
+        return 0.0
+    return sorted_values[max(math.ceil(p / 100 * len(sorted_values)) - 1, 0)]
+
+
+def summarize(values: [float]) -> dict:
+    values = sorted(values)
+    if not values:
+        return {"count": 0}
+    return {"count": len(values), "mean": round(sum(values) / len(values), 4), "min": round(values[0], 4),
+            "p50": round(percentile(values, 50), 4), "p90": round(percentile(values, 90), 4),
+            "p95": round(percentile(values, 95), 4), "p99": round(percentile(values, 99), 4),
+            "max": round(values[-1], 4)}
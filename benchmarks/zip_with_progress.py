@@ -0,0 +1,88 @@
+"""
+Benchmark of commons.zip_with_progress against the previous (temp chunk file based) implementation.
+
+Usage (from the repository root, with the usual BASE_DIR / settings environment):
+
+    python -m benchmarks.zip_with_progress --size-gb 4 [--work-dir /data/tmp] [--compressed]
+
+A test file of the given size is generated in the work directory (half random, half highly compressible data,
+or only random data with --compressed, named .zip so it is stored). Both implementations zip it, the wall time,
+throughput, archive size and number of archive entries are printed as JSON.
+"""
+import argparse
+import json
+import os
+import tempfile
+import time
+import zipfile
+
+from src.commons import zip_with_progress
+
+BLOCK_SIZE = 8 * 1024 * 1024
+
+
+def legacy_zip_with_progress(file_path, zip_path):
+    # The implementation before the streaming rewrite, kept here only to compare against.
+    real_file_path = os.readlink(file_path) if os.path.islink(file_path) else file_path
+    chunk_size = 10 * 1024 * 1024
+    arcname = os.path.basename(file_path)
+    with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
+        with open(real_file_path, 'rb') as f:
+            while True:
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    break
+                temp_chunk_path = 'temp_chunk'
+                with open(temp_chunk_path, 'wb') as tempf:
+                    tempf.write(chunk)
+                zipf.write(temp_chunk_path, arcname=arcname)
+                os.remove(temp_chunk_path)
+
+
+def create_test_file(path: str, size: int, compressed: bool) -> type(None):
+    text_block = (b'packaging-service benchmark line 0123456789\n' * (BLOCK_SIZE // 44 + 1))[:BLOCK_SIZE]
+    written = 0
+    with open(path, 'wb') as f:
+        while written < size:
+            n = min(BLOCK_SIZE, size - written)
+            use_random = compressed or (written // BLOCK_SIZE) % 2 == 0
+            f.write(os.urandom(n) if use_random else text_block[:n])
+            written += n
+
+
+def run(name, func, file_path, zip_path) -> dict:
+    start = time.perf_counter()
+    func(file_path, zip_path)
+    duration = time.perf_counter() - start
+    with zipfile.ZipFile(zip_path) as zf:
+        entries = len(zf.infolist())
+    result = {"implementation": name, "seconds": round(duration, 2),
+              "mb-per-second": round(os.path.getsize(file_path) / duration / (1024 * 1024), 1),
+              "zip-size": os.path.getsize(zip_path), "entries": entries}
+    os.remove(zip_path)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--size-gb', type=float, default=2.0)
+    parser.add_argument('--work-dir', default=None)
+    parser.add_argument('--compressed', action='store_true', help='generate incompressible data named .zip')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(dir=args.work_dir) as work_dir:
+        file_path = os.path.join(work_dir, 'benchmark.zip' if args.compressed else 'benchmark.bin')
+        create_test_file(file_path, int(args.size_gb * 1024 ** 3), args.compressed)
+        zip_path = os.path.join(work_dir, 'out.zip')
+        cwd = os.getcwd()
+        os.chdir(work_dir)  # the legacy implementation writes its temp chunk in the current directory
+        try:
+            results = [run('legacy', legacy_zip_with_progress, file_path, zip_path),
+                       run('streaming', zip_with_progress, file_path, zip_path)]
+        finally:
+            os.chdir(cwd)
+    print(json.dumps({"file-size": int(args.size_gb * 1024 ** 3), "results": results}, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+"""
+Cache of the repository assistant configurations (``ASSISTANT_CONFIG_URL``).
+
+The parsed ``RepoAssistantDataModel`` of every assistant is kept for ``ASSISTANT_CONFIG_TTL`` seconds. A stale entry
+is revalidated with ``If-None-Match`` (the ``ETag`` of the previous response), an unchanged configuration costs a
+304 and no parsing. While the configuration service is unreachable or failing, a stale entry is served for up to
+``ASSISTANT_CONFIG_MAX_STALE`` seconds. ``ASSISTANT_CONFIG_WARM`` lists the assistants to fetch at startup.
+
+Callers get a deep copy: the targets of the configuration get the depositor's credentials filled in.
+"""
+import threading
+import time
+
+import requests
+from fastapi import HTTPException
+
+from src.commons import settings, logger, assistant_repo_headers, LOG_LEVEL_DEBUG, LOG_NAME_PS
+from src.models.assistant_datamodel import RepoAssistantDataModel
+
+
+class _Entry:
+    def __init__(self, model: RepoAssistantDataModel, etag: str | None):
+        self.model = model
+        self.etag = etag
+        self.validated_at = time.monotonic()
+
+    def age(self) -> float:
+        return time.monotonic() - self.validated_at
+
+
+class AssistantConfigCache:
+    def __init__(self, ttl: float, max_stale: float, timeout: float):
+        self.ttl = ttl
+        self.max_stale = max_stale
+        self.timeout = timeout
+        self._entries = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "revalidated": 0, "fetched": 0, "stale-served": 0}
+
+    def _name_lock(self, name: str) -> threading.Lock:
+        with self._lock:
+            return self._locks.setdefault(name, threading.Lock())
+
+    def get(self, name: str) -> RepoAssistantDataModel:
+        """
+        Returns (a copy of) the configuration of the assistant.
+
+        Raises:
+            HTTPException: 404 when the configuration service does not know the assistant, 502 when it cannot be
+            reached (or fails) and there is no usable cached entry.
+        """
+        entry = self._entries.get(name)
+        if entry and entry.age() < self.ttl:
+            self.stats["hits"] += 1
+            return entry.model.model_copy(deep=True)
+        # One request per assistant at a time, the other callers get its result.
+        with self._name_lock(name):
+            entry = self._entries.get(name)
+            if not entry or entry.age() >= self.ttl:
+                entry = self._refresh(name, entry)
+        return entry.model.model_copy(deep=True)
+
+    def _refresh(self, name: str, entry: _Entry | None) -> _Entry:
+        repo_url = f'{settings.ASSISTANT_CONFIG_URL}/{name}'
+        headers = dict(assistant_repo_headers)
+        if entry and entry.etag:
+            headers['If-None-Match'] = entry.etag
+        try:
+            rsp = requests.get(repo_url, headers=headers, timeout=self.timeout)
+        except requests.RequestException as e:
+            return self._stale(name, entry, f'{repo_url} unreachable: {e}')
+
+        if rsp.status_code == 304 and entry:
+            entry.validated_at = time.monotonic()
+            self.stats["revalidated"] += 1
+            return entry
+        if rsp.status_code == 404:
+            self._entries.pop(name, None)
+            raise HTTPException(status_code=404, detail=f"{repo_url} not found")
+        if rsp.status_code != 200:
+            return self._stale(name, entry, f'{repo_url} returned {rsp.status_code}')
+
+        logger(f'Retrieved targets configuration from {repo_url}', LOG_LEVEL_DEBUG, LOG_NAME_PS)
+        # The service returns the configuration as a JSON encoded string.
+        entry = _Entry(RepoAssistantDataModel.model_validate_json(rsp.json()), rsp.headers.get('ETag'))
+        self._entries[name] = entry
+        self.stats["fetched"] += 1
+        return entry
+
+    def _stale(self, name: str, entry: _Entry | None, reason: str) -> _Entry:
+        if entry and entry.age() < self.ttl + self.max_stale:
+            logger(f'{reason}, serving the configuration of {name} cached {round(entry.age())} seconds ago',
+                   'warning', LOG_NAME_PS)
+            self.stats["stale-served"] += 1
+            return entry
+        logger(reason, 'error', LOG_NAME_PS)
+        raise HTTPException(status_code=502, detail=reason)
+
+    def warm(self, names: [str]) -> type(None):
+        """Fetches the configurations of the assistants, failures are logged only."""
+        for name in names:
+            try:
+                self.get(name)
+            except HTTPException as e:
+                logger(f'Unable to warm the configuration of {name}: {e.detail}', 'warning', LOG_NAME_PS)
+
+    def invalidate(self, name: str = None) -> type(None):
+        if name:
+            self._entries.pop(name, None)
+        else:
+            self._entries.clear()
+
+
+assistant_configs = AssistantConfigCache(ttl=settings.get("ASSISTANT_CONFIG_TTL", 300),
+                                         max_stale=settings.get("ASSISTANT_CONFIG_MAX_STALE", 86400),
+                                         timeout=settings.get("ASSISTANT_CONFIG_TIMEOUT", 10))
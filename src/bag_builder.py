@@ -0,0 +1,188 @@
+"""
+BagIt (RFC 8493) package builder.
+
+A bag is built for a dataset in ``DATA_TMP_BASE_DIR/bags/<dataset_id>`` from its ``DataFile`` rows and generated
+files. Payload files are hardlinked into ``data/`` instead of copied (copied only when the bag lives on another file
+system). All manifest algorithms of a file are computed in one streaming read, on the shared ``bagit`` process pool,
+and a checksum already stored in ``DataFile`` is reused instead of recomputed. A finished bag can be written to or
+streamed as a zip or tar archive. As the payload is hardlinked, a bag keeps the disk space of the uploads in use until
+it is removed: after its zip is delivered, or by the orphan collector once its dataset is finished or deleted.
+"""
+import errno
+import hashlib
+import os
+import shutil
+import tarfile
+import time
+import zlib
+from datetime import datetime
+
+from src import settings_snapshot
+from src.commons import settings, logger, LOG_LEVEL_DEBUG, LOG_NAME_PS
+from src.dbz import DataFile
+from src.process_pool import process_pool
+from src.tracing import tracer
+from src.zipstream import ZipStreamEncoder, ParallelZipCompressor, STORED
+
+BAGIT_VERSION = '1.0'
+HASH_BUFFER_SIZE = 8 * 1024 * 1024
+STREAM_CHUNK_SIZE = 8 * 1024 * 1024
+
+
+def hash_file(path: str, algorithms: [str]) -> dict:
+    """Computes all the given hashlib algorithms of a file in a single read."""
+    hashes = {alg: hashlib.new(alg) for alg in algorithms}
+    with open(path, 'rb') as f:
+        while chunk := f.read(HASH_BUFFER_SIZE):
+            for h in hashes.values():
+                h.update(chunk)
+    return {alg: h.hexdigest() for alg, h in hashes.items()}
+
+
+def _encode_path(path: str) -> str:
+    # Percent-encode CR and LF in manifest file paths, the same way the bagit library (used to validate) does.
+    return path.replace('\r', '%0D').replace('\n', '%0A')
+
+
+class BagBuilder:
+    def __init__(self, dataset_id: str, algorithms: [str] = None, bags_dir: str = None):
+        self.dataset_id = dataset_id
+        self.algorithms = algorithms if algorithms else list(settings_snapshot.current.BAGIT_CHECKSUM_ALGORITHMS)
+        self.bag_dir = os.path.join(bags_dir if bags_dir else os.path.join(settings.DATA_TMP_BASE_DIR, 'bags'),
+                                    dataset_id)
+
+    def build(self, data_files: [DataFile], tag_files: dict = None, bag_info: dict = None) -> str:
+        """
+        Builds the bag and returns its directory.
+
+        Args:
+            data_files: The payload, placed in data/ under their name.
+            tag_files: Optional {relative path: content} of extra tag files, e.g. {'metadata/dc.xml': '...'}.
+            bag_info: Optional extra bag-info.txt fields.
+        """
+        start = time.perf_counter()
+        if os.path.exists(self.bag_dir):
+            shutil.rmtree(self.bag_dir)
+        os.makedirs(os.path.join(self.bag_dir, 'data'))
+
+        payload = {}
+        for df in data_files:
+            payload[os.path.join('data', df.name)] = df
+            self._link(os.path.realpath(df.path), os.path.join(self.bag_dir, 'data', df.name))
+
+        with tracer.start_as_current_span('bag checksums', attributes={"ps.bag.files": len(payload)}):
+            manifests = self._payload_checksums(payload)
+        for alg in self.algorithms:
+            self._write_tag(f'manifest-{alg}.txt', ''.join(f'{manifests[p][alg]}  {_encode_path(p)}\n'
+                                                           for p in sorted(manifests)))
+
+        octets = sum(os.path.getsize(os.path.join(self.bag_dir, p)) for p in payload)
+        self._write_tag('bagit.txt', f'BagIt-Version: {BAGIT_VERSION}\nTag-File-Character-Encoding: UTF-8\n')
+        info = {"Bagging-Date": datetime.utcnow().strftime('%Y-%m-%d'), "Bag-Software-Agent": "packaging-service",
+                "External-Identifier": self.dataset_id, "Payload-Oxum": f'{octets}.{len(payload)}'}
+        info.update(bag_info if bag_info else {})
+        self._write_tag('bag-info.txt', ''.join(f'{k}: {v}\n' for k, v in info.items()))
+        for name, content in (tag_files if tag_files else {}).items():
+            self._write_tag(name, content)
+
+        tag_paths = sorted(os.path.relpath(os.path.join(root, name), self.bag_dir)
+                           for root, _, names in os.walk(self.bag_dir) for name in names
+                           if not name.startswith('tagmanifest-'))
+        tag_paths = [p for p in tag_paths if not p.startswith(f'data{os.sep}')]
+        for alg in self.algorithms:
+            self._write_tag(f'tagmanifest-{alg}.txt', ''.join(
+                f'{hash_file(os.path.join(self.bag_dir, p), [alg])[alg]}  {_encode_path(p)}\n' for p in tag_paths))
+
+        logger(f'Bag of {self.dataset_id} with {len(payload)} files ({octets} bytes) built in '
+               f'{round(time.perf_counter() - start, 2)} seconds', LOG_LEVEL_DEBUG, LOG_NAME_PS)
+        return self.bag_dir
+
+    def remove(self) -> type(None):
+        """Removes the bag directory, e.g. once the bag is delivered as a zip."""
+        if os.path.exists(self.bag_dir):
+            shutil.rmtree(self.bag_dir)
+            logger(f'Bag directory {self.bag_dir} removed', LOG_LEVEL_DEBUG, LOG_NAME_PS)
+
+    def _link(self, source: str, destination: str) -> type(None):
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+        try:
+            os.link(source, destination)
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                raise
+            logger(f'Unable to hardlink {source} ({e}), copying it', LOG_LEVEL_DEBUG, LOG_NAME_PS)
+            shutil.copy2(source, destination)
+
+    def _payload_checksums(self, payload: {str: DataFile}) -> dict:
+        checksums = {}
+        todo = {}
+        for path, df in payload.items():
+            known = {'md5': df.checksum_value} if df.checksum_value and 'md5' in self.algorithms else {}
+            missing = [alg for alg in self.algorithms if alg not in known]
+            checksums[path] = known
+            if missing:
+                todo[path] = missing
+        if todo:
+            pool = process_pool('bagit', settings_snapshot.current.BAGIT_HASH_WORKERS or None)
+            futures = {path: pool.submit(hash_file, os.path.join(self.bag_dir, path), algs)
+                       for path, algs in todo.items()}
+            for path, future in futures.items():
+                checksums[path].update(future.result())
+        logger(f'Bag checksums: {len(payload) - len(todo)} of {len(payload)} files reused stored checksums',
+               LOG_LEVEL_DEBUG, LOG_NAME_PS)
+        return checksums
+
+    def _write_tag(self, name: str, content: str) -> type(None):
+        path = os.path.join(self.bag_dir, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(content)
+
+    def _files(self) -> [(str, str)]:
+        # (absolute path, archive name) of all bag files, the bag directory name is the archive root.
+        root_name = os.path.basename(self.bag_dir)
+        return [(os.path.join(root, name), os.path.join(root_name, os.path.relpath(os.path.join(root, name),
+                                                                                   self.bag_dir)))
+                for root, _, names in sorted(os.walk(self.bag_dir)) for name in sorted(names)]
+
+    def write_zip(self, zip_path: str, compression_level: int = None) -> str:
+        """Writes the bag as a zip archive, deflating on all cores (see zipstream.ParallelZipCompressor)."""
+        compressor = ParallelZipCompressor(
+            level=compression_level if compression_level is not None else settings_snapshot.current.ZIP_COMPRESSION_LEVEL,
+            workers=settings_snapshot.current.ZIP_COMPRESSION_WORKERS or None)
+        with tracer.start_as_current_span('bag zip', attributes={"ps.dataset_id": self.dataset_id}), \
+                open(zip_path, 'wb') as out:
+            compressor.write(out, ((arcname, open(path, 'rb'), os.path.getmtime(path))
+                                   for path, arcname in self._files()))
+        return zip_path
+
+    def stream(self, archive_format: str = 'zip'):
+        """Yields the bag as a zip (stored entries) or tar archive, without writing the archive to disk."""
+        return self._stream_tar() if archive_format == 'tar' else self._stream_zip()
+
+    def _stream_zip(self):
+        encoder = ZipStreamEncoder()
+        for path, arcname in self._files():
+            stat = os.stat(path)
+            yield encoder.start_entry(arcname, STORED, stat.st_mtime, stat.st_mode & 0o777)
+            crc, size = 0, 0
+            with open(path, 'rb') as f:
+                while chunk := f.read(STREAM_CHUNK_SIZE):
+                    crc = zlib.crc32(chunk, crc)
+                    size += len(chunk)
+                    yield chunk
+            yield encoder.end_entry(crc, size, size)
+        yield encoder.finish()
+
+    def _stream_tar(self):
+        for path, arcname in self._files():
+            stat = os.stat(path)
+            info = tarfile.TarInfo(arcname)
+            info.size, info.mtime, info.mode = stat.st_size, int(stat.st_mtime), stat.st_mode & 0o777
+            yield info.tobuf(format=tarfile.PAX_FORMAT)
+            with open(path, 'rb') as f:
+                while chunk := f.read(STREAM_CHUNK_SIZE):
+                    yield chunk
+            if stat.st_size % tarfile.BLOCKSIZE:
+                yield tarfile.NUL * (tarfile.BLOCKSIZE - stat.st_size % tarfile.BLOCKSIZE)
+        yield tarfile.NUL * tarfile.BLOCKSIZE * 2
@@ -2,12 +2,13 @@ from __future__ import annotations
 
 import os
 from abc import ABC, abstractmethod
-from dataclasses import dataclass, field
+from dataclasses import dataclass, field, InitVar
 
 from src.commons import settings, db_manager, logger, LOG_LEVEL_DEBUG
-from src.dbz import TargetRepo, DepositStatus, DatabaseManager, Dataset, DataFile
+from src.dbz import TargetRepo, DepositStatus, DatabaseManager, Dataset, DataFile, DepositCheckpoint
 from src.models.assistant_datamodel import Target
-from src.models.bridge_output_model import BridgeOutputDataModel
+from src.models.bridge_output_model import BridgeOutputDataModel, TargetResponse
+from src.poll_scheduler import poll_scheduler
 
 
 @dataclass(frozen=True, kw_only=True, slots=True)
@@ -23,12 +24,19 @@ class Bridge(ABC):
         app_name (str): Name of the application associated with the dataset.
         data_file_rec (DataFile): Record representing the data file associated with the dataset.
         dataset_dir (str): Directory path for the dataset.
+        new_deposit (bool): Whether the deposit starts, its state is then saved as PROGRESS. False for a bridge
+            that completes a submitted deposit.
 
     Methods:
         __post_init__(): Initializes the Bridge object after its creation.
         deposit() -> BridgeOutputModel: Abstract method to deposit data into the target repository.
         save_state(bridge_output_model: BridgeOutputModel = None) -> type(None): Saves the state of the deposit
         process, updating the deposit status in the database.
+        load_checkpoints() / save_checkpoint(key, **values): The steps of an earlier attempt of the deposit that
+        completed, so a resubmitted deposit skips them.
+        submit(...) -> BridgeOutputModel: Marks the deposit as awaiting its completion by the target repository.
+        complete(submitted: BridgeOutputModel, payload) -> BridgeOutputModel: The output of a submitted deposit,
+        from the callback of the repository or the status found by the safety net poll.
 
     Note:
         This class is expected to be subclassed with a concrete implementation of the `deposit` method.
@@ -41,8 +49,9 @@ class Bridge(ABC):
     app_name: str = field(init=False)
     data_file_rec: DataFile = field(init=False)
     dataset_dir: str = field(init=False)
+    new_deposit: InitVar[bool] = True
 
-    def __post_init__(self):
+    def __post_init__(self, new_deposit: bool = True):
         """
         Initializes the Bridge object after its creation.
 
@@ -59,7 +68,8 @@ class Bridge(ABC):
         object.__setattr__(self, 'data_file_rec', self.db_manager.find_files(self.dataset_id))
         object.__setattr__(self, 'dataset_dir', os.path.join(settings.DATA_TMP_BASE_DIR,
                                                              self.app_name, self.dataset_id))
-        self.save_state()
+        if new_deposit:
+            self.save_state()
 
     @classmethod
     @abstractmethod
@@ -93,5 +103,62 @@ class Bridge(ABC):
                                                                 deposit_status=deposit_status, target_output=output,
                                                                 duration=duration))
 
+    def load_checkpoints(self) -> {str: DepositCheckpoint}:
+        """Returns the checkpoints of the deposit to this target, by key (DATASET_CHECKPOINT or a file name)."""
+        return db_manager.find_checkpoints(self.dataset_id, self.target.repo_name)
+
+    def save_checkpoint(self, key: str, **values) -> type(None):
+        """Records a completed step, e.g. save_checkpoint(file.name, remote_id=..., checksum=...)."""
+        db_manager.save_checkpoint(DepositCheckpoint(ds_id=self.dataset_id, target_name=self.target.repo_name,
+                                                     key=key, **values))
+
+    def delete_checkpoints(self) -> type(None):
+        """Forgets the earlier attempts, e.g. when the remote dataset is gone."""
+        db_manager.delete_checkpoints(self.dataset_id, self.target.repo_name)
+
+    @property
+    def callback_url(self) -> str:
+        """The URL the target repository calls (POST, json) when a submitted deposit completes."""
+        return f'{settings.get("CALLBACK_BASE_URL", settings.TUS_BASE_URL)}/inbox/callback/{self.dataset_id}/' \
+               f'{self.target.repo_name}'
+
+    def submit(self, output_data_model: BridgeOutputDataModel, poll_url: str = None, parser: str = None,
+               predicate: str = None, headers: dict = None, auth: (str, str) = None, interval: float = 30,
+               max_attempts: int = 25, first_delay: float = 0, callback: bool = False) -> BridgeOutputDataModel:
+        """
+        Marks the deposit as submitted: the bridge thread is released and the deposit is finalized, and the next
+        targets deposited, when ``callback_url`` is called or the poll of poll_url completes. ``complete`` makes the
+        output of the callback payload or of the value of the parser.
+
+        The status is polled (see ``poll_scheduler``) every interval seconds, the first check after first_delay.
+        With callback, the repository was given ``callback_url``: the poll is only the safety net for a lost
+        callback, SUBMITTED_POLL_FACTOR times less often and the first check after one such interval.
+
+        Returns:
+            BridgeOutputDataModel: The submitted output, to return from ``deposit``.
+        """
+        output_data_model.deposit_status = DepositStatus.SUBMITTED
+        if not output_data_model.response:
+            output_data_model.response = TargetResponse()
+        # Saved before the callback can arrive, it only completes a SUBMITTED target.
+        self.save_state(output_data_model)
+        logger(f'Deposit to {self.target.repo_name} submitted, awaiting '
+               f'{self.callback_url if callback else poll_url}', LOG_LEVEL_DEBUG, self.app_name)
+        if poll_url:
+            if callback:
+                interval *= settings.get("SUBMITTED_POLL_FACTOR", 4)
+                first_delay = interval
+            poll_scheduler.register(self.dataset_id, self.target.repo_name, poll_url, parser, predicate,
+                                    headers=headers, auth=auth, on_complete='src.protected.complete_polled_target',
+                                    interval=interval, max_attempts=max_attempts, first_delay=first_delay, wait=False)
+        return output_data_model
+
+    def complete(self, submitted: BridgeOutputDataModel, payload) -> BridgeOutputDataModel:
+        """
+        Returns the output of the submitted deposit. By default the payload is the output itself
+        (a BridgeOutputDataModel as json).
+        """
+        return BridgeOutputDataModel.model_validate(payload)
+
     def deposit_files(self):
         pass
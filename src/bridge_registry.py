@@ -0,0 +1,206 @@
+"""
+Registry of the bridge classes.
+
+Bridges come from two sources:
+
+- the modules in ``MODULES_DIR``, whose subclasses of ``Bridge`` are found with ``inspect_bridge_module``;
+- the ``packaging_service.bridges`` entry points of the installed distributions (``<name> = "<module>:<class>"``),
+  a bridge in ``MODULES_DIR`` with the same name takes precedence.
+
+The bridges found in the module files are kept in a manifest (``BRIDGE_MANIFEST_PATH``) by file path, modification
+time and size, so a worker that starts while no module changed does not parse any source. A bridge module is only
+imported at the first lookup of one of its classes, after that resolving the bridge of a target is a dict lookup.
+
+A module is inspected again when its file changes: right away in the worker that registers it, and in the other
+workers by a watcher thread that compares the modification times of the files every
+``BRIDGE_MODULES_POLL_INTERVAL`` seconds, or at the first lookup of a bridge name they do not know yet. An imported
+module is reloaded; when that fails, the failure is logged and its previous classes are kept.
+"""
+import importlib
+import importlib.metadata
+import importlib.util
+import json
+import os
+import sys
+import threading
+
+from src.commons import settings, logger, inspect_bridge_module, LOG_LEVEL_DEBUG, LOG_NAME_PS
+
+ENTRY_POINT_GROUP = 'packaging_service.bridges'
+
+
+def _split(qualified_name: str) -> (str, str):
+    module_name, _, class_name = qualified_name.rpartition('.')
+    return module_name, class_name
+
+
+class BridgeRegistry:
+    def __init__(self, modules_dir: str, manifest_path: str):
+        self.modules_dir = modules_dir
+        self.manifest_path = manifest_path
+        self._bridges = {}
+        self._classes = {}
+        self._modules = {}
+        self._entry_points = None
+        self._lock = threading.RLock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def get(self, name: str) -> type:
+        """
+        Returns the bridge class, its module is imported at the first lookup.
+
+        Raises:
+            KeyError: When no module or entry point defines the bridge.
+            Exception: What importing the module raises.
+        """
+        cls = self._classes.get(name)
+        if cls is None:
+            qualified_name = self.qualified_name(name)
+            with self._lock:
+                module_name, class_name = _split(qualified_name)
+                cls = self._classes[name] = getattr(importlib.import_module(module_name), class_name)
+        return cls
+
+    def qualified_name(self, name: str) -> str:
+        """Returns the fully qualified name of the bridge class, e.g. src.modules.filesystem_depositor.FileSystem."""
+        qualified_name = self._bridges.get(name)
+        if qualified_name is None:
+            # Registered in another worker and not seen by the watcher yet.
+            self.scan()
+            qualified_name = self._bridges[name]
+        return qualified_name
+
+    def __contains__(self, name: str) -> bool:
+        try:
+            self.qualified_name(name)
+        except KeyError:
+            return False
+        return True
+
+    def names(self) -> [str]:
+        return sorted(self._bridges)
+
+    def _discover_entry_points(self) -> dict:
+        if self._entry_points is None:
+            self._entry_points = {ep.name: ep.value.replace(':', '.')
+                                  for ep in importlib.metadata.entry_points(group=ENTRY_POINT_GROUP)}
+            if self._entry_points:
+                logger(f'Bridges of entry points: {self._entry_points}', LOG_LEVEL_DEBUG, LOG_NAME_PS)
+        return self._entry_points
+
+    def _read_manifest(self) -> dict:
+        try:
+            with open(self.manifest_path) as f:
+                return {path: (tuple(entry["version"]), entry["bridges"]) for path, entry in json.load(f).items()}
+        except (OSError, ValueError, KeyError, TypeError):
+            return {}
+
+    def _write_manifest(self) -> type(None):
+        manifest = {path: {"version": list(version), "bridges": bridges}
+                    for path, (version, bridges) in self._modules.items()}
+        tmp_path = f'{self.manifest_path}.{os.getpid()}.tmp'
+        try:
+            os.makedirs(os.path.dirname(self.manifest_path), exist_ok=True)
+            with open(tmp_path, 'w') as f:
+                json.dump(manifest, f)
+            os.replace(tmp_path, self.manifest_path)
+        except OSError as e:
+            logger(f'Unable to write the bridge manifest {self.manifest_path}: {e}', 'warning', LOG_NAME_PS)
+
+    def scan(self) -> [str]:
+        """
+        Inspects the new and changed modules and drops the bridges of removed ones.
+
+        Returns:
+            [str]: The names of the bridges of the changed modules.
+        """
+        changed = []
+        with self._lock:
+            files = {}
+            for filename in os.listdir(self.modules_dir):
+                if filename.endswith(".py") and not filename.startswith('__'):
+                    path = os.path.join(self.modules_dir, filename)
+                    stat = os.stat(path)
+                    files[path] = (stat.st_mtime_ns, stat.st_size)
+
+            manifest = self._read_manifest() if not self._modules else {}
+            modules = {}
+            for path, version in files.items():
+                known = self._modules.get(path) or manifest.get(path)
+                if known and known[0] == version:
+                    modules[path] = known
+                    continue
+                modules[path] = (version, self._inspect(path, known[1] if known else {}))
+                changed += modules[path][1]
+
+            if modules != self._modules:
+                removed = set(self._modules) - set(modules)
+                if removed:
+                    logger(f'Bridge modules removed: {sorted(removed)}', LOG_LEVEL_DEBUG, LOG_NAME_PS)
+                self._modules = modules
+                if manifest != modules:
+                    self._write_manifest()
+            self._bridges = dict(self._discover_entry_points())
+            for _, bridges in self._modules.values():
+                self._bridges.update(bridges)
+            self._classes = {name: cls for name, cls in self._classes.items() if name in self._bridges}
+            for module_name in {_split(self._bridges[name])[0] for name in changed}:
+                self._reload(module_name)
+        return changed
+
+    def _inspect(self, path: str, previous: dict) -> dict:
+        try:
+            bridges = {name: qualified_name for found in inspect_bridge_module(path)
+                       for name, qualified_name in found.items()}
+        except (OSError, SyntaxError, ValueError) as e:
+            # Not retried until the file changes again.
+            logger(f'Unable to inspect the bridge module {path}: {type(e).__name__}: {e}', 'error', LOG_NAME_PS)
+            return previous
+        logger(f'Bridge module {path} inspected: {list(bridges)}', LOG_LEVEL_DEBUG, LOG_NAME_PS)
+        return bridges
+
+    def _reload(self, module_name: str) -> type(None):
+        # Only a module that is in use is imported again, the others are imported at the first lookup.
+        module = sys.modules.get(module_name)
+        if not module:
+            importlib.invalidate_caches()
+            return
+        try:
+            if getattr(module, '__file__', None):
+                # The cached bytecode only records the mtime in seconds, a quick rewrite could reuse it.
+                try:
+                    os.remove(importlib.util.cache_from_source(module.__file__))
+                except OSError:
+                    pass
+            module = importlib.reload(module)
+            for name, qualified_name in self._bridges.items():
+                if _split(qualified_name)[0] == module_name:
+                    self._classes[name] = getattr(module, _split(qualified_name)[1])
+        except Exception as e:
+            logger(f'Unable to reload the bridge module {module_name}: {type(e).__name__}: {e}', 'error',
+                   LOG_NAME_PS)
+
+    def _watch(self, interval: float) -> type(None):
+        while not self._stop.wait(interval):
+            try:
+                self.scan()
+            except Exception as e:
+                logger(f'Bridge module watcher failed: {e}', 'error', LOG_NAME_PS)
+
+    def start_watcher(self) -> type(None):
+        interval = settings.get("BRIDGE_MODULES_POLL_INTERVAL", 5)
+        if interval <= 0 or (self._thread and self._thread.is_alive()):
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._watch, args=(interval,), name='bridge-module-watcher',
+                                        daemon=True)
+        self._thread.start()
+
+    def stop_watcher(self) -> type(None):
+        self._stop.set()
+
+
+bridge_registry = BridgeRegistry(settings.MODULES_DIR,
+                                 settings.get("BRIDGE_MANIFEST_PATH",
+                                              os.path.join(settings.DATA_TMP_BASE_DIR, 'bridge-manifest.json')))
@@ -14,9 +14,7 @@ from datetime import datetime
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from functools import wraps
-from logging.handlers import TimedRotatingFileHandler
 from typing import Any, Callable
-from requests_toolbelt.multipart.encoder import MultipartEncoder, MultipartEncoderMonitor
 
 import requests
 from dynaconf import Dynaconf
@@ -25,6 +23,11 @@ from starlette import status
 
 from src.dbz import DatabaseManager, DepositStatus
 from src.models.bridge_output_model import BridgeOutputDataModel, TargetResponse
+from src.metrics import instrument_engine, TRANSFORM_SECONDS
+from src.tracing import tracer, trace_engine
+from src.log_pipeline import start_logging
+from src.zipstream import ParallelZipCompressor
+from src import settings_snapshot
 
 LOG_NAME_PS = 'ps'
 LOG_LEVEL_DEBUG = 'debug'
@@ -33,10 +36,13 @@ conf_path = os.getenv("BASE_DIR") if os.getenv("BASE_DIR") is not None else os.g
 
 settings = Dynaconf(root_path=f'{os.getenv("BASE_DIR", os.getcwd())}/conf', settings_files=["*.toml"],
                     environments=True)
+# Fails at boot when a setting of the snapshot is missing or wrong.
+settings_snapshot.rebuild(settings)
 
-data = {}
-
-db_manager = DatabaseManager(db_dialect=settings.DB_DIALECT, db_url=settings.DB_URL, encryption_key='Jum@t#10&h@yy1hdr@M%12@maL2004In')
+db_manager = DatabaseManager(db_dialect=settings.DB_DIALECT, db_url=settings.DB_URL, encryption_key='Jum@t#10&h@yy1hdr@M%12@maL2004In',
+                             busy_timeout=settings.get("DB_BUSY_TIMEOUT", 30000))
+instrument_engine(db_manager.engine)
+trace_engine(db_manager.engine)
 
 transformer_headers = {
     'Content-Type': 'application/json',
@@ -53,43 +59,36 @@ def setup_logger():
     """
     This function sets up the logger for the application.
 
-    It iterates over the list of loggers specified in the settings, and for each logger, it:
-    - Gets or creates a logger with the specified name.
-    - Creates a formatter with the specified format.
-    - Creates a file handler that writes to the specified log file in append mode, and sets its formatter.
-    - Creates a stream handler (which writes to stdout by default) and sets its formatter.
-    - Creates a timed rotating file handler that rotates the log file every 8 hours and keeps the last 10 log files, and adds it to the logger.
-    - Sets the log level of the logger.
-    - Adds the file handler and the stream handler to the logger.
-    - Logs a startup message at the debug level, which includes the current time and the Python version.
-
-    The logger settings (name, format, log file, and log level) are read from the `LOGGERS` setting in the application's configuration.
+    The loggers specified in the `LOGGERS` setting (name, format, log file and log level) put their records on one
+    queue, a single writer thread writes them to a log file that rotates every 8 hours (keeping the last 10) and to
+    stdout, see `log_pipeline.start_logging`. `LOG_JSON` writes the records as JSON lines and
+    `LOG_PROGRESS_INTERVAL` samples the progress lines.
 
-    The startup message is logged using the `logger` function defined elsewhere in this module.
+    A startup message, which includes the current time and the Python version, is logged at the debug level.
     """
     now = datetime.utcnow()
-    for log in settings.LOGGERS:
-        log_setup = logging.getLogger(log.get('name'))
-        formatter = logging.Formatter(log.get('log_format'))
-        file_handler = logging.FileHandler(log.get('log_file'), mode='a')
-        file_handler.setFormatter(formatter)
-        stream_handler = logging.StreamHandler()
-        stream_handler.setFormatter(formatter)
-        rotating_handler = TimedRotatingFileHandler(log.get('log_file'), when="H", interval=8, backupCount=10)
-        log_setup.addHandler(rotating_handler)
-        log_setup.setLevel(log.get('log_level'))
-        log_setup.addHandler(file_handler)
-        log_setup.addHandler(stream_handler)
-        logger(f"Start {log.get('name')} at {now} Pyton version: {platform.python_version()}",
-               'debug', log.get('name'))
-
-
-def logger(msg, level, logfile):
+    snapshot = settings_snapshot.current
+    start_logging([log.model_dump() for log in snapshot.LOGGERS], json_records=snapshot.LOG_JSON,
+                  progress_interval=snapshot.LOG_PROGRESS_INTERVAL)
+    for log in snapshot.LOGGERS:
+        logger("Start %s at %s Pyton version: %s", 'debug', log.name, log.name, now, platform.python_version())
+
+
+LOG_LEVELS = {'debug': logging.DEBUG, 'info': logging.INFO, 'warning': logging.WARNING, 'error': logging.ERROR}
+
+
+def logger(msg, level, logfile, *args, progress: str = None):
+    """
+    Logs msg to the logger named logfile.
+
+    The message is %-formatted with args only when the level is enabled, so hot paths should pass their arguments
+    instead of an f-string. Progress lines pass a key as progress, they are sampled per key.
+    """
     log = logging.getLogger(logfile)
-    if level == 'info': log.info(msg)
-    if level == 'warning': log.warning(msg)
-    if level == 'error': log.error(msg)
-    if level == 'debug': log.debug(msg)
+    levelno = LOG_LEVELS.get(level)
+    if levelno is None or not log.isEnabledFor(levelno):
+        return
+    log.log(levelno, msg, *args, extra={'progress': progress} if progress else None)
 
 
 def get_class(kls) -> Any:
@@ -127,7 +126,12 @@ def transform(transformer_url: str, str_tobe_transformed: str) -> str:
     if type(str_tobe_transformed) is not str:
         raise ValueError(f"Error - str_tobe_transformed is not a string. It is : {type(str_tobe_transformed)}")
 
-    transformer_response = requests.post(transformer_url, headers=transformer_headers, data=str_tobe_transformed)
+    transformer = transformer_url.rstrip('/').split('/')[-1]
+    with tracer.start_as_current_span('transform', attributes={"ps.transformer": transformer,
+                                                               "ps.transform.input_bytes": len(str_tobe_transformed)}
+                                      ) as span, TRANSFORM_SECONDS.labels(transformer).time():
+        transformer_response = requests.post(transformer_url, headers=transformer_headers, data=str_tobe_transformed)
+        span.set_attribute("http.status_code", transformer_response.status_code)
     if transformer_response.status_code == 200:
         transformed_metadata = transformer_response.json()
         str_transformed_metadata = transformed_metadata.get('result')
@@ -297,7 +301,8 @@ def inspect_bridge_module(py_file_path: str):
     This function inspects a Python module and returns a list of classes that inherit from the 'Bridge' class.
 
     It opens the Python file at the given path and parses it into an AST (Abstract Syntax Tree) using the `ast.parse` function.
-    It then iterates over the nodes in the AST, and for each class definition, it checks if it inherits from the 'Bridge' class.
+    It then iterates over the nodes in the AST, and for each class definition, it checks if it inherits from the 'Bridge' class,
+    as `Bridge` or `<module>.Bridge`, or from a bridge class defined earlier in the same module.
     If it does, it constructs the fully qualified name of the class and adds it to the results list.
 
     The fully qualified name of a class is constructed by replacing the base directory path in the file path with an empty string,
@@ -314,9 +319,12 @@ def inspect_bridge_module(py_file_path: str):
     with open(py_file_path, 'r') as f:
         bridge_mdl = ast.parse(f.read())
     results = []
+    bridge_names = {'Bridge'}
     for node in bridge_mdl.body:
         if isinstance(node, ast.ClassDef) and any(
-                isinstance(base, ast.Name) and base.id == 'Bridge' for base in node.bases):
+                (isinstance(base, ast.Name) and base.id in bridge_names) or
+                (isinstance(base, ast.Attribute) and base.attr == 'Bridge') for base in node.bases):
+            bridge_names.add(node.name)
             module_name = py_file_path.replace(f'{os.getenv("BASE_DIR", os.getcwd())}/', '').replace('/', '.')
             name_of_bridge_subclass = f"{module_name[:-3]}.{node.name}"
             results.append({node.name: name_of_bridge_subclass})
@@ -355,14 +363,22 @@ def send_mail(subject: str, text: str):
 
 
 def dmz_dataverse_headers(username, password) -> dict:
-    headers = {'X-Authorization': settings.dmz_x_authorization_value} if settings.exists("dmz_x_authorization_value",
-                                                                                         fresh=False) else {}
+    dmz_x_authorization_value = settings_snapshot.current.DMZ_X_AUTHORIZATION_VALUE
+    headers = {'X-Authorization': dmz_x_authorization_value} if dmz_x_authorization_value is not None else {}
     if username == 'API_KEY':
         headers["X-Dataverse-key"] = password
     return headers
 
 
-def upload_large_file(url, file_path, json_data, api_key, file_name=None):
+def upload_large_file(url, file_path, json_data, api_key, file_name=None, fileobj=None, timeout=None):
+    """
+    Uploads a file as a streamed multipart body, logging the progress every 5%.
+
+    Instead of the file at file_path, any readable file object with a length (e.g. a zipstream.StoredZipStream)
+    can be given as fileobj.
+    """
+    from requests_toolbelt.multipart.encoder import MultipartEncoder, MultipartEncoderMonitor
+
     def create_callback(encoder):
         encoder_len = encoder.len
         last_reported_progress = -5  # Initialize to -5 so it prints at 0%
@@ -373,22 +389,22 @@ def upload_large_file(url, file_path, json_data, api_key, file_name=None):
             if progress >= last_reported_progress + 5 or progress > 95:
                 memory_usage_msg = f", Memory usage: {psutil.Process().memory_info().rss / (1024 * 1024):.2f} MB" \
                     if progress >= last_reported_progress + 5 else ""
-                logger(f"Upload Progress: {progress:.2f}%{memory_usage_msg}", LOG_LEVEL_DEBUG, LOG_NAME_PS)
+                logger("Upload Progress: %.2f%%%s", LOG_LEVEL_DEBUG, LOG_NAME_PS, progress, memory_usage_msg,
+                       progress=file_path)
                 last_reported_progress = progress if progress >= last_reported_progress + 5 else last_reported_progress
 
         return callback
 
-    with open(file_path, 'rb') as f:
+    with open(file_path, 'rb') if fileobj is None else fileobj as f:
         encoder = MultipartEncoder(
             fields={'file': (file_name if file_name else os.path.basename(file_path), f, 'application/octet-stream'),
                     'jsonData': (None, json_data['jsonData'])}
         )
         callback = create_callback(encoder)
         monitor = MultipartEncoderMonitor(encoder, callback)
-        logger(f'upload_large_file  api_key: {api_key}', LOG_LEVEL_DEBUG, LOG_NAME_PS)
-        response = requests.post(url, data=monitor, headers={"X-Dataverse-key": api_key,
-                                                             'X-Authorization': settings.dmz_x_authorization_value,
-                                                             'Content-Type': monitor.content_type})
+        headers = dmz_dataverse_headers('API_KEY', api_key)
+        headers['Content-Type'] = monitor.content_type
+        response = requests.post(url, data=monitor, headers=headers, timeout=timeout)
 
         logger(f'upload_large_file response: {response.status_code}', LOG_LEVEL_DEBUG, LOG_NAME_PS)
         if response.status_code == status.HTTP_502_BAD_GATEWAY:
@@ -397,42 +413,47 @@ def upload_large_file(url, file_path, json_data, api_key, file_name=None):
     return response
 
 
-def zip_with_progress(file_path, zip_path):
-    # Resolve the file_path if it's a symlink
-    if os.path.islink(file_path):
-        real_file_path = os.readlink(file_path)
-        print(f"'{file_path}' is a symlink, including the real file '{real_file_path}'.")
-    else:
-        real_file_path = file_path
+# Formats that are compressed already. Deflating them again costs CPU time for (almost) no gain in size.
+COMPRESSED_FILE_EXTENSIONS = ('.zip', '.gz', '.tgz', '.bz2', '.xz', '.7z', '.rar', '.zst', '.jar', '.docx', '.xlsx',
+                              '.pptx', '.odt', '.ods', '.epub', '.jpg', '.jpeg', '.png', '.gif', '.webp', '.heic',
+                              '.mp3', '.m4a', '.ogg', '.flac', '.mp4', '.mkv', '.mov', '.avi', '.webm')
+ZIP_BUFFER_SIZE = 16 * 1024 * 1024
 
-    file_size = os.path.getsize(real_file_path)
-    chunk_size = 10 * 1024 * 1024  # 10MB chunks
-    processed_size = 0
-    last_printed_progress = 0
-    arcname = os.path.basename(file_path)
 
-    with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
-        with open(real_file_path, 'rb') as f:
-            while True:
-                chunk = f.read(chunk_size)
-                if not chunk:
-                    break
+def is_compressed_file(file_name: str) -> bool:
+    return file_name.lower().endswith(COMPRESSED_FILE_EXTENSIONS)
 
-                # Create a temporary file to write the chunk
-                temp_chunk_path = 'temp_chunk'
-                with open(temp_chunk_path, 'wb') as tempf:
-                    tempf.write(chunk)
 
-                zipf.write(temp_chunk_path, arcname=arcname)
+def zip_with_progress(file_path, zip_path, buffer_size=ZIP_BUFFER_SIZE):
+    """
+    Zips a single file into a new archive at zip_path, streaming it into one (ZIP64) entry.
 
-                processed_size += len(chunk)
-                progress = processed_size / file_size * 100
-                if progress - last_printed_progress >= 10:
-                    logger(f"Zipping Progress of {arcname}: {progress:.0f}%", LOG_LEVEL_DEBUG, LOG_NAME_PS)
-                    last_printed_progress += 10
+    The file is copied in buffers of buffer_size bytes, so no temporary files are written and the memory usage
+    does not depend on the file size. Files that are compressed already are stored instead of deflated.
+    A symlink is resolved, the entry gets the name of the symlink.
+    """
+    real_file_path = os.path.realpath(file_path)
+    if real_file_path != os.path.abspath(file_path):
+        logger(f"'{file_path}' is a symlink, including the real file '{real_file_path}'.", LOG_LEVEL_DEBUG,
+               LOG_NAME_PS)
 
-                # Remove the temporary file
-                os.remove(temp_chunk_path)
+    file_size = os.path.getsize(real_file_path)
+    processed_size = 0
+    last_printed_progress = 0
+    arcname = os.path.basename(file_path)
+    zinfo = zipfile.ZipInfo.from_file(real_file_path, arcname=arcname)
+    zinfo.compress_type = zipfile.ZIP_STORED if is_compressed_file(arcname) else zipfile.ZIP_DEFLATED
+
+    with zipfile.ZipFile(zip_path, 'w') as zipf, open(real_file_path, 'rb') as f, \
+            zipf.open(zinfo, 'w', force_zip64=True) as entry:
+        while chunk := f.read(buffer_size):
+            entry.write(chunk)
+            processed_size += len(chunk)
+            progress = processed_size / file_size * 100
+            if progress - last_printed_progress >= 10:
+                logger("Zipping Progress of %s: %.0f%%", LOG_LEVEL_DEBUG, LOG_NAME_PS, arcname, progress,
+                       progress=zip_path)
+                last_printed_progress += 10
 
     logger(f"Zipping completed.", LOG_LEVEL_DEBUG, LOG_NAME_PS)
 
@@ -448,34 +469,55 @@ def delete_symlink_and_target(link_name):
         logger(f'{link_name} and its target {target} DELETED successfully.', LOG_LEVEL_DEBUG, LOG_NAME_PS)
 
 
-def compress_zip_file(original_zip_path):
+def compress_zip_file(original_zip_path, compression_level=None):
+    """
+    Re-compresses the zip file at original_zip_path in place, deflating its members on all cores.
+
+    Members are streamed block by block, so the memory use does not depend on the size of the largest member.
+    Members that turn out to be incompressible are stored. The compression level defaults to the
+    ZIP_COMPRESSION_LEVEL setting, a target can override it with its 'compression-level'.
+    """
     if not os.path.exists(original_zip_path):
-        print(f"File {original_zip_path} does not exist.")
+        logger(f"File {original_zip_path} does not exist.", 'error', LOG_NAME_PS)
         return
 
-    with NamedTemporaryFile(delete=False) as temp_file:
+    with NamedTemporaryFile(delete=False, dir=os.path.dirname(original_zip_path)) as temp_file:
         temp_file_path = temp_file.name
 
+    compressor = ParallelZipCompressor(
+        level=compression_level if compression_level is not None else settings_snapshot.current.ZIP_COMPRESSION_LEVEL,
+        workers=settings_snapshot.current.ZIP_COMPRESSION_WORKERS or None)
     try:
         with zipfile.ZipFile(original_zip_path, 'r') as original_zip:
-            total_size = sum([zinfo.file_size for zinfo in original_zip.infolist()])
-            processed_size = 0
-
-            with zipfile.ZipFile(temp_file_path, 'w', compression=zipfile.ZIP_DEFLATED,
-                                 compresslevel=9) as compressed_zip:
-                for file_info in original_zip.infolist():
-                    with original_zip.open(file_info.filename) as file:
-                        file_content = file.read()
-                        compressed_zip.writestr(file_info, file_content)
-                        processed_size += file_info.file_size
-                        progress = (processed_size / total_size) * 100
-                        print(f"Progress: {progress:.2f}%")
+            infos = original_zip.infolist()
+            total_size = sum([zinfo.file_size for zinfo in infos]) or 1
+            processed = {}
+            last_printed_progress = 0
+
+            def progress(arcname, read_size):
+                nonlocal last_printed_progress
+                processed[arcname] = read_size
+                percentage = sum(processed.values()) / total_size * 100
+                if percentage - last_printed_progress >= 10:
+                    logger("Compression progress of %s: %.0f%%", LOG_LEVEL_DEBUG, LOG_NAME_PS, original_zip_path,
+                           percentage, progress=original_zip_path)
+                    last_printed_progress = percentage
+
+            members = ((i.filename, None if i.is_dir() else original_zip.open(i),
+                        time.mktime(i.date_time + (0, 0, -1)),
+                        {"external_attr": i.external_attr, "create_system": i.create_system, "comment": i.comment,
+                         "extra": i.extra}) for i in infos)
+            with tracer.start_as_current_span('zip compress', attributes={"ps.zip.path": original_zip_path,
+                                                                          "ps.zip.members": len(infos),
+                                                                          "ps.zip.bytes": total_size}), \
+                    open(temp_file_path, 'wb') as compressed_zip:
+                compressor.write(compressed_zip, members, progress, original_zip.comment)
 
         shutil.move(temp_file_path, original_zip_path)
-        print(f"Compression of {original_zip_path} completed successfully.")
+        logger(f"Compression of {original_zip_path} completed successfully.", LOG_LEVEL_DEBUG, LOG_NAME_PS)
     except Exception as e:
         os.remove(temp_file_path)
-        print(f"An error occurred: {e}")
+        logger(f"An error occurred while compressing {original_zip_path}: {e}", 'error', LOG_NAME_PS)
 
 
 def zip_a_zipfile_with_progress(original_zip_path, new_zip_path):
@@ -9,7 +9,7 @@ from typing import List, Optional, Sequence, Any
 from cryptography.fernet import Fernet
 
 from pydantic import BaseModel
-from sqlalchemy import text, delete, inspect, UniqueConstraint, desc, asc
+from sqlalchemy import text, delete, update, inspect, event, UniqueConstraint, desc, asc, func
 from sqlalchemy.exc import IntegrityError
 from sqlmodel import SQLModel, Field, create_engine, Session, select
 
@@ -66,6 +66,16 @@ class FilePermissions(StrEnum):
     PRIVATE = auto()
 
 
+class DiskReservationKind(StrEnum):
+    TUS_UPLOAD = auto()
+
+
+class PollState(StrEnum):
+    PENDING = auto()
+    DONE = auto()
+    FAILED = auto()
+
+
 # Define the Metadata model
 class Dataset(SQLModel, table=True):
     id: str = Field(primary_key=True, index=True)
@@ -133,11 +143,78 @@ class DataFile(SQLModel, table=True):
     state: DataFileWorkState = DataFileWorkState.REGISTERED
 
 
+# Space promised to a write that has not (fully) hit the disk yet, e.g. a running tus upload.
+class DiskReservation(SQLModel, table=True):
+    __tablename__ = "disk_reservation"
+    id: int = Field(default=None, primary_key=True)
+    owner: str = Field(index=True)  # tus upload uuid or dataset id
+    kind: DiskReservationKind
+    size: int
+    path: Optional[str]  # the file being written, used to subtract what is already on disk
+    created_date: datetime = Field(default_factory=datetime.utcnow)
+    expires: datetime = Field(index=True)
+
+
+def _set_sqlite_busy_timeout(busy_timeout: int):
+    def on_connect(dbapi_connection, connection_record):
+        # Wait for the write lock of another worker instead of failing with 'database is locked'.
+        dbapi_connection.execute(f'PRAGMA busy_timeout = {int(busy_timeout)}')
+    return on_connect
+
+
+# Progress of the deposit of a dataset to a target, so a resubmitted deposit continues where it stopped: the remote
+# dataset (key DATASET_CHECKPOINT) and every deposited file (key = file name).
+class DepositCheckpoint(SQLModel, table=True):
+    __tablename__ = "deposit_checkpoint"
+    __table_args__ = (
+        UniqueConstraint("ds_id", "target_name", "key", name="unique_ds_id_target_name_key"),
+    )
+    id: int = Field(default=None, primary_key=True)
+    ds_id: str = Field(index=True)
+    target_name: str
+    key: str
+    remote_id: Optional[str]  # e.g. the Dataverse dataset or file id
+    pid: Optional[str]
+    checksum: Optional[str]  # md5 of the deposited file, a changed file is deposited again
+    embargo: Optional[str]  # the date of the embargo that is set
+    saved_date: datetime = Field(default_factory=datetime.utcnow)
+
+
+DATASET_CHECKPOINT = ''
+
+
+# A status check of a deposit, run by poll_scheduler until it completes. The request (headers, auth) is encrypted.
+class Poll(SQLModel, table=True):
+    __tablename__ = "poll"
+    id: str = Field(primary_key=True)
+    ds_id: str = Field(index=True)
+    target_name: str
+    url: str
+    request: str
+    parser: str  # qualified names of module level functions, resolved again after a restart
+    predicate: str
+    on_complete: Optional[str]
+    context: Optional[str]  # JSON given back to on_complete
+    state: PollState = PollState.PENDING
+    attempt: int = 0
+    max_attempts: int
+    interval: float
+    max_interval: float
+    delay: float
+    last_value: Optional[str]
+    next_poll: datetime = Field(index=True)
+    lease_until: datetime = Field(index=True)  # the owner (process) renews it, an expired lease is taken over
+    owner: str
+    created_date: datetime = Field(default_factory=datetime.utcnow)
+
+
 class DatabaseManager:
     cipher_suite = None
-    def __init__(self, db_dialect: str, db_url: str, encryption_key: str):
+    def __init__(self, db_dialect: str, db_url: str, encryption_key: str, busy_timeout: int = 30000):
         self.conn_url = f'{db_dialect}:{db_url}'
         self.engine = create_engine(self.conn_url, pool_size=10)
+        if db_dialect.startswith('sqlite'):
+            event.listen(self.engine, 'connect', _set_sqlite_busy_timeout(busy_timeout))
         # TODO: Remove db_file = self.conn_url.split("///")[1]
         # TODO use self.engine
         self.db_file = self.conn_url.split("///")[1]  # sqlite:////
@@ -161,12 +238,16 @@ class DatabaseManager:
 
     def create_db_and_tables(self):
         # checkfirst=True means if not exist create one, otherwise skip it.
-        # But it doesn't work in multiple uvicorn workers
-        if not inspect(self.engine).has_table("Dataset"):
-            SQLModel.metadata.create_all(self.engine, checkfirst=True)
-        else:
+        # With multiple uvicorn workers it must run under workers.file_lock, see main.
+        if inspect(self.engine).has_table("Dataset"):
             from src.commons import logger
-            logger('TABLES ALREADY CREATED', LOG_LEVEL_DEBUG, LOG_NAME_PS)
+            logger('TABLES ALREADY CREATED, creating missing tables only', LOG_LEVEL_DEBUG, LOG_NAME_PS)
+        # Tables added in later versions (e.g. disk_reservation) are created on existing databases as well.
+        SQLModel.metadata.create_all(self.engine, checkfirst=True)
+        if self.engine.dialect.name == 'sqlite':
+            # Readers do not block the writer (and the other way around), the workers share the database.
+            with self.engine.connect() as connection:
+                connection.exec_driver_sql('PRAGMA journal_mode=WAL')
 
     def insert_dataset_and_target_repo(self, ds_record: Dataset, repo_records: List[TargetRepo]) -> None:
         # Encrypt the md field of the Dataset
@@ -206,14 +287,30 @@ class DatabaseManager:
 
     def delete_all(self) -> dict:
         with Session(self.engine) as session:
-            tabs = {cls.__qualname__: session.exec(delete(cls)).rowcount for cls in [DataFile, TargetRepo, Dataset]}
+            tabs = {cls.__qualname__: session.exec(delete(cls)).rowcount
+                    for cls in [DataFile, TargetRepo, Poll, DepositCheckpoint, Dataset]}
             session.commit()
         return tabs
 
+    def snapshot(self, path: str, pages_per_step: int = 1024) -> str:
+        """
+        Copies the database to path with the SQLite online backup API.
+
+        The copy is consistent even while other connections write, the source is only locked for one step of
+        pages_per_step pages at a time.
+        """
+        source = self.engine.raw_connection()
+        try:
+            with closing(sqlite3.connect(path)) as target:
+                source.driver_connection.backup(target, pages=pages_per_step)
+        finally:
+            source.close()
+        return path
+
     def delete_by_dataset_id(self, dataset_id) -> type(None):
         with Session(self.engine) as session:
             # Delete DataFiles and TargetRepos in a single transaction
-            for model in [DataFile, TargetRepo]:
+            for model in [DataFile, TargetRepo, Poll, DepositCheckpoint]:
                 session.exec(delete(model).where(model.ds_id == dataset_id))
             session.commit()
 
@@ -245,9 +342,12 @@ class DatabaseManager:
 
     def find_unfinished_target_repo(self, dataset_id: str) -> Sequence[TargetRepo]:
         with Session(self.engine) as session:
-            return session.exec(select(TargetRepo).where(TargetRepo.ds_id == dataset_id,
-                                                         TargetRepo.deposit_status != DepositStatus.FINISH).
-                                order_by(TargetRepo.id)).all()
+            target_repos = session.exec(select(TargetRepo).where(TargetRepo.ds_id == dataset_id,
+                                                                 TargetRepo.deposit_status != DepositStatus.FINISH).
+                                        order_by(TargetRepo.id)).all()
+            for target_repo in target_repos:
+                target_repo.decrypt_config(self.cipher_suite)
+            return target_repos
 
     def find_all_datasets(self) -> Sequence[Dataset]:
         with Session(self.engine) as session:
@@ -323,8 +423,6 @@ class DatabaseManager:
             statement = select(DataFile).where(DataFile.ds_id == dataset_id, DataFile.name == file_name)
             results = session.exec(statement)
             result = results.one_or_none()
-            print(dataset_id)
-            print(file_name)
         return result
 
     def find_registered_files(self, dataset_id: str) -> [DataFile]:
@@ -465,6 +563,12 @@ class DatabaseManager:
                 session.commit()
                 session.refresh(md_record)
 
+    def count_unpublished_datasets_by_state(self) -> dict:
+        with Session(self.engine) as session:
+            statement = select(Dataset.state, func.count()).where(
+                Dataset.release_version != ReleaseVersion.PUBLISHED).group_by(Dataset.state)
+            return {state: count for state, count in session.exec(statement).all()}
+
     def update_target_repo_deposit_status(self, target_repo: TargetRepo) -> type(None):
         with Session(self.engine) as session:
             statement = select(TargetRepo).where(TargetRepo.ds_id == target_repo.ds_id,
@@ -476,7 +580,6 @@ class DatabaseManager:
                 target_repo_record.target_output = target_repo.target_output
                 target_repo_record.deposit_time = datetime.utcnow()
                 target_repo_record.duration = target_repo.duration
-                target_repo_record.encrypt_config(self.cipher_suite)
                 session.add(target_repo_record)
                 session.commit()
                 session.refresh(target_repo_record)
@@ -488,7 +591,6 @@ class DatabaseManager:
             target_repo_record = results.one_or_none()
             if target_repo_record:
                 target_repo_record.target_output = target_repo.target_output
-                target_repo_record.encrypt_config(self.cipher_suite)
                 session.add(target_repo_record)
                 session.commit()
                 session.refresh(target_repo_record)
@@ -546,6 +648,137 @@ class DatabaseManager:
                 session.add(tr)
             session.commit()
 
+    def insert_disk_reservation(self, reservation: DiskReservation) -> DiskReservation:
+        with Session(self.engine) as session:
+            session.add(reservation)
+            session.commit()
+            session.refresh(reservation)
+        return reservation
+
+    def update_disk_reservation_owner(self, reservation_id: int, owner: str, path: str = None) -> type(None):
+        with Session(self.engine) as session:
+            reservation = session.exec(select(DiskReservation).where(DiskReservation.id == reservation_id)).one_or_none()
+            if reservation:
+                reservation.owner = owner
+                reservation.path = path if path else reservation.path
+                session.add(reservation)
+                session.commit()
+
+    def find_active_disk_reservations(self) -> Sequence[DiskReservation]:
+        with Session(self.engine) as session:
+            return session.exec(select(DiskReservation).where(DiskReservation.expires > datetime.utcnow())).all()
+
+    def delete_disk_reservations(self, owner: str, kind: DiskReservationKind = None) -> int:
+        with Session(self.engine) as session:
+            statement = delete(DiskReservation).where(DiskReservation.owner == owner)
+            if kind:
+                statement = statement.where(DiskReservation.kind == kind)
+            rowcount = session.exec(statement).rowcount
+            session.commit()
+        return rowcount
+
+    def delete_disk_reservation_by_id(self, reservation_id: int) -> type(None):
+        with Session(self.engine) as session:
+            session.exec(delete(DiskReservation).where(DiskReservation.id == reservation_id))
+            session.commit()
+
+    def delete_expired_disk_reservations(self) -> int:
+        with Session(self.engine) as session:
+            rowcount = session.exec(delete(DiskReservation).where(DiskReservation.expires <= datetime.utcnow())).rowcount
+            session.commit()
+        return rowcount
+
+    def insert_poll(self, poll: Poll) -> Poll:
+        poll.request = self.cipher_suite.encrypt(poll.request.encode()).decode()
+        with Session(self.engine) as session:
+            session.add(poll)
+            session.commit()
+            session.refresh(poll)
+        poll.request = self.cipher_suite.decrypt(poll.request.encode()).decode()
+        return poll
+
+    def find_poll(self, poll_id: str) -> Poll:
+        with Session(self.engine) as session:
+            poll = session.exec(select(Poll).where(Poll.id == poll_id)).one_or_none()
+        if poll:
+            poll.request = self.cipher_suite.decrypt(poll.request.encode()).decode()
+        return poll
+
+    def reschedule_poll(self, poll_id: str, owner: str, attempt: int, delay: float, last_value: str,
+                        next_poll: datetime, lease_until: datetime) -> bool:
+        """Returns False when the poll is gone or owned by another process."""
+        with Session(self.engine) as session:
+            rowcount = session.exec(update(Poll).where(Poll.id == poll_id, Poll.owner == owner).values(
+                attempt=attempt, delay=delay, last_value=last_value, next_poll=next_poll,
+                lease_until=lease_until)).rowcount
+            session.commit()
+        return rowcount == 1
+
+    def claim_expired_polls(self, owner: str, lease_until: datetime, limit: int = 100) -> [str]:
+        """Takes over the pending polls whose owner did not renew the lease, e.g. after a restart."""
+        claimed = []
+        with Session(self.engine) as session:
+            expired = session.exec(select(Poll.id, Poll.owner).where(
+                Poll.state == PollState.PENDING, Poll.lease_until < datetime.utcnow()).limit(limit)).all()
+            for poll_id, previous_owner in expired:
+                # Only one process wins the update of a poll.
+                if session.exec(update(Poll).where(Poll.id == poll_id, Poll.owner == previous_owner).values(
+                        owner=owner, lease_until=lease_until)).rowcount == 1:
+                    claimed.append(poll_id)
+            session.commit()
+        return claimed
+
+    def finish_poll(self, poll_id: str, owner: str, state: PollState) -> bool:
+        """Marks the pending poll done or failed. Returns False when it was already finished or taken over."""
+        with Session(self.engine) as session:
+            rowcount = session.exec(update(Poll).where(Poll.id == poll_id, Poll.owner == owner,
+                                                       Poll.state == PollState.PENDING).values(state=state)).rowcount
+            session.commit()
+        return rowcount == 1
+
+    def find_checkpoints(self, dataset_id: str, target_name: str) -> {str: DepositCheckpoint}:
+        with Session(self.engine) as session:
+            return {cp.key: cp for cp in session.exec(select(DepositCheckpoint).where(
+                DepositCheckpoint.ds_id == dataset_id, DepositCheckpoint.target_name == target_name)).all()}
+
+    def save_checkpoint(self, checkpoint: DepositCheckpoint) -> type(None):
+        """Inserts the checkpoint, or updates the given fields of the one with the same key."""
+        with Session(self.engine) as session:
+            record = session.exec(select(DepositCheckpoint).where(
+                DepositCheckpoint.ds_id == checkpoint.ds_id, DepositCheckpoint.target_name == checkpoint.target_name,
+                DepositCheckpoint.key == checkpoint.key)).one_or_none()
+            if record:
+                for name, value in checkpoint.model_dump(exclude_unset=True, exclude={'id'}).items():
+                    setattr(record, name, value)
+                record.saved_date = datetime.utcnow()
+            session.add(record or checkpoint)
+            session.commit()
+
+    def delete_checkpoints(self, dataset_id: str, target_name: str) -> int:
+        with Session(self.engine) as session:
+            rowcount = session.exec(delete(DepositCheckpoint).where(
+                DepositCheckpoint.ds_id == dataset_id, DepositCheckpoint.target_name == target_name)).rowcount
+            session.commit()
+        return rowcount
+
+    def cancel_polls(self, dataset_id: str, target_name: str) -> int:
+        with Session(self.engine) as session:
+            rowcount = session.exec(update(Poll).where(Poll.ds_id == dataset_id, Poll.target_name == target_name,
+                                                       Poll.state == PollState.PENDING).values(
+                state=PollState.DONE)).rowcount
+            session.commit()
+        return rowcount
+
+    def claim_submitted_target(self, dataset_id: str, target_name: str) -> bool:
+        """Moves a SUBMITTED target to FINALIZING. Only one of the callback and the poll of a target wins."""
+        with Session(self.engine) as session:
+            rowcount = session.exec(update(TargetRepo).where(
+                TargetRepo.ds_id == dataset_id, TargetRepo.name == target_name,
+                TargetRepo.deposit_status == DepositStatus.SUBMITTED).values(
+                deposit_status=DepositStatus.FINALIZING)).rowcount
+            session.commit()
+        return rowcount == 1
+
     def is_dataset_ready(self, dataset_id: str) -> bool:
         with Session(self.engine) as session:
             dataset_id_rec = session.exec(
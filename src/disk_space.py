@@ -0,0 +1,80 @@
+"""
+Disk space admission control.
+
+Writes that can be large (tus uploads) reserve their expected size before they start.
+A reservation is refused when the space already used on the data volume plus the outstanding part of all
+active reservations plus the new request would pass the configured high watermark. Reservations are released
+when the write completes, or ignored and purged once they expire.
+"""
+import os
+import shutil
+from datetime import datetime, timedelta
+
+from src import settings_snapshot
+from src.commons import settings, db_manager, logger, LOG_LEVEL_DEBUG, LOG_NAME_PS
+from src.dbz import DiskReservation, DiskReservationKind
+from src.workers import file_lock
+
+
+class InsufficientStorageError(Exception):
+    """Raised when a reservation would push the data volume over the high watermark."""
+
+
+class DiskSpaceManager:
+    """
+    Keeps track of disk space reservations for the data volume (``DATA_TMP_BASE_DIR``).
+
+    Reservations are stored in the database so that every worker sees the same picture, the check and insert of a
+    reservation hold a lock shared by the workers.
+    """
+
+    def __init__(self, data_dir: str):
+        self.data_dir = data_dir
+
+    @staticmethod
+    def _outstanding(reservation: DiskReservation) -> int:
+        # Bytes already written by the reserving process are part of the 'used' figure of the volume.
+        written = os.path.getsize(reservation.path) if reservation.path and os.path.isfile(reservation.path) else 0
+        return max(reservation.size - written, 0)
+
+    def usage(self) -> dict:
+        total, used, free = shutil.disk_usage(self.data_dir)
+        reserved = sum(self._outstanding(r) for r in db_manager.find_active_disk_reservations())
+        return {"total": total, "used": used, "free": free, "reserved": reserved,
+                "limit": int(total * settings_snapshot.current.DISK_HIGH_WATERMARK)}
+
+    def reserve(self, owner: str, kind: DiskReservationKind, size: int, path: str = None,
+                ttl: int = None) -> DiskReservation:
+        """
+        Reserves ``size`` bytes for ``owner``.
+
+        Raises:
+            InsufficientStorageError: If the reservation would pass the high watermark.
+        """
+        ttl = ttl if ttl else settings_snapshot.current.DISK_RESERVATION_TTL
+        with file_lock('disk-reservations'):
+            db_manager.delete_expired_disk_reservations()
+            usage = self.usage()
+            if usage["used"] + usage["reserved"] + size > usage["limit"]:
+                logger(f'Disk reservation of {size} bytes for {owner} refused. Used: {usage["used"]} '
+                       f'Reserved: {usage["reserved"]} Limit: {usage["limit"]}', 'warning', LOG_NAME_PS)
+                raise InsufficientStorageError(f'Not enough disk space to store {size} bytes.')
+            reservation = db_manager.insert_disk_reservation(
+                DiskReservation(owner=owner, kind=kind, size=size, path=path,
+                                expires=datetime.utcnow() + timedelta(seconds=ttl)))
+        logger(f'Reserved {size} bytes for {kind} {owner}', LOG_LEVEL_DEBUG, LOG_NAME_PS)
+        return reservation
+
+    def assign(self, reservation: DiskReservation, owner: str, path: str = None) -> type(None):
+        """Hands a reservation made before the owner was known (e.g. a tus upload uuid) to its owner."""
+        db_manager.update_disk_reservation_owner(reservation.id, owner, path)
+
+    def release(self, owner: str, kind: DiskReservationKind = None) -> type(None):
+        if db_manager.delete_disk_reservations(owner, kind):
+            logger(f'Released disk reservation(s) of {owner}', LOG_LEVEL_DEBUG, LOG_NAME_PS)
+
+    def cancel(self, reservation: DiskReservation) -> type(None):
+        db_manager.delete_disk_reservation_by_id(reservation.id)
+
+
+disk_space = DiskSpaceManager(settings.DATA_TMP_BASE_DIR)
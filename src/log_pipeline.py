@@ -0,0 +1,129 @@
+"""
+Non-blocking logging of the packaging service.
+
+Request and bridge threads only put their records on a queue (``QueueHandler``), a single ``QueueListener`` thread
+writes them to the log files and stdout. Every log file gets one rotating handler, shared by the loggers that write
+to it. Records carry the ``dataset_id`` of the work they belong to (see ``dataset_context``) and are written as
+plain text in the logger's ``log_format`` or, with ``LOG_JSON``, as one JSON object per line.
+
+Progress lines (logged with ``progress=<key>``) are sampled: per key at most one every ``LOG_PROGRESS_INTERVAL``
+seconds is kept.
+"""
+import atexit
+import contextvars
+import json
+import logging
+import queue
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener, TimedRotatingFileHandler
+
+dataset_id_var = contextvars.ContextVar('dataset_id', default=None)
+
+_listener = None
+
+
+@contextmanager
+def dataset_context(dataset_id: str):
+    """Tags the records logged in this context (and in threads started with a copy of it) with the dataset id."""
+    token = dataset_id_var.set(dataset_id)
+    try:
+        yield
+    finally:
+        dataset_id_var.reset(token)
+
+
+class DatasetContextFilter(logging.Filter):
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.dataset_id = dataset_id_var.get() or '-'
+        return True
+
+
+class ProgressSamplingFilter(logging.Filter):
+    """Drops progress records that follow the previous kept record of the same key within the interval."""
+
+    def __init__(self, interval: float):
+        super().__init__()
+        self.interval = interval
+        self.last_kept = {}
+        self.lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        key = getattr(record, 'progress', None)
+        if key is None or self.interval <= 0:
+            return True
+        now = time.monotonic()
+        with self.lock:
+            if now - self.last_kept.get(key, float('-inf')) < self.interval:
+                return False
+            self.last_kept[key] = now
+        return True
+
+
+class _LoggerNameFilter(logging.Filter):
+    # A log file can be shared by several loggers, e.g. two apps configured with the same file.
+    def __init__(self):
+        super().__init__()
+        self.names = set()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        return record.name in self.names
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {"time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+                 "level": record.levelname, "logger": record.name, "thread": record.threadName,
+                 "dataset_id": getattr(record, 'dataset_id', '-'), "message": record.getMessage()}
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+
+def start_logging(loggers: [dict], json_records: bool = False, progress_interval: float = 0) -> type(None):
+    """
+    Routes the given loggers through one queue to a single writer thread.
+
+    Args:
+        loggers: The LOGGERS setting, dicts with name, log_file, log_level and log_format.
+        json_records: Write JSON lines instead of the log_format.
+        progress_interval: Seconds between kept progress records of the same key, 0 keeps all.
+    """
+    global _listener
+    if _listener:
+        return
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = QueueHandler(log_queue)
+    queue_handler.addFilter(DatasetContextFilter())
+    queue_handler.addFilter(ProgressSamplingFilter(progress_interval))
+
+    file_handlers = {}
+    for log in loggers:
+        formatter = JsonFormatter() if json_records else logging.Formatter(log.get('log_format'))
+        if log.get('log_file') not in file_handlers:
+            handler = TimedRotatingFileHandler(log.get('log_file'), when="H", interval=8, backupCount=10)
+            handler.setFormatter(formatter)
+            handler.addFilter(_LoggerNameFilter())
+            file_handlers[log.get('log_file')] = handler
+        file_handlers[log.get('log_file')].filters[0].names.add(log.get('name'))
+
+        log_setup = logging.getLogger(log.get('name'))
+        log_setup.setLevel(log.get('log_level'))
+        log_setup.addHandler(queue_handler)
+
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(JsonFormatter() if json_records else logging.Formatter(loggers[0].get('log_format')))
+    _listener = QueueListener(log_queue, *file_handlers.values(), stream_handler, respect_handler_level=True)
+    _listener.start()
+    atexit.register(stop_logging)
+
+
+def stop_logging() -> type(None):
+    """Writes the queued records and stops the writer thread."""
+    global _listener
+    if _listener:
+        _listener.stop()
+        _listener = None
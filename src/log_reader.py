@@ -0,0 +1,112 @@
+"""
+Partial reads of the (large) log files: byte ranges, the last lines and the lines of a dataset.
+
+The lines of a dataset are found with an offset index per log file that maps every dataset id (the ``[dataset_id]``
+field of the records, see ``log_pipeline``, or a UUID in the message) to the offsets of its lines. The index is
+extended incrementally with the lines written since the previous request and rebuilt when the file was rotated.
+"""
+import os
+import re
+import threading
+
+READ_BLOCK_SIZE = 64 * 1024
+# The dataset id field of text and JSON records, and dataset ids (UUIDs) mentioned in messages.
+DATASET_ID_PATTERN = re.compile(rb'\[(?P<field>[^\]\s]+)\] : |"dataset_id": "(?P<json>[^"]+)"|'
+                                rb'(?P<uuid>[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12})')
+
+
+def parse_range(header: str, size: int) -> (int, int):
+    """
+    Parses a single range Range header.
+
+    Returns:
+        (int, int): The first and last (inclusive) byte position, or None if the header is not a single byte range.
+
+    Raises:
+        ValueError: When the range cannot be satisfied.
+    """
+    match = re.fullmatch(r'\s*bytes=(\d*)-(\d*)\s*', header or '')
+    if not match or match.group(1) == match.group(2) == '':
+        return None
+    if match.group(1) == '':
+        start, end = max(size - int(match.group(2)), 0), size - 1
+    else:
+        start = int(match.group(1))
+        end = min(int(match.group(2)), size - 1) if match.group(2) else size - 1
+    if start >= size or start > end:
+        raise ValueError(f'Range {header} not satisfiable, size is {size}')
+    return start, end
+
+
+def iter_range(path: str, start: int, end: int):
+    """Yields the bytes start..end (inclusive) of the file."""
+    with open(path, 'rb') as f:
+        f.seek(start)
+        remaining = end - start + 1
+        while remaining > 0 and (chunk := f.read(min(READ_BLOCK_SIZE, remaining))):
+            remaining -= len(chunk)
+            yield chunk
+
+
+def tail(path: str, lines: int) -> bytes:
+    """Returns the last lines of the file, reading blocks backwards from the end."""
+    with open(path, 'rb') as f:
+        position = f.seek(0, os.SEEK_END)
+        data = b''
+        # One more newline than lines, the file (normally) ends with one.
+        while position > 0 and data.count(b'\n') <= lines:
+            step = min(READ_BLOCK_SIZE, position)
+            position -= step
+            f.seek(position)
+            data = f.read(step) + data
+    return b''.join(data.splitlines(keepends=True)[-lines:]) if lines > 0 else b''
+
+
+class LogIndex:
+    """Offsets of the lines of every dataset id in one log file."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.inode = None
+        self.indexed_size = 0
+        self.offsets = {}
+        self.lock = threading.Lock()
+
+    def update(self) -> type(None):
+        stat = os.stat(self.path)
+        if stat.st_ino != self.inode or stat.st_size < self.indexed_size:
+            self.inode, self.indexed_size, self.offsets = stat.st_ino, 0, {}
+        with open(self.path, 'rb') as f:
+            f.seek(self.indexed_size)
+            offset = self.indexed_size
+            for line in f:
+                if not line.endswith(b'\n'):
+                    break  # Being written, indexed next time.
+                for dataset_id in {m.group('field') or m.group('json') or m.group('uuid')
+                                   for m in DATASET_ID_PATTERN.finditer(line)} - {b'-'}:
+                    self.offsets.setdefault(dataset_id.decode(errors='replace'), []).append(offset)
+                offset += len(line)
+            self.indexed_size = offset
+
+    def lines(self, dataset_id: str, last: int = None) -> bytes:
+        """Returns the lines of the dataset, or only its last lines."""
+        with self.lock:
+            self.update()
+            offsets = self.offsets.get(dataset_id, [])
+        if last is not None:
+            offsets = offsets[-last:] if last > 0 else []
+        lines = []
+        with open(self.path, 'rb') as f:
+            for offset in offsets:
+                f.seek(offset)
+                lines.append(f.readline())
+        return b''.join(lines)
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def log_index(path: str) -> LogIndex:
+    with _indexes_lock:
+        return _indexes.setdefault(path, LogIndex(path))
@@ -9,7 +9,7 @@ Modules:
 - `protected`: Contains protected access routes.
 - `tus_files`: Contains routes for handling file uploads using the Tus protocol.
 - `commons`: Contains common settings, logger setup, and utility functions.
-- `InspectBridgeModule`: Provides a utility for inspecting bridge module classes.
+- `bridge_registry`: Loads the bridge module classes and reloads changed modules.
 - `db_manager`: Manages the creation of the database and tables.
 
 Dependencies:
@@ -24,43 +24,36 @@ import importlib
 # import importlib.metadata
 import multiprocessing
 import os
+import threading
 from contextlib import asynccontextmanager
 from datetime import datetime, timezone
 from typing import Annotated
 
-import emoji
-import uvicorn
 from fastapi import FastAPI, Request, HTTPException, Depends
-from fastapi.security import OAuth2PasswordBearer, HTTPBearer, HTTPAuthorizationCredentials
+from fastapi.responses import JSONResponse
+from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from fastapi_events.middleware import EventHandlerASGIMiddleware
-from gunicorn.app.wsgiapp import WSGIApplication
-from keycloak import KeycloakOpenID, KeycloakAuthenticationError
-
-import multiprocessing
-import platform
-from datetime import datetime, timezone
-
 
 __version__ = importlib.metadata.metadata("packaging-service")["version"]
 
 from starlette import status
+from starlette.concurrency import run_in_threadpool
 from starlette.middleware.cors import CORSMiddleware
 
-from src import public, protected, tus_files
-from src.commons import settings, setup_logger, data, db_manager, logger, send_mail, inspect_bridge_module, \
-    LOG_LEVEL_DEBUG, LOG_NAME_PS
+from src import public, protected, tus_files, process_pool
+from src.commons import settings, setup_logger, db_manager, logger, send_mail, LOG_LEVEL_DEBUG, LOG_NAME_PS
 
-from src.tus_files import upload_files
+from src.tus_files import upload_files, reserve_tus_upload_space
+from src.orphan_collector import orphan_collector
+from src.workers import file_lock, leader
+from src.bridge_registry import bridge_registry
+from src.poll_scheduler import poll_scheduler
+from src.assistant_config import assistant_configs
+from src.metrics import observe_tus_patch, prepare_multiprocess_dir
+from src.tracing import configure_tracing
+from src.token_validation import token_validator, InvalidTokenError
 
 from fastapi_events.handlers.local import local_handler
-from fastapi_events.typing import Event
-
-from opentelemetry import trace
-from opentelemetry.exporter.jaeger.thrift import JaegerExporter
-from opentelemetry.instrumentation.fastapi import FastAPIInstrumentor
-from opentelemetry.sdk.trace import TracerProvider
-from opentelemetry.sdk.trace.export import BatchSpanProcessor
-from opentelemetry.sdk.resources import SERVICE_NAME, Resource
 
 
 @asynccontextmanager
@@ -69,8 +62,8 @@ async def lifespan(application: FastAPI):
     Lifespan event handler for the FastAPI application.
 
     This function is executed during the startup of the FastAPI application.
-    It initializes the database, iterates through saved bridge module directories,
-    and prints available bridge classes.
+    It initializes the database, loads the bridge modules (and starts watching them for changes),
+    starts the status poll scheduler and prints available bridge classes.
 
     Args:
         application (FastAPI): The FastAPI application.
@@ -82,15 +75,30 @@ async def lifespan(application: FastAPI):
     print('start up')
     if not os.path.exists(settings.DB_URL):
         logger('Creating database', LOG_LEVEL_DEBUG, LOG_NAME_PS)
-        db_manager.create_db_and_tables()
     else:
         logger('Database already exists', LOG_LEVEL_DEBUG, LOG_NAME_PS)
-    iterate_saved_bridge_module_dir()
-    print(f'Available bridge classes: {sorted(list(data.keys()))}')
+    with file_lock('db-init'):
+        db_manager.create_db_and_tables()
+    bridge_registry.scan()
+    bridge_registry.start_watcher()
+    print(f'Available bridge classes: {bridge_registry.names()}')
+    # Background jobs that run in one worker only.
+    if settings.get("ORPHAN_COLLECTOR_ENABLE", True):
+        leader.add_job('orphan-collector', orphan_collector.start, orphan_collector.stop)
+    leader.start()
+    poll_scheduler.start()
+    if settings.get("ASSISTANT_CONFIG_WARM"):
+        threading.Thread(target=assistant_configs.warm, args=(settings.ASSISTANT_CONFIG_WARM,), daemon=True).start()
+    import emoji
     print(emoji.emojize(':thumbs_up:'))
 
     yield
 
+    poll_scheduler.stop()
+    process_pool.shutdown()
+    leader.resign()
+    bridge_registry.stop_watcher()
+
 
 api_keys = [settings.DANS_PACKAGING_SERVICE_API_KEY]
 
@@ -114,16 +122,33 @@ def auth_header(request: Request, auth_cred: Annotated[HTTPAuthorizationCredenti
     if api_key in api_keys:
         return
 
-    keycloak_env = settings.get(f"keycloak_{request.headers['auth-env-name']}")
+    env_name = request.headers.get('auth-env-name')
+    keycloak_env = settings.get(f"keycloak_{env_name}")
     if not keycloak_env:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Forbidden")
 
     try:
-        keycloak_openid = KeycloakOpenID(server_url=keycloak_env.URL, client_id=keycloak_env.CLIENT_ID, realm_name=keycloak_env.REALMS)
-        keycloak_openid.userinfo(api_key)
-    except KeycloakAuthenticationError:
+        token_validator.validate_token(env_name, keycloak_env, api_key)
+    except InvalidTokenError as e:
+        logger(f'Invalid token for {env_name}: {e}', LOG_LEVEL_DEBUG, LOG_NAME_PS)
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Forbidden")
 
+
+async def authenticate_tus_create(request: Request, call_next):
+    """
+    HTTP middleware that authenticates the creation of a tus upload before its disk space is reserved.
+
+    The router dependency ``auth_header`` only runs after all middlewares, so without it an unauthenticated POST could
+    reserve (and hold until it expires) any announced ``Upload-Length``.
+    """
+    if request.method == 'POST' and request.url.path.rstrip('/') == '/files':
+        try:
+            await run_in_threadpool(auth_header, request, await security(request))
+        except HTTPException as e:
+            return JSONResponse(status_code=e.status_code, content={"detail": e.detail}, headers=e.headers)
+    return await call_next(request)
+
+
 def pre_startup_routine(app: FastAPI) -> None:
     setup_logger()
     logger(f'MELT_ENABLE = {settings.get("MELT_ENABLE")}', LOG_LEVEL_DEBUG, LOG_NAME_PS)
@@ -131,6 +156,12 @@ def pre_startup_routine(app: FastAPI) -> None:
     if settings.get("MELT_ENABLE", False):
         enable_otel(app)
 
+    # Reserve disk space for new tus uploads, reject with 507 when the data volume is (nearly) full
+    app.middleware("http")(reserve_tus_upload_space)
+    # Added after it, so it runs before it: an upload is authenticated before its disk space is reserved
+    app.middleware("http")(authenticate_tus_create)
+    app.middleware("http")(observe_tus_patch)
+
     # Enable CORS
     app.add_middleware(
         CORSMiddleware,
@@ -157,20 +188,11 @@ def pre_startup_routine(app: FastAPI) -> None:
 
 
 def enable_otel(app):
-    melt_agent_host_name = settings.get("MELT_AGENT_HOST_NAME", "localhost")
-    # Set up the tracer provider
-    trace.set_tracer_provider(
-        TracerProvider(resource=Resource.create({SERVICE_NAME: "Packaging Service"}))
-    )
-    tracer_provider = trace.get_tracer_provider()
-    # Configure Jaeger exporter
-    jaeger_exporter = JaegerExporter(
-        agent_host_name=melt_agent_host_name,
-        agent_port=6831,
-        udp_split_oversized_batches=True,
-    )
-    # Add the Jaeger exporter to the tracer provider
-    tracer_provider.add_span_processor(BatchSpanProcessor(jaeger_exporter))
+    # Only imported when MELT_ENABLE is set, the instrumentation takes a good part of the import time.
+    from opentelemetry.instrumentation.fastapi import FastAPIInstrumentor
+    configure_tracing(exporter=settings.get("MELT_EXPORTER", "jaeger"),
+                      agent_host_name=settings.get("MELT_AGENT_HOST_NAME", "localhost"),
+                      otlp_endpoint=settings.get("MELT_OTLP_ENDPOINT", "http://localhost:4318/v1/traces"))
     FastAPIInstrumentor.instrument_app(app)
 
 
@@ -198,26 +220,17 @@ def info():
     return {"name": "packaging-service", "version": __version__}
 
 
-def iterate_saved_bridge_module_dir():
-    """
-    Iterates through saved bridge module directories.
-
-    For each Python file in the modules directory, it inspects the file for bridge classes
-    and updates the data dictionary with the class name.
-
-    """
-    for filename in os.listdir(settings.MODULES_DIR):
-        if filename.endswith(".py") and not filename.startswith('__'):
-            module_path = os.path.join(settings.MODULES_DIR, filename)
-            for cls_name in inspect_bridge_module(module_path):
-                data.update(cls_name)
-
-
 def run_server():
     """Configures and runs the server based on the environment settings."""
+    import uvicorn
     if settings.get("MULTIPLE_WORKERS_ENABLE", False):
+        # The workers write their metrics to files in this directory, /metrics aggregates them.
+        prepare_multiprocess_dir(settings.PROMETHEUS_MULTIPROC_DIR)
+        # Created (and migrated) once before the workers start, not by all of them at the same time.
+        with file_lock('db-init'):
+            db_manager.create_db_and_tables()
         uvicorn.run("src.main:app", host="0.0.0.0", port=10124, reload=False,
-                    workers=(multiprocessing.cpu_count() * 2) + 1,
+                    workers=settings.get("WORKERS", 0) or (multiprocessing.cpu_count() * 2) + 1,
                     # worker_class="uvicorn.workers.UvicornWorker",
                     timeout_keep_alive= 300,
                     # preload=True
@@ -0,0 +1,148 @@
+"""
+Prometheus metrics of the deposit pipeline, exposed on ``/metrics``.
+
+With ``MULTIPLE_WORKERS_ENABLE`` every worker is a separate process. ``run_server`` then points
+``PROMETHEUS_MULTIPROC_DIR`` to an empty directory before the workers start, every process writes its samples to
+memory mapped files there and ``/metrics`` aggregates the files of all (live) workers. Without that variable the
+default in-process registry is used.
+
+The figures that live in the database (pending datasets, disk reservations) are not counted per process but read
+at scrape time by ``DatabaseStateCollector``.
+"""
+import os
+import re
+import time
+from contextlib import contextmanager
+
+import psutil
+from prometheus_client import CollectorRegistry, Counter, Gauge, Histogram, CONTENT_TYPE_LATEST, REGISTRY, \
+    generate_latest, multiprocess
+from prometheus_client.core import GaugeMetricFamily
+from sqlalchemy import event
+
+MULTIPROC_DIR_ENV = 'PROMETHEUS_MULTIPROC_DIR'
+LIVE_GAUGE_FILE_PATTERN = re.compile(r'^gauge_live\w+_(?P<pid>\d+)\.db$')
+
+# Deposits and transformations are seconds to hours, DB queries and tus PATCH chunks milliseconds to seconds.
+SLOW_BUCKETS = (0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600, 7200, 14400)
+FAST_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+THROUGHPUT_BUCKETS = tuple(2 ** n * 1024 * 1024 for n in range(-4, 11))  # 64 KiB/s - 1 GiB/s
+
+TRANSFORM_SECONDS = Histogram('ps_transform_duration_seconds', 'Duration of transformer service calls.',
+                              ['transformer'], buckets=SLOW_BUCKETS)
+DEPOSIT_SECONDS = Histogram('ps_deposit_duration_seconds', 'Duration of the deposit to a target repository.',
+                            ['target', 'bridge', 'status'], buckets=SLOW_BUCKETS)
+FILE_UPLOAD_SECONDS = Histogram('ps_file_upload_duration_seconds', 'Duration of a single file upload to a target.',
+                                ['target'], buckets=SLOW_BUCKETS)
+FILE_UPLOAD_BYTES_PER_SECOND = Histogram('ps_file_upload_bytes_per_second', 'Throughput of single file uploads.',
+                                         ['target'], buckets=THROUGHPUT_BUCKETS)
+TUS_PATCH_SECONDS = Histogram('ps_tus_patch_duration_seconds', 'Duration of tus PATCH (chunk upload) requests.',
+                              ['status'], buckets=FAST_BUCKETS)
+DB_QUERY_SECONDS = Histogram('ps_db_query_duration_seconds', 'Duration of database statements.', ['statement'],
+                             buckets=FAST_BUCKETS)
+BRIDGE_THREADS = Gauge('ps_bridge_threads_running', 'Number of running bridge threads.',
+                       multiprocess_mode='livesum')
+BRIDGE_ERRORS = Counter('ps_bridge_errors_total', 'Number of failed deposits, by bridge class.', ['bridge'])
+ORPHAN_RECLAIMED_BYTES = Counter('ps_orphan_collector_reclaimed_bytes_total',
+                                 'Bytes reclaimed by the orphan collector.')
+
+
+class DatabaseStateCollector:
+    """Reads the pending datasets and the active disk reservations from the database on every scrape."""
+
+    def __init__(self, db_manager):
+        self.db_manager = db_manager
+
+    def collect(self):
+        pending = GaugeMetricFamily('ps_datasets_pending', 'Number of datasets by work state, excluding published.',
+                                    labels=['state'])
+        for state, count in self.db_manager.count_unpublished_datasets_by_state().items():
+            pending.add_metric([state], count)
+        yield pending
+
+        reservations = self.db_manager.find_active_disk_reservations()
+        count = GaugeMetricFamily('ps_disk_reservations', 'Number of active disk reservations.', labels=['kind'])
+        size = GaugeMetricFamily('ps_disk_reserved_bytes', 'Bytes held by active disk reservations.', labels=['kind'])
+        for kind in sorted({r.kind for r in reservations}):
+            count.add_metric([kind], sum(1 for r in reservations if r.kind == kind))
+            size.add_metric([kind], sum(r.size for r in reservations if r.kind == kind))
+        yield count
+        yield size
+
+
+def is_multiprocess() -> bool:
+    return bool(os.environ.get(MULTIPROC_DIR_ENV))
+
+
+def prepare_multiprocess_dir(path: str) -> type(None):
+    """Empties (or creates) the multiprocess directory and exports it to the worker processes."""
+    os.makedirs(path, exist_ok=True)
+    for name in os.listdir(path):
+        if name.endswith('.db'):
+            os.remove(os.path.join(path, name))
+    os.environ[MULTIPROC_DIR_ENV] = path
+
+
+def _purge_dead_workers() -> type(None):
+    # The live gauges (running bridge threads) of a worker that died or was restarted must not be summed anymore.
+    pids = {int(m['pid']) for m in (LIVE_GAUGE_FILE_PATTERN.match(name)
+                                    for name in os.listdir(os.environ[MULTIPROC_DIR_ENV])) if m}
+    for pid in pids:
+        if not psutil.pid_exists(pid):
+            multiprocess.mark_process_dead(pid)
+
+
+def generate_metrics(db_manager) -> (bytes, str):
+    """Returns the exposition of all metrics and its content type."""
+    registry = CollectorRegistry()
+    registry.register(DatabaseStateCollector(db_manager))
+    if is_multiprocess():
+        _purge_dead_workers()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry), CONTENT_TYPE_LATEST
+    return generate_latest(REGISTRY) + generate_latest(registry), CONTENT_TYPE_LATEST
+
+
+def instrument_engine(engine) -> type(None):
+    """Times every statement executed through the SQLAlchemy engine."""
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('ps_query_start', []).append(time.perf_counter())
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        start = conn.info['ps_query_start'].pop()
+        DB_QUERY_SECONDS.labels(statement.split(None, 1)[0].upper()).observe(time.perf_counter() - start)
+
+    @event.listens_for(engine, 'handle_error')
+    def handle_error(exception_context):
+        # A failed statement has no after_cursor_execute, its start time would stay on the (pooled) connection.
+        starts = exception_context.connection.info.get('ps_query_start') if exception_context.connection else None
+        if starts:
+            starts.pop()
+
+
+@contextmanager
+def track_bridge_thread():
+    BRIDGE_THREADS.inc()
+    try:
+        yield
+    finally:
+        BRIDGE_THREADS.dec()
+
+
+def observe_file_upload(target: str, size: int, duration: float) -> type(None):
+    FILE_UPLOAD_SECONDS.labels(target).observe(duration)
+    if size and duration > 0:
+        FILE_UPLOAD_BYTES_PER_SECOND.labels(target).observe(size / duration)
+
+
+async def observe_tus_patch(request, call_next):
+    """HTTP middleware that times the tus PATCH requests."""
+    if request.method != 'PATCH' or not request.url.path.startswith('/files/'):
+        return await call_next(request)
+    start = time.perf_counter()
+    response = await call_next(request)
+    TUS_PATCH_SECONDS.labels(str(response.status_code)).observe(time.perf_counter() - start)
+    return response
@@ -66,6 +66,7 @@ class Target(BaseModel):
     - username (str): The username for authentication.
     - password (str): The password for authentication.
     - metadata (Metadata): Metadata associated with the target repository.
+    - compression_level (Optional[int]): Deflate level (0-9) for packages built for this target.
     """
     repo_name: str = Field(..., alias='repo-name')
     repo_display_name: str = Field(..., alias='repo-display-name')
@@ -77,6 +78,7 @@ class Target(BaseModel):
     metadata: Metadata
     initial_release_version: Optional[str] = Field(default=None, alias='initial-release-version')
     input: Optional[Input] = None
+    compression_level: Optional[int] = Field(default=None, alias='compression-level', ge=0, le=9)
 
 
 class FileConversion(BaseModel):
@@ -4,7 +4,7 @@ from datetime import datetime
 from enum import StrEnum, auto
 from typing import List, Optional
 
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, ConfigDict, Field
 
 from src.dbz import DepositStatus
 
@@ -38,15 +38,18 @@ class IdentifierItem(BaseModel):
 # print(i.protocol.value)
 
 class TargetResponse(BaseModel):
+    # Saved states are dumped by field name, the API uses the aliases.
+    model_config = ConfigDict(populate_by_name=True)
+
     url: Optional[str] = None
     status_code: int = Field(default=-10122004, alias='status-code')
     duration: float = 0.0
     status: Optional[str] = None
     error: Optional[str] = None
-    message: str = None
+    message: Optional[str] = None
     identifiers: Optional[List[IdentifierItem]] = None
-    content: str = None
-    content_type: ResponseContentType = Field(None, alias='content-type')
+    content: Optional[str] = None
+    content_type: Optional[ResponseContentType] = Field(None, alias='content-type')
 
 
 # # it = IdentifierItem()
@@ -56,6 +59,8 @@ class TargetResponse(BaseModel):
 
 
 class BridgeOutputDataModel(BaseModel):
+    model_config = ConfigDict(populate_by_name=True)
+
     deposit_time: Optional[str] = Field(datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S.%f"), alias='deposit-time')
     deposit_status: DepositStatus = Field(DepositStatus.UNDEFINED, alias='deposit-status')
     notes: Optional[str] = "" # This is for any message/text
@@ -15,6 +15,7 @@ import requests
 from simple_file_checksum import get_checksum
 from starlette import status
 
+from src import settings_snapshot
 from src.bridge import Bridge, BridgeOutputDataModel
 from src.commons import (
     settings,
@@ -22,10 +23,14 @@ from src.commons import (
     transform,
     logger,
     handle_deposit_exceptions, dmz_dataverse_headers, LOG_LEVEL_DEBUG, upload_large_file, zip_with_progress,
-    compress_zip_file, zip_a_zipfile_with_progress, escape_invalid_json_characters,
+    compress_zip_file, escape_invalid_json_characters,
 )
-from src.dbz import ReleaseVersion, DataFile, DepositStatus, FilePermissions, DataFileWorkState
+from src.dbz import ReleaseVersion, DataFile, DepositStatus, FilePermissions, DataFileWorkState, \
+    DATASET_CHECKPOINT
+from src.metrics import observe_file_upload
+from src.tracing import file_upload_span
 from src.models.bridge_output_model import IdentifierItem, IdentifierProtocol, TargetResponse, ResponseContentType
+from src.zipstream import StoredZipStream
 
 
 class DataverseIngester(Bridge):
@@ -47,8 +52,10 @@ class DataverseIngester(Bridge):
         for gf in generated_files:
             files_metadata.append({"name": gf.name, "mimetype": gf.mime_type,
                                    "private": True if gf.permissions == FilePermissions.PRIVATE else False})
+        # A resubmitted deposit regenerates the files, they are registered once.
+        registered = {df.name for df in db_manager.find_files(self.dataset_id)}
         if generated_files:
-            db_manager.insert_datafiles(generated_files)
+            db_manager.insert_datafiles([gf for gf in generated_files if gf.name not in registered])
         # Update the file-metadata: added some attributes
         md_json.update({"file-metadata": files_metadata})
         # updating mimetype of user's uploaded files since no mimetype in the form-metadata submission
@@ -77,13 +84,27 @@ class DataverseIngester(Bridge):
                 logger(f"Error: {e}", "error", self.app_name)
                 return BridgeOutputDataModel(notes="Error", deposit_status=DepositStatus.ERROR)
 
-        logger(f'deposit to "{self.target.target_url}"', "debug", self.app_name)
-        dv_response = requests.post(
-            f"{self.target.target_url}", headers=dmz_dataverse_headers('API_KEY', self.target.password),
-            data=str_dv_metadata
-        )
+        checkpoints = self.load_checkpoints()
+        draft = checkpoints.get(DATASET_CHECKPOINT)
+        if draft and not self.__draft_exists(draft.remote_id):
+            logger(f'The draft {draft.pid} of an earlier attempt is gone, starting over', "warning", self.app_name)
+            self.delete_checkpoints()
+            checkpoints, draft = {}, None
+        if draft:
+            logger(f'Resuming the deposit to {draft.pid}, {len(checkpoints) - 1} file(s) deposited before', "debug",
+                   self.app_name)
+            dv_status_code = status.HTTP_201_CREATED
+            dv_response_text = json.dumps({"status": "OK", "data": {"id": int(draft.remote_id),
+                                                                    "persistentId": draft.pid}})
+        else:
+            logger(f'deposit to "{self.target.target_url}"', "debug", self.app_name)
+            dv_response = requests.post(
+                f"{self.target.target_url}", headers=dmz_dataverse_headers('API_KEY', self.target.password),
+                data=str_dv_metadata
+            )
+            dv_status_code, dv_response_text = dv_response.status_code, dv_response.text
         logger(
-            f"dv_response.status_code: {dv_response.status_code} dv_response.text: {dv_response.text}",
+            f"dv_response.status_code: {dv_status_code} dv_response.text: {dv_response_text}",
             "debug",
             self.app_name,
         )
@@ -93,17 +114,19 @@ class DataverseIngester(Bridge):
         dataset_id = None
         identifier_items = []
         logger(f'Ingesting metadata {self.dataset_id} to {self.target.target_url}', "debug", self.app_name)
-        if dv_response.status_code == 201:
-            dv_response_json = dv_response.json()
+        if dv_status_code == 201:
+            dv_response_json = json.loads(dv_response_text)
             dataset_id = dv_response_json["data"]["id"]
             logger(f"Data ingest successfully! {json.dumps(dv_response_json)}", "debug", self.app_name)
             pid = dv_response_json["data"]["persistentId"]
+            if not draft:
+                self.save_checkpoint(DATASET_CHECKPOINT, remote_id=str(dataset_id), pid=pid)
             identifier_items.append(
                 IdentifierItem(value=pid, url=f'{self.target.base_url}/dataset.xhtml?persistentId={pid}',
                                protocol=IdentifierProtocol('doi')))
             logger(f"pid: {pid}", "debug", self.app_name)
 
-            ingest_file = self.__ingest_files(pid, str_updated_metadata_json)
+            ingest_file = self.__ingest_files(pid, str_updated_metadata_json, checkpoints)
             if ingest_file.get("status") == status.HTTP_200_OK:
                 ingest_status, message = DepositStatus.FINISH, "The dataset and its file is successfully ingested"
                 logger(f'Ingest FILE(s) successfully! {json.dumps(ingest_file)}', LOG_LEVEL_DEBUG, self.app_name)
@@ -114,26 +137,30 @@ class DataverseIngester(Bridge):
             else:
                 ingest_status, message = DepositStatus.ERROR, ingest_file.get("message")
         else:
-            logger(f"Ingest failed with status code {dv_response.status_code}:", "debug", self.app_name)
-            logger(f'Response:  {dv_response.text}', "debug", self.app_name)
+            logger(f"Ingest failed with status code {dv_status_code}:", "debug", self.app_name)
+            logger(f'Response:  {dv_response_text}', "debug", self.app_name)
             logger(f"Ingest metadata - str_dv_metadata {str_dv_metadata}", "debug", self.app_name)
             logger(f"Ingest metadata - str_updated_metadata_json {str_updated_metadata_json}", "debug", self.app_name)
             # TODO: DELETE DRAFT Dataverse dataset
             ingest_status, message = DepositStatus.ERROR, "Error"
 
-        if ingest_status == DepositStatus.ERROR:
-            # Delete Dataverse dataset
-            delete_response = requests.delete(f"{self.target.base_url}/api/datasets/{dataset_id}/versions/:draft",
-                            headers=dmz_dataverse_headers('API_KEY', self.target.password))
-            logger(f"delete_response.status_code: {delete_response.status_code} delete_response.text: {delete_response.text}", "debug", self.app_name)
+        if ingest_status == DepositStatus.ERROR and dataset_id is not None:
+            if settings.get("DATAVERSE_RESUMABLE_DEPOSITS", True):
+                logger(f'Draft {dataset_id} kept, /inbox/resubmit continues the deposit', "debug", self.app_name)
+            else:
+                # Delete Dataverse dataset
+                delete_response = requests.delete(f"{self.target.base_url}/api/datasets/{dataset_id}/versions/:draft",
+                                headers=dmz_dataverse_headers('API_KEY', self.target.password))
+                logger(f"delete_response.status_code: {delete_response.status_code} delete_response.text: {delete_response.text}", "debug", self.app_name)
+                self.delete_checkpoints()
 
         bridge_output_model = BridgeOutputDataModel(notes=message, deposit_status=ingest_status)
         current_time = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S.%f")
         bridge_output_model.deposit_time = current_time
         target_repo = TargetResponse(url=self.target.target_url, status=DepositStatus.FINISH, message=message,
-                                     identifiers=identifier_items, content=dv_response.text)
+                                     identifiers=identifier_items, content=dv_response_text)
         target_repo.content_type = ResponseContentType.JSON
-        target_repo.status_code = dv_response.status_code
+        target_repo.status_code = dv_status_code
         bridge_output_model = BridgeOutputDataModel(notes=message, response=target_repo)
         bridge_output_model.deposit_time = current_time
         bridge_output_model.deposit_status = ingest_status
@@ -158,86 +185,135 @@ class DataverseIngester(Bridge):
                     state=DataFileWorkState.GENERATED))
         return generated_files
 
-    def __ingest_files(self, pid: str, str_updated_metadata_json: str) -> dict:
+    def __draft_exists(self, dataset_id: str) -> bool:
+        response = requests.get(f"{self.target.base_url}/api/datasets/{dataset_id}",
+                                headers=dmz_dataverse_headers('API_KEY', self.target.password))
+        return response.status_code == status.HTTP_200_OK
+
+    def __delete_file(self, file_id: str) -> bool:
+        logger(f'Deleting file {file_id} of an earlier attempt, the file changed since', "debug", self.app_name)
+        response = requests.delete(f"{self.target.base_url}/api/files/{file_id}",
+                                   headers=dmz_dataverse_headers('API_KEY', self.target.password))
+        if response.status_code not in (status.HTTP_200_OK, status.HTTP_204_NO_CONTENT, status.HTTP_404_NOT_FOUND):
+            logger(f'Unable to delete file {file_id}: {response.status_code} {response.text}', "error", self.app_name)
+            return False
+        return True
+
+    def __ingest_files(self, pid: str, str_updated_metadata_json: str, checkpoints: dict) -> dict:
         logger(f'Ingesting files to {pid}', "debug", self.app_name)
         str_dv_file = transform(
             transformer_url=self.target.metadata.transformed_metadata[1].transformer_url,
             str_tobe_transformed=str_updated_metadata_json
         )
 
+        # Embargoes are set after the uploads, one call per date: {date: {file name: file id}}.
+        embargoes = {}
         for file in db_manager.find_non_generated_files(dataset_id=self.dataset_id):
             logger(f'Ingesting file {file.name}. Size: {file.size} Path: {file.path} ', "debug", self.app_name)
             jsonData = json.loads(str_dv_file).get(file.name)
-            if jsonData:
-                start = time.perf_counter()
-                data = {"jsonData": json.dumps(jsonData)}
-                if file.mime_type == "application/zip":
-                    real_file_path = os.readlink(file.path)
-                    zip_file_name = f'{os.path.dirname(real_file_path)}/{file.name}'
-                    # remove the symlink
-                    os.remove(file.path)
-                    os.rename(real_file_path, zip_file_name)
-                    logger(f'Start zipping file {file.name}. Real path: {zip_file_name}', LOG_LEVEL_DEBUG
-                           , self.app_name)
-                    zip_a_zipfile_with_progress(zip_file_name, file.path)
-                    os.remove(zip_file_name)
-                    logger(f'Finished zipping file {file.name} to {real_file_path} in '
-                           f'{round(time.perf_counter() - start, 2)} seconds', LOG_LEVEL_DEBUG, self.app_name)
-
-                url_base = f"{self.target.base_url}/api/datasets/:persistentId/add?persistentId={pid}"
-                headers = dmz_dataverse_headers('API_KEY', self.target.password)
-                timeout_seconds = settings.get("DATAVERSE_RESPONSE_TIMEOUT", 360000)
-                # file_path = file.path + '.zip' if file.mime_type == "application/zip" else file.path
-
-                response_ingest_file = None
-                logger(f'>>>> Start ingesting file {file.name}. Size: {file.size}. Ingest to {url_base}', "debug", self.app_name)
-                if file.size < settings.get("MAX_INGEST_SIZE_USING_PYTHON", 100000000):
-                    logger(f'++++ Ingest SMALL FILE using python: {file.name}', "debug", self.app_name)
-                    with open(file.path, 'rb') as f:
-                        files = {'file': (file.name, f)}
-                        response_ingest_file = requests.post(url_base, files=files, data=data, headers=headers, timeout= timeout_seconds)
-                        response_ingest_file = response_ingest_file.json()
-                        logger(f'>>>>>>>File {file.name} is successfully ingested', "debug", self.app_name)
-                else:
-                    logger(f'####### Ingest LARGE FILE using script: {file.name}', "debug", self.app_name)
-                    # Convert jsonData and headers to strings
-                    jsonData_str = json.dumps(jsonData)
-                    try:
-                        output = f'{settings.DATA_TMP_BASE_DIR}/{self.app_name}/{self.dataset_id}/{str(uuid.uuid4().int)}.txt'
-                        logger(f'>>>>>>>Output: {output}', "debug", self.app_name)
-                        # Execute the shell script with the parameters
-                        result = subprocess.run(
-                            [settings.SHELL_SCRIPT_PATH, file.path, url_base, jsonData_str, self.target.password, output],
-                            check=True,  # Raises a CalledProcessError if the command exits with a non-zero status
-                            text=True,  # Interprets stdout and stderr as text strings
-                            capture_output=True  # Captures the output (stdout and stderr)
-                        )
-                        logger(f'>>>>>>>File {file.name} is successfully ingested', "debug", self.app_name)
-                        logger(f'>>>>>>>Response: {result.stdout}', "debug", self.app_name)
-                        response_ingest_file = json.loads(result.stdout)
-                    except subprocess.CalledProcessError as e:
-                        logger(f'>>>>>>>File {file.name} is FAIL ingested', "error", self.app_name)
-                        logger(f'>>>>>>>Response: {e.stderr}', "error", self.app_name)
-                        return {"status": "error", "message": e.stderr}
-                    except Exception as e:
-                        logger(f'>>>>>>>File {file.name} is FAIL ingested', "error", self.app_name)
-                        logger(f'>>>>>>>Response: {e}', "error", self.app_name)
-                        return {"status": "error", "message": e}
-
-                logger(f'Finish ingesting file {file.name} to {pid} in {round(time.perf_counter() - start, 2)}'
-                       f' seconds.',"debug", self.app_name)
-
-                if jsonData.get('embargo'):
-                    json_data = {
-                        'dateAvailable': jsonData.get('embargo'),
-                        'reason': '',
-                        'fileIds': [response_ingest_file['data']['files'][0]['dataFile']['id']],
-                    }
-                    response_embargo = requests.post(
-                        f'{self.target.base_url}/api/datasets/:persistentId/files/actions/:set-embargo?persistentId={pid}',
-                        headers=dmz_dataverse_headers('API_KEY', self.target.password), json=json_data)
-                    if response_embargo.status_code != status.HTTP_200_OK:
-                        return {"status": "error", "message": response_embargo.text}
+            checkpoint = checkpoints.get(file.name)
+            if checkpoint and checkpoint.remote_id and checkpoint.checksum == file.checksum_value:
+                logger(f'File {file.name} was deposited before as {checkpoint.remote_id}', "debug", self.app_name)
+                file_id = checkpoint.remote_id
+            elif jsonData:
+                if checkpoint and checkpoint.remote_id and not self.__delete_file(checkpoint.remote_id):
+                    # Uploading anyway would keep both versions in the draft, the new one renamed to name-1.ext.
+                    return {"status": "error", "message": f'Unable to delete {checkpoint.remote_id}, the earlier '
+                                                          f'version of the changed file {file.name}'}
+                with file_upload_span(self.target.repo_name, file.name, file.size):
+                    start = time.perf_counter()
+                    data = {"jsonData": json.dumps(jsonData)}
+                    url_base = f"{self.target.base_url}/api/datasets/:persistentId/add?persistentId={pid}"
+                    headers = dmz_dataverse_headers('API_KEY', self.target.password)
+                    timeout_seconds = settings_snapshot.current.DATAVERSE_RESPONSE_TIMEOUT
+                    # file_path = file.path + '.zip' if file.mime_type == "application/zip" else file.path
+
+                    response_ingest_file = None
+                    logger(f'>>>> Start ingesting file {file.name}. Size: {file.size}. Ingest to {url_base}', "debug", self.app_name)
+                    if file.mime_type == "application/zip":
+                        # Dataverse unpacks uploaded zips. To keep the zip as it is, it is wrapped in a zip that is
+                        # encoded on the fly while uploading, so the file is read once and no copy is written.
+                        logger(f'++++ Ingest ZIP FILE wrapped in a streamed zip: {file.name}', "debug", self.app_name)
+                        response = upload_large_file(url_base, file.path, data, self.target.password, file.name,
+                                                     fileobj=StoredZipStream(os.path.realpath(file.path), file.name),
+                                                     timeout=timeout_seconds)
+                        if response.status_code != status.HTTP_200_OK:
+                            logger(f'>>>>>>>File {file.name} is FAIL ingested: {response.text}', "error", self.app_name)
+                            return {"status": "error", "message": response.text}
+                        response_ingest_file = response.json()
+                        logger(f'>>>>>>>File {file.name} is successfully ingested in '
+                               f'{round(time.perf_counter() - start, 2)} seconds', "debug", self.app_name)
+                    elif file.size < settings_snapshot.current.MAX_INGEST_SIZE_USING_PYTHON:
+                        logger(f'++++ Ingest SMALL FILE using python: {file.name}', "debug", self.app_name)
+                        with open(file.path, 'rb') as f:
+                            files = {'file': (file.name, f)}
+                            response_ingest_file = requests.post(url_base, files=files, data=data, headers=headers, timeout= timeout_seconds)
+                            if response_ingest_file.status_code != status.HTTP_200_OK:
+                                logger(f'>>>>>>>File {file.name} is FAIL ingested: {response_ingest_file.text}', "error",
+                                       self.app_name)
+                                return {"status": "error", "message": response_ingest_file.text}
+                            response_ingest_file = response_ingest_file.json()
+                            logger(f'>>>>>>>File {file.name} is successfully ingested', "debug", self.app_name)
+                    else:
+                        logger(f'####### Ingest LARGE FILE using script: {file.name}', "debug", self.app_name)
+                        # Convert jsonData and headers to strings
+                        jsonData_str = json.dumps(jsonData)
+                        try:
+                            output = f'{settings.DATA_TMP_BASE_DIR}/{self.app_name}/{self.dataset_id}/{str(uuid.uuid4().int)}.txt'
+                            logger(f'>>>>>>>Output: {output}', "debug", self.app_name)
+                            # Execute the shell script with the parameters
+                            result = subprocess.run(
+                                [settings.SHELL_SCRIPT_PATH, file.path, url_base, jsonData_str, self.target.password, output],
+                                check=True,  # Raises a CalledProcessError if the command exits with a non-zero status
+                                text=True,  # Interprets stdout and stderr as text strings
+                                capture_output=True  # Captures the output (stdout and stderr)
+                            )
+                            logger(f'>>>>>>>File {file.name} is successfully ingested', "debug", self.app_name)
+                            logger(f'>>>>>>>Response: {result.stdout}', "debug", self.app_name)
+                            response_ingest_file = json.loads(result.stdout)
+                        except subprocess.CalledProcessError as e:
+                            logger(f'>>>>>>>File {file.name} is FAIL ingested', "error", self.app_name)
+                            logger(f'>>>>>>>Response: {e.stderr}', "error", self.app_name)
+                            return {"status": "error", "message": e.stderr}
+                        except Exception as e:
+                            logger(f'>>>>>>>File {file.name} is FAIL ingested', "error", self.app_name)
+                            logger(f'>>>>>>>Response: {e}', "error", self.app_name)
+                            return {"status": "error", "message": e}
+
+                    logger(f'Finish ingesting file {file.name} to {pid} in {round(time.perf_counter() - start, 2)}'
+                           f' seconds.',"debug", self.app_name)
+                    observe_file_upload(self.target.repo_name, file.size, time.perf_counter() - start)
+                file_id = str(response_ingest_file['data']['files'][0]['dataFile']['id'])
+                self.save_checkpoint(file.name, remote_id=file_id, checksum=file.checksum_value)
+                checkpoint = None
+            else:
+                continue
+
+            if jsonData and jsonData.get('embargo') and not (checkpoint and checkpoint.embargo == jsonData['embargo']):
+                embargoes.setdefault(jsonData['embargo'], {})[file.name] = file_id
+
+        return self.__set_embargoes(pid, embargoes)
+
+    def __set_embargoes(self, pid: str, embargoes: dict) -> dict:
+        # The endpoint takes a list of file ids, batched by DATAVERSE_EMBARGO_BATCH_SIZE.
+        batch_size = settings.get("DATAVERSE_EMBARGO_BATCH_SIZE", 500)
+        for date_available, files in embargoes.items():
+            names = list(files)
+            for i in range(0, len(names), batch_size):
+                batch = names[i:i + batch_size]
+                logger(f'Embargo until {date_available} for {len(batch)} file(s)', "debug", self.app_name)
+                json_data = {
+                    'dateAvailable': date_available,
+                    'reason': '',
+                    'fileIds': [int(files[name]) for name in batch],
+                }
+                response_embargo = requests.post(
+                    f'{self.target.base_url}/api/datasets/:persistentId/files/actions/:set-embargo?persistentId={pid}',
+                    headers=dmz_dataverse_headers('API_KEY', self.target.password), json=json_data)
+                if response_embargo.status_code != status.HTTP_200_OK:
+                    return {"status": "error", "message": response_embargo.text}
+                for name in batch:
+                    self.save_checkpoint(name, embargo=date_available)
 
         return {"status": status.HTTP_200_OK}
 
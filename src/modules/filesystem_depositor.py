@@ -1,13 +1,49 @@
 from __future__ import annotations
 
+import os
+from datetime import datetime
+from urllib.parse import urlparse
+
+from src.bag_builder import BagBuilder
 from src.bridge import Bridge
-from src.models.bridge_output_model import BridgeOutputDataModel
+from src.commons import transform, logger, handle_deposit_exceptions, db_manager, LOG_LEVEL_DEBUG
+from src.dbz import DataFile, DataFileWorkState, DepositStatus
+from src.models.bridge_output_model import BridgeOutputDataModel, TargetResponse, ResponseContentType
 
 
 class FileSystem(Bridge):
 
+    @handle_deposit_exceptions
     def deposit(self) -> BridgeOutputDataModel:
+        tag_files = {}
+        data_files = list(db_manager.find_uploaded_files(self.dataset_id))
+        for gnr_file in self.target.metadata.transformed_metadata:
+            content = transform(gnr_file.transformer_url,
+                                self.metadata_rec.md) if gnr_file.transformer_url else self.metadata_rec.md
+            if gnr_file.target_dir:  # e.g. "metadata", a tag directory of the bag
+                tag_files[os.path.join(gnr_file.target_dir, gnr_file.name)] = content
+                continue
+            gf_path = os.path.join(self.dataset_dir, gnr_file.name)
+            with open(gf_path, "wt") as f:
+                f.write(content)
+            data_files.append(DataFile(ds_id=self.dataset_id, name=gnr_file.name, path=gf_path,
+                                       size=os.path.getsize(gf_path), state=DataFileWorkState.GENERATED))
 
-        bridge_output_model = BridgeOutputDataModel()
+        bag_builder = BagBuilder(self.dataset_id)
+        bag_dir = bag_builder.build(data_files, tag_files, {"Source-Organization": self.app_name})
+        location = bag_dir
+        # A file:// url or absolute path as target-url is the directory the zipped bag is delivered to.
+        destination_dir = urlparse(self.target.target_url).path if self.target.target_url else ''
+        if destination_dir and os.path.isdir(destination_dir):
+            location = bag_builder.write_zip(os.path.join(destination_dir, f'{self.dataset_id}.zip'),
+                                             self.target.compression_level)
+            bag_builder.remove()
+        logger(f'Bag of {self.dataset_id} is available at {location}', LOG_LEVEL_DEBUG, self.app_name)
 
+        target_response = TargetResponse(url=self.target.target_url, status=DepositStatus.FINISH,
+                                         message=f'Bag is available at {location}', content=location)
+        target_response.content_type = ResponseContentType.TEXT
+        bridge_output_model = BridgeOutputDataModel(notes="Bag is created successfully.", response=target_response)
+        bridge_output_model.deposit_status = DepositStatus.FINISH
+        bridge_output_model.deposit_time = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S.%f")
         return bridge_output_model
@@ -1,18 +1,50 @@
 from __future__ import annotations
 
 import json
-from time import sleep
 
 import jmespath
 import requests
 
 from src.bridge import Bridge
-from src.commons import logger, settings, LOG_LEVEL_DEBUG
+from src.commons import logger, settings, LOG_LEVEL_DEBUG, LOG_NAME_PS
 from src.dbz import DepositStatus
 from src.models.bridge_output_model import BridgeOutputDataModel, TargetResponse, ResponseContentType, IdentifierItem, \
     IdentifierProtocol
 
 
+def parse_save_request(rsp: requests.Response) -> dict:
+    """Parser of the poll of a save code now request: the status json, None while it is not available."""
+    if rsp.status_code != 200:
+        logger(f'{rsp.url} status code: {rsp.status_code}', LOG_LEVEL_DEBUG, LOG_NAME_PS)
+        return None
+    swh_resp_json = rsp.json()
+    logger(f'{rsp.url} response: {json.dumps(swh_resp_json)}', LOG_LEVEL_DEBUG, LOG_NAME_PS)
+    return swh_resp_json
+
+
+def is_save_request_done(swh_resp_json: dict) -> bool:
+    return bool(swh_resp_json) and (swh_resp_json.get('save_task_status') == DepositStatus.FAILED
+                                    or bool(swh_resp_json.get('snapshot_swhid')))
+
+
+def save_request_output(swh_resp_json: dict, swh_url: str) -> BridgeOutputDataModel:
+    target_response = TargetResponse()
+    bridge_output_model = BridgeOutputDataModel(response=target_response)
+    if swh_resp_json.get('save_task_status') == DepositStatus.FAILED:
+        bridge_output_model.deposit_status = DepositStatus.FAILED
+        logger(f"save_task_status is failed.", 'error', LOG_NAME_PS)
+        return bridge_output_model
+
+    bridge_output_model.deposit_status = DepositStatus.FINISH
+    target_response.status_code = 200
+    target_response.content_type = ResponseContentType.JSON
+    target_response.content = json.dumps(swh_resp_json)
+    target_response.status = DepositStatus.SUCCESS
+    target_response.identifiers = [IdentifierItem(value=swh_resp_json.get('snapshot_swhid'), url=swh_url,
+                                                  protocol=IdentifierProtocol('swhid'))]
+    return bridge_output_model
+
+
 class SwhApiDepositor(Bridge):
 
     def deposit(self) -> BridgeOutputDataModel:
@@ -30,36 +62,10 @@ class SwhApiDepositor(Bridge):
         if api_resp.status_code == 200:
             api_resp_json = api_resp.json()
             logger(f'swh_api response json: {json.dumps(api_resp_json)}', LOG_LEVEL_DEBUG, self.app_name)
-            goto_sleep = False
-            counter = 0  # TODO: Refactor using Tenancy!
-            while True and (counter < settings.SWH_API_MAX_RETRIES):
-                counter += 1
-                swh_check_url = api_resp_json.get("request_url")
-                check_resp = requests.get(swh_check_url, headers=headers)
-                if check_resp.status_code == 200:
-                    swh_resp_json = check_resp.json()
-                    logger(f'{swh_check_url} response: {json.dumps(swh_resp_json)}', LOG_LEVEL_DEBUG, self.app_name)
-                    if swh_resp_json.get('save_task_status') == DepositStatus.FAILED:
-                        bridge_output_model.deposit_status = DepositStatus.FAILED
-                        logger(f"save_task_status is failed.", 'error', self.app_name)
-                        break
-                    elif swh_resp_json.get('snapshot_swhid'):
-                        bridge_output_model.deposit_status = DepositStatus.FINISH
-                        target_response.status_code = check_resp.status_code
-                        target_response.content_type = ResponseContentType.JSON
-                        target_response.content = json.dumps(swh_resp_json)
-                        target_response.status = DepositStatus.SUCCESS
-                        identifier_items = []
-                        target_response.identifiers = identifier_items
-                        ideni = IdentifierItem(value=swh_resp_json.get('snapshot_swhid'), url=swh_url,
-                                               protocol=IdentifierProtocol('swhid'))
-                        identifier_items.append(ideni)
-                        break
-                    else:
-                        goto_sleep = True
-                if goto_sleep:
-                    sleep(settings.SWH_DELAY_POLLING)
-
+            target_response.url = swh_url
+            return self.submit(bridge_output_model, api_resp_json.get("request_url"),
+                               f'{__name__}.parse_save_request', f'{__name__}.is_save_request_done', headers=headers,
+                               interval=settings.SWH_DELAY_POLLING, max_attempts=settings.SWH_API_MAX_RETRIES)
         else:
             logger(f'ERROR api_resp.status_code: {api_resp.status_code}', LOG_LEVEL_DEBUG, self.app_name)
             target_response.status_code = api_resp.status_code
@@ -73,3 +79,9 @@ class SwhApiDepositor(Bridge):
                    self.app_name)
 
         return bridge_output_model
+
+    def complete(self, submitted: BridgeOutputDataModel, swh_resp_json: dict) -> BridgeOutputDataModel:
+        """The save request status, of the callback or of the poll."""
+        if not is_save_request_done(swh_resp_json):
+            raise ValueError(f'Save request of {submitted.response.url} not done: {swh_resp_json}')
+        return save_request_output(swh_resp_json, submitted.response.url)
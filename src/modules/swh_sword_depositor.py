@@ -2,15 +2,39 @@ from __future__ import annotations
 
 import json
 from datetime import datetime
-from time import sleep
 
 import requests
 import sword2.deposit_receipt as dr
-from requests.auth import HTTPBasicAuth
 
 from src.bridge import Bridge
-from src.commons import settings, DepositStatus, transform, logger, db_manager, LOG_LEVEL_DEBUG
+from src.commons import settings, DepositStatus, transform, logger, db_manager, LOG_LEVEL_DEBUG, LOG_NAME_PS
 from src.models.bridge_output_model import BridgeOutputDataModel, TargetResponse
+from src.poll_scheduler import PollFailed
+
+
+def parse_deposit_status(rsp: requests.Response) -> dict:
+    """Parser of the poll of a SWORD deposit: the deposit status of the receipt and the receipt."""
+    if rsp.status_code != 200:
+        raise PollFailed(f'Error request to {rsp.url} with rsp.status_code: {rsp.status_code} and '
+                         f'rsp.text: {rsp.text}')
+    logger(f'response from {rsp.url} is {rsp.text}', LOG_LEVEL_DEBUG, LOG_NAME_PS)
+    swh_deposit_status = dr.Deposit_Receipt(xml_deposit_receipt=rsp.text).metadata.get('atom_deposit_status')
+    return {"status": str(swh_deposit_status[0]) if swh_deposit_status else None, "receipt": rsp.text}
+
+
+def is_deposited(deposit_status: dict) -> bool:
+    return deposit_status["status"] == DepositStatus.DEPOSITED
+
+
+def deposit_output(deposit_status: dict, status_url: str) -> BridgeOutputDataModel:
+    rsp_text = deposit_status["receipt"]
+    target_repo = TargetResponse(url=status_url, status=DepositStatus.FINISH, message=rsp_text, content=rsp_text)
+    target_repo.status_code = 200
+    bridge_output_model = BridgeOutputDataModel()
+    bridge_output_model.deposit_status = DepositStatus.FINISH
+    bridge_output_model.response = target_repo
+    bridge_output_model.deposit_time = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S.%f")
+    return bridge_output_model
 
 
 class SwhSwordDepositor(Bridge):
@@ -33,7 +57,7 @@ class SwhSwordDepositor(Bridge):
         headers = {
             'Content-Type': 'application/atom+xml;type=entry',
         }
-        auth = HTTPBasicAuth(settings.swh_sword_username, settings.swh_sword_password)
+        auth = (settings.swh_sword_username, settings.swh_sword_password)
         response = requests.post(self.target.target_url, headers=headers, auth=auth, data=str_sword_payload)
         logger(f'status_code: {response.status_code}. Response: {response.text}', "debug", self.app_name)
         if response.status_code == 200 or response.status_code == 201:  # TODO: remove 200, use only 201
@@ -42,33 +66,18 @@ class SwhSwordDepositor(Bridge):
             deposit_response = dr.Deposit_Receipt(xml_deposit_receipt=rt)
             status_url = deposit_response.alternate
             logger(f'Status request send to {status_url}', LOG_LEVEL_DEBUG, self.app_name)
-            counter = 0
-            while True and (counter < settings.swh_api_max_retries):
-                counter += 1
-                sleep(settings.swh_delay_polling_sword)
-                rsp = requests.get(status_url, headers=headers, auth=auth)
-                if rsp.status_code == 200:
-                    rsp_text = rsp.text
-                    logger(f'response from {status_url} is {rsp_text}', LOG_LEVEL_DEBUG, self.app_name)
-                    rsp_dep = dr.Deposit_Receipt(xml_deposit_receipt=rsp_text)
-                    print(rsp_dep.metadata)
-                    swh_metadata = rsp_dep.metadata
-                    swh_deposit_status = swh_metadata.get('atom_deposit_status')
-                    if swh_deposit_status and swh_deposit_status[0] == DepositStatus.DEPOSITED:
-                        target_repo = TargetResponse(url=self.target.target_url, status=DepositStatus.FINISH,
-                                                     message=rsp_text, content=rsp_text)
-                        target_repo.url = status_url
-                        target_repo.status_code = rsp.status_code
-                        target_repo.content = rsp_text
-                        bridge_output_model.deposit_status = DepositStatus.FINISH
-                        bridge_output_model.response = target_repo
-                        bridge_output_model.deposit_time = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S.%f")
-                        return bridge_output_model
-
-                else:
-                    raise ValueError(f'Error request to {status_url} with rsp.status_code: {rsp.status_code} and '
-                                     f'rsp.text: {rsp.text}')
+            bridge_output_model.response = TargetResponse(url=status_url)
+            return self.submit(bridge_output_model, status_url, f'{__name__}.parse_deposit_status',
+                               f'{__name__}.is_deposited', headers=headers, auth=auth,
+                               interval=settings.swh_delay_polling_sword, max_attempts=settings.swh_api_max_retries,
+                               first_delay=settings.swh_delay_polling_sword)
         else:
             bridge_output_model.deposit_status = DepositStatus.ERROR
             bridge_output_model.notes = response.text
         return bridge_output_model
+
+    def complete(self, submitted: BridgeOutputDataModel, deposit_status: dict) -> BridgeOutputDataModel:
+        """The deposit status (and receipt) of the poll, or of the callback."""
+        if not is_deposited(deposit_status):
+            raise ValueError(f'Deposit {submitted.response.url} not deposited: {deposit_status["status"]}')
+        return deposit_output(deposit_status, submitted.response.url)
@@ -1,26 +1,84 @@
 from __future__ import annotations
 
+import hashlib
 import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from typing import List
 
 import requests
 from pydantic import BaseModel
 from starlette import status
+from tenacity import Retrying, retry_if_exception, stop_after_attempt, wait_exponential
 
 from src.bridge import Bridge
-from src.commons import transform, logger, handle_deposit_exceptions, db_manager, LOG_LEVEL_DEBUG
-from src.dbz import DepositStatus
+from src.commons import settings, transform, logger, handle_deposit_exceptions, db_manager, LOG_LEVEL_DEBUG
+from src.dbz import DataFile, DepositStatus, DATASET_CHECKPOINT
+from src.metrics import observe_file_upload
+from src.tracing import file_upload_span, in_current_context
 from src.models.bridge_output_model import BridgeOutputDataModel, TargetResponse, ResponseContentType, IdentifierItem
 
+# Bucket PUTs with these status codes are retried, other errors fail the file right away.
+RETRY_STATUS_CODES = (408, 429, 500, 502, 503, 504)
+
+
+class ZenodoUploadError(Exception):
+    def __init__(self, message: str, retry: bool = True):
+        super().__init__(message)
+        self.retry = retry
+
+
+class HashingReader:
+    """
+    File reader that computes the md5 of what is sent and reports the progress every 5%. It has a length, so requests
+    streams it with a Content-Length instead of a chunked body.
+    """
+
+    def __init__(self, fp, size: int, on_progress):
+        self.fp = fp
+        self.size = size
+        self.sent = 0
+        self.reported = 0
+        self.md5 = hashlib.md5()
+        self.on_progress = on_progress
+
+    def __len__(self) -> int:
+        return self.size
+
+    def __iter__(self):
+        return iter(lambda: self.read(1024 * 1024), b'')
+
+    def read(self, size: int = -1) -> bytes:
+        chunk = self.fp.read(size)
+        self.md5.update(chunk)
+        self.sent += len(chunk)
+        if self.sent - self.reported >= self.size / 20 or (not chunk and self.reported < self.sent):
+            self.reported = self.sent
+            self.on_progress(self.sent / self.size * 100 if self.size else 100)
+        return chunk
+
+
+def _is_retriable(e: BaseException) -> bool:
+    return isinstance(e, requests.RequestException) or (isinstance(e, ZenodoUploadError) and e.retry)
+
 
 class ZenodoApiDepositor(Bridge):
     @handle_deposit_exceptions
     def deposit(self) -> BridgeOutputDataModel:
-        zenodo_resp = self.__create_initial_dataset()
-        if zenodo_resp is None:
-            return BridgeOutputDataModel(notes="Error occurs: status code: 500", deposit_status=DepositStatus.ERROR)
-        zenodo_id = zenodo_resp.get("id")
+        checkpoints = self.load_checkpoints()
+        draft = checkpoints.get(DATASET_CHECKPOINT)
+        if draft:
+            zenodo_id = draft.remote_id
+            logger(f'Resuming the deposit to {zenodo_id}, {len(checkpoints) - 1} file(s) uploaded before',
+                   LOG_LEVEL_DEBUG, self.app_name)
+        else:
+            zenodo_resp = self.__create_initial_dataset()
+            if zenodo_resp is None:
+                return BridgeOutputDataModel(notes="Error occurs: status code: 500", deposit_status=DepositStatus.ERROR)
+            zenodo_id = zenodo_resp.get("id")
+            self.save_checkpoint(DATASET_CHECKPOINT, remote_id=str(zenodo_id))
         str_zenodo_dataset_metadata = transform(self.target.metadata.transformed_metadata[0].transformer_url,
                                                 self.metadata_rec.md)
 
@@ -29,6 +87,10 @@ class ZenodoApiDepositor(Bridge):
         zen_resp = requests.put(url, data=str_zenodo_dataset_metadata, headers={"Content-Type": "application/json"})
         logger(f'Zenodo response status code: {zen_resp.status_code}. Zenodo response: {zen_resp.text}',
                LOG_LEVEL_DEBUG, self.app_name)
+        if draft and zen_resp.status_code == status.HTTP_404_NOT_FOUND:
+            logger(f'The deposition {zenodo_id} of an earlier attempt is gone, starting over', 'warning', self.app_name)
+            self.delete_checkpoints()
+            return self.deposit()
         bridge_output_model = BridgeOutputDataModel()
         if zen_resp.status_code != status.HTTP_200_OK:
             logger(f'Error occurs: status code: {zen_resp.status_code}', 'error', self.app_name)
@@ -39,7 +101,14 @@ class ZenodoApiDepositor(Bridge):
             bridge_output_model.deposit_status = DepositStatus.ERROR
             return bridge_output_model
         zm = ZenodoModel(**zen_resp.json())
-        self.__ingest_files(zm.links.bucket)
+        failed = self.__ingest_files(zm.links.bucket, checkpoints)
+        if failed:
+            bridge_output_model.deposit_status = DepositStatus.ERROR
+            bridge_output_model.notes = f'Upload of {len(failed)} file(s) to Zenodo failed: {json.dumps(failed)}'
+            bridge_output_model.deposit_time = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S.%f")
+            bridge_output_model.response = TargetResponse(url=f'{self.target.target_url}/{zenodo_id}',
+                                                          status=DepositStatus.ERROR, error=json.dumps(failed))
+            return bridge_output_model
         bridge_output_model.deposit_status = DepositStatus.SUCCESS
         bridge_output_model.notes = "Successfully deposited to Zenodo."
         bridge_output_model.deposit_time = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S.%f")
@@ -60,16 +129,80 @@ class ZenodoApiDepositor(Bridge):
         logger(f"Response status code: {response.status_code}", LOG_LEVEL_DEBUG, self.app_name)
         return response.json() if response.status_code == 201 else None
 
-    def __ingest_files(self, bucket_url: str) -> dict:
-        logger(f'Ingesting files to {bucket_url}', "debug", self.app_name)
+    def __ingest_files(self, bucket_url: str, checkpoints: dict) -> dict:
+        """
+        PUTs the files to the bucket, ZENODO_UPLOAD_WORKERS at a time, each streamed from disk. The files uploaded by
+        an earlier attempt (same checksum) are skipped.
+
+        A file is retried (ZENODO_UPLOAD_MAX_ATTEMPTS) on connection errors, 408/429/5xx responses and a checksum
+        that does not match the md5 of what was sent.
+
+        Returns:
+            dict: The error of every file that failed, by file name.
+        """
+        files = [file for file in db_manager.find_non_generated_files(dataset_id=self.dataset_id)
+                 if not (file.name in checkpoints and checkpoints[file.name].checksum == file.checksum_value)]
+        logger(f'Ingesting {len(files)} files to {bucket_url}', LOG_LEVEL_DEBUG, self.app_name)
+        total_size = sum(file.size or 0 for file in files)
+        done_files, done_bytes = 0, 0
+        failed = {}
+        with ThreadPoolExecutor(max_workers=settings.get("ZENODO_UPLOAD_WORKERS", 4),
+                                thread_name_prefix='zenodo-upload') as pool:
+            futures = {pool.submit(in_current_context(self.__upload_file), bucket_url, file): file for file in files}
+            for future, file in futures.items():
+                try:
+                    future.result()
+                except Exception as e:
+                    logger(f'Upload of {file.name} to {bucket_url} failed: {e}', 'error', self.app_name)
+                    failed[file.name] = str(e)
+                    continue
+                done_files += 1
+                done_bytes += file.size or 0
+                logger("Zenodo upload progress: %d of %d files, %d of %d bytes", LOG_LEVEL_DEBUG, self.app_name,
+                       done_files, len(files), done_bytes, total_size, progress=bucket_url)
+        return failed
+
+    def __upload_file(self, bucket_url: str, file: DataFile) -> dict:
+        retrying = Retrying(stop=stop_after_attempt(settings.get("ZENODO_UPLOAD_MAX_ATTEMPTS", 3)),
+                            wait=wait_exponential(multiplier=settings.get("ZENODO_UPLOAD_RETRY_WAIT", 2), max=60),
+                            retry=retry_if_exception(_is_retriable), reraise=True)
+        for attempt in retrying:
+            with attempt:
+                if attempt.retry_state.attempt_number > 1:
+                    logger(f'Retrying the upload of {file.name}, attempt {attempt.retry_state.attempt_number}',
+                           'warning', self.app_name)
+                return self.__put_file(bucket_url, file)
+
+    def __put_file(self, bucket_url: str, file: DataFile) -> dict:
+        # The path of a file includes its name.
+        size = file.size or os.path.getsize(file.path)
+        logger(f'Ingesting file {file.path}', LOG_LEVEL_DEBUG, self.app_name)
         params = {'access_token': self.target.password, 'access_right': 'restricted'}
-        for file in db_manager.find_non_generated_files(dataset_id=self.dataset_id):
-            file_path = f"{file.path}/{file.name}"
-            logger(f'Ingesting file {file_path}', "debug", self.app_name)
-            with open(file_path, "rb") as fp:
-                response = requests.put(f"{bucket_url}/{file.name}", data=fp, params=params)
-            logger(f"Response status code: {response.status_code} and message: {response.text}", LOG_LEVEL_DEBUG, self.app_name)
-        return {"status": status.HTTP_200_OK}
+        start = time.perf_counter()
+        with file_upload_span(self.target.repo_name, file.name, size), open(file.path, "rb") as fp:
+            reader = HashingReader(fp, size, lambda percentage: logger(
+                "Upload progress of %s: %.0f%%", LOG_LEVEL_DEBUG, self.app_name, file.name, percentage,
+                progress=file.path))
+            response = requests.put(f"{bucket_url}/{file.name}", data=reader, params=params,
+                                    timeout=settings.get("ZENODO_UPLOAD_TIMEOUT", 3600))
+        observe_file_upload(self.target.repo_name, size, time.perf_counter() - start)
+        logger(f"Response status code: {response.status_code} and message: {response.text}", LOG_LEVEL_DEBUG,
+               self.app_name)
+        if response.status_code not in (status.HTTP_200_OK, status.HTTP_201_CREATED):
+            raise ZenodoUploadError(f'{response.status_code} {response.text}',
+                                    retry=response.status_code in RETRY_STATUS_CODES)
+        md5 = reader.md5.hexdigest()
+        if file.checksum_value and file.checksum_value != md5:
+            # The file changed on disk, sending it again would not help.
+            raise ZenodoUploadError(f'The md5 of what was sent ({md5}) differs from the one at upload '
+                                    f'({file.checksum_value})', retry=False)
+        uploaded = response.json()
+        checksum = uploaded.get("checksum")
+        if checksum and checksum != f'md5:{md5}':
+            raise ZenodoUploadError(f'Zenodo checksum {checksum} does not match md5:{md5}')
+        self.save_checkpoint(file.name, remote_id=uploaded.get("version_id") or uploaded.get("key"),
+                             checksum=file.checksum_value)
+        return uploaded
 
 
 class PrereserveDoi(BaseModel):
@@ -0,0 +1,200 @@
+"""
+Background collector for orphaned upload and working files.
+
+It walks ``DATA_TMP_BASE_TUS_FILES_DIR`` and the dataset directories in ``DATA_TMP_BASE_DIR`` incrementally,
+``ORPHAN_COLLECTOR_BATCH_SIZE`` entries per run, and removes entries older than ``ORPHAN_COLLECTOR_TTL`` that no
+live dataset or ``DataFile`` refers to:
+
+- abandoned tus uploads (``<uuid>`` + ``<uuid>.info`` + ``<uuid>.lock``) and ``.info`` files whose DELETE failed,
+- symlink targets ``<uuid>-<dataset_id>.<app_name>`` of deleted datasets,
+- dataset directories of deleted datasets,
+- bags (``bags/<dataset_id>``) of deleted datasets and of datasets of which all targets are finished,
+- ``<uuid>.txt`` outputs of ``ingest.sh``.
+"""
+import os
+import re
+import shutil
+import threading
+import time
+from datetime import datetime
+
+from src.commons import settings, db_manager, logger, LOG_LEVEL_DEBUG, LOG_NAME_PS
+from src.disk_space import disk_space
+from src.metrics import ORPHAN_RECLAIMED_BYTES
+
+TUS_UPLOAD_PATTERN = re.compile(r'^(?P<uuid>[0-9a-f]{32})(?P<suffix>\.info|\.lock)?$')
+TUS_TARGET_PATTERN = re.compile(r'^(?P<uuid>[0-9a-f]{32})-(?P<dataset_id>.+)\.(?P<app_name>[^.]+)$')
+INGEST_OUTPUT_PATTERN = re.compile(r'^\d+\.txt$')
+# Directories in DATA_TMP_BASE_DIR that are not application directories.
+NON_APP_DIRS = ('bags', 'zips', 'uploads', 'sword', 'profiles', 'locks')
+BAGS_DIR = 'bags'
+
+
+def _size_of(path: str) -> int:
+    if os.path.islink(path) or not os.path.isdir(path):
+        return os.lstat(path).st_size
+    return sum(os.lstat(os.path.join(root, name)).st_size for root, _, names in os.walk(path) for name in names)
+
+
+def _age_of(*paths: str) -> float:
+    mtimes = [os.lstat(p).st_mtime for p in paths if os.path.lexists(p)]
+    return time.time() - max(mtimes) if mtimes else 0.0
+
+
+class OrphanCollector:
+    def __init__(self, tus_dir: str, data_dir: str):
+        self.tus_dir = tus_dir
+        self.data_dir = data_dir
+        self._walker = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self.stats = {"runs": 0, "passes": 0, "removed-items": 0, "reclaimed-bytes": 0, "last-run": None}
+
+    def _candidates(self):
+        if os.path.isdir(self.tus_dir):
+            with os.scandir(self.tus_dir) as entries:
+                for entry in entries:
+                    yield self._check_tus_entry, entry.path
+        skip_dirs = {os.path.realpath(self.tus_dir)} | {os.path.join(self.data_dir, d) for d in NON_APP_DIRS}
+        with os.scandir(self.data_dir) as app_entries:
+            for app_entry in app_entries:
+                if not app_entry.is_dir(follow_symlinks=False) or os.path.realpath(app_entry.path) in skip_dirs:
+                    continue
+                with os.scandir(app_entry.path) as dataset_entries:
+                    for dataset_entry in dataset_entries:
+                        if dataset_entry.is_dir(follow_symlinks=False):
+                            yield self._check_dataset_dir, dataset_entry.path
+        bags_dir = os.path.join(self.data_dir, BAGS_DIR)
+        if os.path.isdir(bags_dir):
+            with os.scandir(bags_dir) as bag_entries:
+                for bag_entry in bag_entries:
+                    if bag_entry.is_dir(follow_symlinks=False):
+                        yield self._check_bag_dir, bag_entry.path
+
+    def _check_tus_entry(self, path: str, ttl: int) -> int:
+        name = os.path.basename(path)
+        upload = TUS_UPLOAD_PATTERN.match(name)
+        if upload:
+            bin_path = os.path.join(self.tus_dir, upload['uuid'])
+            paths = [bin_path, f'{bin_path}.info', f'{bin_path}.lock']
+            # Handle every upload once, through its first existing file.
+            if path != next(p for p in paths if os.path.lexists(p)) or _age_of(*paths) < ttl:
+                return 0
+            reclaimed = self._remove(*paths)
+            disk_space.release(upload['uuid'])
+            return reclaimed
+
+        target = TUS_TARGET_PATTERN.match(name)
+        if target and _age_of(path) >= ttl and not self._is_referenced(path, target['dataset_id']):
+            return self._remove(path)
+        return 0
+
+    def _check_dataset_dir(self, path: str, ttl: int) -> int:
+        dataset_id = os.path.basename(path)
+        if not db_manager.is_dataset_exist(dataset_id):
+            if _age_of(path) < ttl:
+                return 0
+            reclaimed = 0
+            for name in os.listdir(path):
+                link = os.path.join(path, name)
+                if os.path.islink(link) and os.path.exists(link):
+                    reclaimed += self._remove(os.path.realpath(link))
+            return reclaimed + self._remove(path)
+
+        outputs = [os.path.join(path, name) for name in os.listdir(path) if INGEST_OUTPUT_PATTERN.match(name)]
+        return self._remove(*[p for p in outputs if _age_of(p) >= ttl])
+
+    def _check_bag_dir(self, path: str, ttl: int) -> int:
+        # The payload is hardlinked, the space of the uploads is only freed once the bag is gone too.
+        dataset_id = os.path.basename(path)
+        if _age_of(path) < ttl or (db_manager.is_dataset_exist(dataset_id)
+                                   and db_manager.find_unfinished_target_repo(dataset_id)):
+            return 0
+        return self._remove(path)
+
+    @staticmethod
+    def _is_referenced(target_path: str, dataset_id: str) -> bool:
+        if not db_manager.is_dataset_exist(dataset_id):
+            return False
+        return any(f.path and os.path.islink(f.path) and os.path.realpath(f.path) == os.path.realpath(target_path)
+                   for f in db_manager.find_files(dataset_id))
+
+    @staticmethod
+    def _remove(*paths: str) -> int:
+        reclaimed = 0
+        for path in paths:
+            if not os.path.lexists(path):
+                continue
+            size = _size_of(path)
+            try:
+                if os.path.isdir(path) and not os.path.islink(path):
+                    shutil.rmtree(path)
+                else:
+                    os.remove(path)
+            except OSError as e:
+                logger(f'Orphan collector is unable to remove {path}: {e}', 'error', LOG_NAME_PS)
+                continue
+            logger(f'Orphan collector removed {path} ({size} bytes)', LOG_LEVEL_DEBUG, LOG_NAME_PS)
+            reclaimed += size
+        return reclaimed
+
+    def collect(self, batch_size: int = None, ttl: int = None) -> dict:
+        """
+        Inspects the next ``batch_size`` entries, continuing where the previous run stopped.
+
+        Returns:
+            dict: The number of removed items and reclaimed bytes of this run.
+        """
+        batch_size = batch_size if batch_size else settings.get("ORPHAN_COLLECTOR_BATCH_SIZE", 500)
+        ttl = ttl if ttl is not None else settings.get("ORPHAN_COLLECTOR_TTL", 172800)
+        removed, reclaimed = 0, 0
+        with self._lock:
+            db_manager.delete_expired_disk_reservations()
+            for _ in range(batch_size):
+                if self._walker is None:
+                    self._walker = self._candidates()
+                try:
+                    check, path = next(self._walker)
+                except StopIteration:
+                    self._walker = None
+                    self.stats["passes"] += 1
+                    break
+                try:
+                    size = check(path, ttl) if os.path.lexists(path) else 0
+                except OSError as e:
+                    logger(f'Orphan collector is unable to inspect {path}: {e}', 'error', LOG_NAME_PS)
+                    continue
+                removed += 1 if size else 0
+                reclaimed += size
+            self.stats["runs"] += 1
+            self.stats["removed-items"] += removed
+            self.stats["reclaimed-bytes"] += reclaimed
+            ORPHAN_RECLAIMED_BYTES.inc(reclaimed)
+            self.stats["last-run"] = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
+        if reclaimed:
+            logger(f'Orphan collector reclaimed {reclaimed} bytes ({removed} items). Total reclaimed: '
+                   f'{self.stats["reclaimed-bytes"]} bytes', LOG_LEVEL_DEBUG, LOG_NAME_PS)
+        return {"removed-items": removed, "reclaimed-bytes": reclaimed}
+
+    def _run(self, interval: int) -> type(None):
+        while not self._stop.wait(interval):
+            try:
+                self.collect()
+            except Exception as e:
+                logger(f'Orphan collector run failed: {e}', 'error', LOG_NAME_PS)
+
+    def start(self) -> type(None):
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, args=(settings.get("ORPHAN_COLLECTOR_INTERVAL", 600),),
+                                        name='orphan-collector', daemon=True)
+        self._thread.start()
+        logger('Orphan collector started', LOG_LEVEL_DEBUG, LOG_NAME_PS)
+
+    def stop(self) -> type(None):
+        self._stop.set()
+
+
+orphan_collector = OrphanCollector(settings.DATA_TMP_BASE_TUS_FILES_DIR, settings.DATA_TMP_BASE_DIR)
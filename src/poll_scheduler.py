@@ -0,0 +1,228 @@
+"""
+Multiplexed status polling of deposits, e.g. SWH save code now requests and SWORD deposit receipts.
+
+A bridge registers a poll (URL, parser and completion predicate) and gets a ``Future`` of the parsed value. One
+scheduler thread keeps the polls of the process in a heap by due time and hands the due ones to a pool of
+``POLL_SCHEDULER_WORKERS`` threads, so a batch of deposits waiting for their status costs no thread per deposit.
+
+The delay between two checks adapts: it starts at the interval of the poll, grows by ``POLL_BACKOFF_FACTOR`` up to
+the max interval while the parsed value does not change, and goes back to the interval when it does. Every delay is
+jittered by ``POLL_JITTER`` so polls registered together do not hit the service together.
+
+Polls are stored in the ``poll`` table. The owning process renews a lease at every check, the leader takes over the
+polls of which the lease expired (a restart, a crashed worker) every ``POLL_ADOPT_INTERVAL`` seconds. A completed
+poll without a waiting future, like a taken over one, calls its ``on_complete`` function instead.
+
+Parser, predicate and on_complete are qualified names of module level functions:
+
+- ``parser(response) -> value``: a JSON serializable value, raises ``PollFailed`` to stop polling;
+- ``predicate(value) -> bool``: whether the poll is complete;
+- ``on_complete(dataset_id, target_name, context, value, error)``.
+"""
+import heapq
+import importlib
+import json
+import os
+import random
+import socket
+import threading
+import uuid
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+import requests
+
+from src.commons import settings, db_manager, logger, LOG_LEVEL_DEBUG, LOG_NAME_PS
+from src.dbz import Poll, PollState
+from src.log_pipeline import dataset_context
+from src.tracing import tracer
+from src.workers import leader
+
+EPOCH = datetime(1970, 1, 1)
+
+
+class PollFailed(Exception):
+    """Raised by a parser when the status tells the deposit failed, the poll stops."""
+
+
+class PollExpired(Exception):
+    """The poll did not complete within its maximum number of attempts."""
+
+
+def _resolve(qualified_name: str):
+    module_name, _, name = qualified_name.rpartition('.')
+    return getattr(importlib.import_module(module_name), name)
+
+
+def _timestamp(moment: datetime) -> float:
+    return (moment - EPOCH).total_seconds()
+
+
+class PollScheduler:
+    def __init__(self):
+        self.owner = None
+        self._heap = []
+        self._futures = {}
+        self._cond = threading.Condition()
+        self._thread = None
+        self._executor = None
+        self._stop = threading.Event()
+        self.stats = {"registered": 0, "checks": 0, "completed": 0, "failed": 0, "adopted": 0}
+
+    def register(self, dataset_id: str, target_name: str, url: str, parser: str, predicate: str,
+                 headers: dict = None, auth: (str, str) = None, on_complete: str = None, context: dict = None,
+                 interval: float = 30, max_interval: float = None, max_attempts: int = 25,
+                 first_delay: float = 0, wait: bool = True) -> Future:
+        """
+        Registers a poll of the url, the first check after first_delay seconds.
+
+        Returns:
+            Future: The value of the parser that completed the poll. Its exception is ``PollFailed`` or
+            ``PollExpired``. None when not waiting, on_complete is called instead.
+        """
+        self.start()
+        next_poll = datetime.utcnow() + timedelta(seconds=first_delay)
+        poll = db_manager.insert_poll(Poll(
+            id=uuid.uuid4().hex, ds_id=dataset_id, target_name=target_name, url=url,
+            request=json.dumps({"headers": headers or {}, "auth": auth}), parser=parser, predicate=predicate,
+            on_complete=on_complete, context=json.dumps(context) if context else None, max_attempts=max_attempts,
+            interval=interval, max_interval=max_interval or interval * settings.get("POLL_MAX_INTERVAL_FACTOR", 4),
+            delay=interval, next_poll=next_poll, lease_until=self._lease_until(next_poll), owner=self.owner))
+        future = Future() if wait else None
+        if future:
+            self._futures[poll.id] = future
+        self.stats["registered"] += 1
+        logger(f'Poll {poll.id} of {target_name} registered: {url}', LOG_LEVEL_DEBUG, LOG_NAME_PS)
+        self._schedule(poll.id, next_poll)
+        return future
+
+    def cancel(self, dataset_id: str, target_name: str) -> int:
+        """Stops the pending polls of the target, e.g. when the repository reported the completion itself."""
+        cancelled = db_manager.cancel_polls(dataset_id, target_name)
+        if cancelled:
+            logger(f'{cancelled} poll(s) of {target_name} cancelled', LOG_LEVEL_DEBUG, LOG_NAME_PS)
+        return cancelled
+
+    @staticmethod
+    def _lease_until(next_poll: datetime) -> datetime:
+        return next_poll + timedelta(seconds=settings.get("POLL_LEASE_GRACE", 120))
+
+    def _schedule(self, poll_id: str, next_poll: datetime) -> type(None):
+        with self._cond:
+            heapq.heappush(self._heap, (_timestamp(next_poll), poll_id))
+            self._cond.notify()
+
+    def _run(self) -> type(None):
+        adopt_interval = settings.get("POLL_ADOPT_INTERVAL", 60)
+        next_adoption = 0
+        while not self._stop.is_set():
+            with self._cond:
+                now = _timestamp(datetime.utcnow())
+                due = []
+                while self._heap and self._heap[0][0] <= now:
+                    due.append(heapq.heappop(self._heap)[1])
+                if self._stop.is_set():
+                    return
+                if not due and now < next_adoption:
+                    self._cond.wait(min(self._heap[0][0] - now if self._heap else adopt_interval, next_adoption - now))
+                    continue
+            for poll_id in due:
+                self._executor.submit(self._check, poll_id)
+            if now >= next_adoption:
+                next_adoption = now + adopt_interval
+                if leader.is_leader:
+                    self._adopt()
+
+    def _adopt(self) -> type(None):
+        try:
+            claimed = db_manager.claim_expired_polls(self.owner, self._lease_until(datetime.utcnow()))
+        except Exception as e:
+            logger(f'Unable to take over expired polls: {e}', 'error', LOG_NAME_PS)
+            return
+        if claimed:
+            logger(f'Took over the polls {claimed}', LOG_LEVEL_DEBUG, LOG_NAME_PS)
+            self.stats["adopted"] += len(claimed)
+        for poll_id in claimed:
+            self._schedule(poll_id, datetime.utcnow())
+
+    def _check(self, poll_id: str) -> type(None):
+        poll = db_manager.find_poll(poll_id)
+        if not poll or poll.state != PollState.PENDING or poll.owner != self.owner:
+            return
+        attempt = poll.attempt + 1
+        self.stats["checks"] += 1
+        with dataset_context(poll.ds_id), tracer.start_as_current_span('poll', attributes={
+                "ps.dataset_id": poll.ds_id, "ps.target": poll.target_name, "ps.poll.attempt": attempt}) as span:
+            value = None
+            try:
+                request = json.loads(poll.request)
+                rsp = requests.get(poll.url, headers=request["headers"],
+                                   auth=tuple(request["auth"]) if request["auth"] else None,
+                                   timeout=settings.get("POLL_TIMEOUT", 60))
+                span.set_attribute("http.status_code", rsp.status_code)
+                value = _resolve(poll.parser)(rsp)
+                if _resolve(poll.predicate)(value):
+                    self._finish(poll, value=value)
+                    return
+            except PollFailed as e:
+                self._finish(poll, error=e)
+                return
+            except Exception as e:
+                logger(f'Poll {poll.id} of {poll.target_name} ({poll.url}) attempt {attempt} failed: {e}', 'warning',
+                       LOG_NAME_PS)
+
+        if attempt >= poll.max_attempts:
+            self._finish(poll, error=PollExpired(f'{poll.url} not complete after {attempt} attempts'))
+            return
+        last_value = json.dumps(value, sort_keys=True, default=str) if value is not None else poll.last_value
+        # Back to the interval when the status moved, further apart while it does not.
+        delay = poll.interval if poll.last_value and last_value != poll.last_value else \
+            min(poll.delay * settings.get("POLL_BACKOFF_FACTOR", 1.5), poll.max_interval) if attempt > 1 else poll.delay
+        jitter = settings.get("POLL_JITTER", 0.2)
+        next_poll = datetime.utcnow() + timedelta(seconds=delay * random.uniform(1 - jitter, 1 + jitter))
+        if db_manager.reschedule_poll(poll.id, self.owner, attempt, delay, last_value, next_poll,
+                                      self._lease_until(next_poll)):
+            self._schedule(poll.id, next_poll)
+
+    def _finish(self, poll: Poll, value=None, error: Exception = None) -> type(None):
+        if not db_manager.finish_poll(poll.id, self.owner, PollState.FAILED if error else PollState.DONE):
+            return
+        self.stats["failed" if error else "completed"] += 1
+        logger(f'Poll {poll.id} of {poll.target_name} {"failed: " + str(error) if error else "completed"}',
+               LOG_LEVEL_DEBUG, LOG_NAME_PS)
+        future = self._futures.pop(poll.id, None)
+        if future:
+            if error:
+                future.set_exception(error)
+            else:
+                future.set_result(value)
+        elif poll.on_complete:
+            try:
+                with dataset_context(poll.ds_id):
+                    _resolve(poll.on_complete)(poll.ds_id, poll.target_name,
+                                               json.loads(poll.context) if poll.context else {}, value, error)
+            except Exception as e:
+                logger(f'on_complete of poll {poll.id} ({poll.on_complete}) failed: {e}', 'error', LOG_NAME_PS)
+
+    def start(self) -> type(None):
+        with self._cond:
+            if self._thread and self._thread.is_alive():
+                return
+            # Set here and not at import: the owner is this process.
+            self.owner = f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}'
+            self._executor = ThreadPoolExecutor(max_workers=settings.get("POLL_SCHEDULER_WORKERS", 4),
+                                                thread_name_prefix='poll')
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name='poll-scheduler', daemon=True)
+            self._thread.start()
+
+    def stop(self) -> type(None):
+        """Stops polling, the leases of the pending polls expire and the leader takes them over."""
+        with self._cond:
+            self._stop.set()
+            self._cond.notify()
+        if self._executor:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+poll_scheduler = PollScheduler()
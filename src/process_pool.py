@@ -0,0 +1,33 @@
+"""
+Process pools of the CPU bound work of the bridges, e.g. deflating zip blocks.
+
+A pool is shared by all bridge threads and created at its first use, ``shutdown`` ends them with the application.
+The pool processes are started by a forkserver: a fork of the multithreaded server would copy the locks that other
+threads hold at that moment into the child, which deadlocks when it needs one of them.
+"""
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+_pools = {}
+_lock = threading.Lock()
+
+
+def process_pool(name: str, workers: int = None) -> ProcessPoolExecutor:
+    """Returns the pool of the given name, with workers processes (default: all cores) when it is created."""
+    with _lock:
+        pool = _pools.get(name)
+        # A pool of which a process died is broken for good, it is replaced.
+        if pool is None or pool._broken:
+            pool = ProcessPoolExecutor(max_workers=workers if workers else os.cpu_count(),
+                                       mp_context=multiprocessing.get_context('forkserver'))
+            _pools[name] = pool
+        return pool
+
+
+def shutdown() -> type(None):
+    with _lock:
+        for pool in _pools.values():
+            pool.shutdown(wait=False, cancel_futures=True)
+        _pools.clear()
@@ -0,0 +1,235 @@
+"""
+On-demand profiling of bridge executions.
+
+Profiling is requested per dataset id or per bridge class (see the ``/profiling`` endpoints) for a number of
+``execute_bridges`` runs. A matching run is profiled with ``cProfile`` (deterministic, all calls of the bridge
+thread) or with a sampling profiler (the stack of the bridge thread every ``PROFILING_SAMPLE_INTERVAL`` seconds,
+little overhead). With ``memory`` the ``tracemalloc`` top allocations are taken at the start and end of the run and
+of the deposit to every target. The results are written to ``DATA_TMP_BASE_DIR/profiles/<dataset_id>``, which is
+kept when the dataset directory is deleted after the deposit.
+
+The requests are kept in a file in the profiles directory, so every worker sees them. It is read and updated under
+a file lock, so two workers do not lose each other's updates.
+"""
+import cProfile
+import io
+import json
+import os
+import pstats
+import sys
+import threading
+import tracemalloc
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime
+from enum import StrEnum
+
+from src.commons import settings, logger, LOG_LEVEL_DEBUG, LOG_NAME_PS
+from src.workers import file_lock
+
+PROFILING_MODES = ('cprofile', 'sampling')
+
+
+class ProfilingKind(StrEnum):
+    DATASETS = 'datasets'
+    BRIDGES = 'bridges'
+
+# tracemalloc is process wide, it runs as long as a profiled run needs it.
+_tracemalloc_users = 0
+_tracemalloc_lock = threading.Lock()
+
+
+def _start_tracemalloc() -> type(None):
+    global _tracemalloc_users
+    with _tracemalloc_lock:
+        if _tracemalloc_users == 0 and not tracemalloc.is_tracing():
+            tracemalloc.start(settings.get("PROFILING_TRACEMALLOC_FRAMES", 10))
+        _tracemalloc_users += 1
+
+
+def _stop_tracemalloc() -> type(None):
+    global _tracemalloc_users
+    with _tracemalloc_lock:
+        _tracemalloc_users -= 1
+        if _tracemalloc_users == 0:
+            tracemalloc.stop()
+
+
+class SamplingProfiler(threading.Thread):
+    """Counts the stacks of one thread, written in the collapsed (flame graph) format."""
+
+    def __init__(self, thread_id: int, interval: float):
+        super().__init__(name='sampling-profiler', daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._done = threading.Event()
+
+    def run(self):
+        while not self._done.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame:
+                stack.append(f'{frame.f_code.co_name} ({os.path.basename(frame.f_code.co_filename)}:'
+                             f'{frame.f_code.co_firstlineno})')
+                frame = frame.f_back
+            if stack:
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def stop(self) -> type(None):
+        self._done.set()
+        self.join()
+
+    def collapsed(self) -> str:
+        return ''.join(f'{stack} {count}\n' for stack, count in self.stacks.most_common())
+
+
+class BridgeRunProfiler:
+    """Profiles one execute_bridges run, see ``BridgeProfiling.profiler``."""
+
+    def __init__(self, dataset_id: str, output_dir: str, mode: str = None, memory: bool = False):
+        self.dataset_id = dataset_id
+        self.output_dir = output_dir
+        self.mode = mode
+        self.memory = memory
+        self.name = datetime.now().strftime('%Y%m%dT%H%M%S')
+        self.profiler = None
+        self.snapshots = {}
+        self.memory_report = []
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.mode or self.memory)
+
+    def __enter__(self):
+        if self.memory:
+            _start_tracemalloc()
+        self._snapshot('start of run')
+        if self.mode == 'cprofile':
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        elif self.mode == 'sampling':
+            self.profiler = SamplingProfiler(threading.get_ident(), settings.get("PROFILING_SAMPLE_INTERVAL", 0.01))
+            self.profiler.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self.mode == 'cprofile':
+            self.profiler.disable()
+        elif self.mode == 'sampling':
+            self.profiler.stop()
+        self._snapshot('end of run')
+        if self.memory:
+            _stop_tracemalloc()
+        if self.enabled:
+            self._write()
+        return False
+
+    @contextmanager
+    def stage(self, name: str):
+        """Takes the memory snapshots at the start and end of a stage of the run."""
+        self._snapshot(f'start of {name}')
+        try:
+            yield
+        finally:
+            self._snapshot(f'end of {name}')
+
+    def _snapshot(self, label: str) -> type(None):
+        if not self.memory:
+            return
+        top = settings.get("PROFILING_MEMORY_TOP", 20)
+        snapshot = tracemalloc.take_snapshot().filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)])
+        current, peak = tracemalloc.get_traced_memory()
+        lines = [f'== {label}: {current} bytes traced, peak {peak} bytes']
+        lines += [str(s) for s in snapshot.statistics('lineno')[:top]]
+        stage = label[len('end of '):] if label.startswith('end of ') else None
+        if stage and f'start of {stage}' in self.snapshots:
+            lines.append(f'-- growth since the start of {stage}')
+            lines += [str(s) for s in snapshot.compare_to(self.snapshots.pop(f'start of {stage}'), 'lineno')[:top]]
+        else:
+            self.snapshots[label] = snapshot
+        self.memory_report.append('\n'.join(lines))
+
+    def _write(self) -> type(None):
+        os.makedirs(self.output_dir, exist_ok=True)
+        base = os.path.join(self.output_dir, self.name)
+        if self.mode == 'cprofile':
+            self.profiler.dump_stats(f'{base}-cprofile.prof')
+            summary = io.StringIO()
+            pstats.Stats(self.profiler, stream=summary).sort_stats('cumulative').print_stats(50)
+            with open(f'{base}-cprofile.txt', 'w') as f:
+                f.write(summary.getvalue())
+        elif self.mode == 'sampling':
+            with open(f'{base}-sampling.folded', 'w') as f:
+                f.write(self.profiler.collapsed())
+        if self.memory:
+            with open(f'{base}-memory.txt', 'w') as f:
+                f.write('\n\n'.join(self.memory_report) + '\n')
+        logger(f'Profile of the bridges run of {self.dataset_id} written to {base}-*', LOG_LEVEL_DEBUG, LOG_NAME_PS)
+
+
+class BridgeProfiling:
+    """The profiling requests and the stored profiles."""
+
+    def __init__(self, profiles_dir: str):
+        self.profiles_dir = profiles_dir
+        self.requests_path = os.path.join(profiles_dir, 'requests.json')
+
+    def requests(self) -> dict:
+        if not os.path.exists(self.requests_path):
+            return {"datasets": {}, "bridges": {}}
+        with open(self.requests_path) as f:
+            return json.load(f)
+
+    def _save(self, requests: dict) -> type(None):
+        os.makedirs(self.profiles_dir, exist_ok=True)
+        tmp_path = f'{self.requests_path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(requests, f)
+        os.replace(tmp_path, self.requests_path)
+
+    def enable(self, kind: str, key: str, mode: str = 'cprofile', memory: bool = False, runs: int = 1) -> dict:
+        """Profiles the next runs of a dataset (kind 'datasets') or bridge class (kind 'bridges')."""
+        if mode not in PROFILING_MODES and not (mode is None and memory):
+            raise ValueError(f'Unknown profiling mode {mode}, use one of {", ".join(PROFILING_MODES)}')
+        with file_lock('profiling-requests'):
+            requests = self.requests()
+            requests[kind][key] = {"mode": mode, "memory": memory, "runs": runs}
+            self._save(requests)
+        return requests
+
+    def disable(self, kind: str, key: str) -> dict:
+        with file_lock('profiling-requests'):
+            requests = self.requests()
+            requests[kind].pop(key, None)
+            self._save(requests)
+        return requests
+
+    def profiler(self, dataset_id: str, bridge_classes: [str]) -> BridgeRunProfiler:
+        """
+        Returns the profiler of a run of the given bridges for the dataset, a disabled one when no profiling was
+        requested. A dataset request goes before a bridge class request and uses one of its runs.
+        """
+        with file_lock('profiling-requests'):
+            requests = self.requests()
+            matches = [("datasets", dataset_id)] + [("bridges", b) for b in bridge_classes]
+            kind, key = next(((k, key) for k, key in matches if key in requests[k]), (None, None))
+            if not kind:
+                return BridgeRunProfiler(dataset_id, self.dataset_dir(dataset_id))
+            request = requests[kind][key]
+            request["runs"] -= 1
+            if request["runs"] <= 0:
+                requests[kind].pop(key)
+            self._save(requests)
+        logger(f'Profiling the bridges run of {dataset_id} ({kind} {key}): {request}', LOG_LEVEL_DEBUG, LOG_NAME_PS)
+        return BridgeRunProfiler(dataset_id, self.dataset_dir(dataset_id), request["mode"], request["memory"])
+
+    def dataset_dir(self, dataset_id: str) -> str:
+        return os.path.join(self.profiles_dir, os.path.basename(dataset_id))
+
+    def list(self, dataset_id: str) -> [str]:
+        path = self.dataset_dir(dataset_id)
+        return sorted(os.listdir(path)) if os.path.isdir(path) else []
+
+
+profiling = BridgeProfiling(os.path.join(settings.DATA_TMP_BASE_DIR, 'profiles'))
@@ -8,22 +8,37 @@ import shutil
 from pathlib import Path
 import threading
 import time
+import uuid
 from datetime import datetime
 from typing import Callable, Awaitable
 
 import jmespath
-import requests
 from fastapi import APIRouter, Request, UploadFile, Form, File, HTTPException
+from pydantic import ValidationError
 from fastapi.responses import JSONResponse
-from starlette.responses import FileResponse
-
-from src.commons import settings, logger, data, db_manager, get_class, assistant_repo_headers, handle_ps_exceptions, \
+from starlette.background import BackgroundTask
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import FileResponse, StreamingResponse, Response
+
+from src import log_reader, settings_snapshot
+from src.assistant_config import assistant_configs
+from src.bag_builder import BagBuilder
+from src.bridge_registry import bridge_registry
+from src.commons import settings, logger, db_manager, handle_ps_exceptions, \
     send_mail, LOG_LEVEL_DEBUG, LOG_NAME_PS, delete_symlink_and_target
 from src.dbz import TargetRepo, DataFile, Dataset, ReleaseVersion, DepositStatus, FilePermissions, \
-    DatasetWorkState, DataFileWorkState
+    DatasetWorkState, DataFileWorkState, DiskReservationKind
+from src.disk_space import disk_space
+from src.metrics import DEPOSIT_SECONDS, BRIDGE_ERRORS, track_bridge_thread
+from src.orphan_collector import orphan_collector
+from src.poll_scheduler import poll_scheduler
+from src.profiling import profiling, ProfilingKind
+from src.tracing import tracer, in_current_context
+from src.log_pipeline import dataset_context, dataset_id_var
 from src.models.app_model import ResponseDataModel, InboxDatasetDataModel
 # Import custom modules and classes
 from src.models.assistant_datamodel import RepoAssistantDataModel, Target
+from src.models.bridge_output_model import BridgeOutputDataModel, TargetResponse
 from src.models.target_datamodel import TargetsCredentialsModel
 
 # Create an API router instance
@@ -34,23 +49,25 @@ router = APIRouter()
 @router.post("/register-bridge-module/{name}/{overwrite}")
 async def register_module(name: str, bridge_file: Request, overwrite: bool | None = False) -> {}:
     logger(f'Registering {name}', LOG_LEVEL_DEBUG, LOG_NAME_PS)
-    if not overwrite and name in data["bridge-modules"]:
+    bridge_path = os.path.join(settings.MODULES_DIR, os.path.basename(name))
+    if not overwrite and os.path.exists(bridge_path):
         raise HTTPException(status_code=400,
                             detail=f'The {name} is already exist. Consider /register-bridge-module/{name}/true')
 
     if bridge_file.headers['Content-Type'] != 'text/x-python':
         raise HTTPException(status_code=400, detail="Unsupported content type")
 
-    m_file = await bridge_file.body()
-    bridge_path = os.path.join(settings.MODULES_DIR, name)
-    with open(bridge_path, "w+") as file:
-        file.write(m_file.decode())
-
     if mimetypes.guess_type(bridge_path)[0] != 'text/x-python':
-        os.remove(bridge_path)
         raise HTTPException(status_code=400, detail='Unsupported file type')
 
-    return {"status": "ok", "bridge-module-name": name}
+    m_file = await bridge_file.body()
+    # Written under another name first, the module watchers of the other workers never see a partial file.
+    tmp_path = f'{bridge_path}.{os.getpid()}.tmp'
+    with open(tmp_path, "w+") as file:
+        file.write(m_file.decode())
+    os.replace(tmp_path, bridge_path)
+
+    return {"status": "ok", "bridge-module-name": name, "bridge-classes": bridge_registry.scan()}
 
 
 # Helper function to process inbox dataset metadata
@@ -74,14 +91,15 @@ async def process_inbox_dataset_metadata(request: Request, release_version: Rele
     file_metadata = jmespath.search('"file-metadata"[*]', idh.metadata)
     logger(f'--- Number of file_metadata: {len(file_metadata)}', LOG_LEVEL_DEBUG, LOG_NAME_PS)
     datasetId = jmespath.search("id", idh.metadata)
+    dataset_id_var.set(datasetId)
 
     logger(f'Start inbox for metadata id: {datasetId} - release version: {release_version} - assistant name: '
            f'{idh.assistant_name}', LOG_LEVEL_DEBUG, LOG_NAME_PS)
 
     if db_manager.is_dataset_published(datasetId):
         raise HTTPException(status_code=400, detail='Dataset is already published.')
-    repo_config = retrieve_targets_configuration(idh.assistant_name)
-    repo_assistant = RepoAssistantDataModel.model_validate_json(repo_config)
+    # A cache miss fetches the configuration, with blocking requests.
+    repo_assistant = await run_in_threadpool(retrieve_targets_configuration, idh.assistant_name)
 
     dataset_folder = os.path.join(settings.DATA_TMP_BASE_DIR, repo_assistant.app_name, datasetId)
     if not os.path.exists(dataset_folder):
@@ -251,7 +269,7 @@ def process_target_repos(repo_assistant, target_creds) -> [TargetRepo]:
     tgc = {"targets-credentials": json.loads(target_creds)}
     input_target_cred_model = TargetsCredentialsModel.model_validate(tgc)
     for repo_target in repo_assistant.targets:
-        if repo_target.bridge_module_class not in data.keys():
+        if repo_target.bridge_module_class not in bridge_registry:
             raise HTTPException(status_code=404, detail=f'Module "{repo_target.bridge_module_class}" not found.',
                                 headers={})
         target_repo_name = repo_target.repo_name
@@ -350,10 +368,8 @@ def list_files_with_suffix(directory: str, suffix: str) -> list:
 #     rdm.start_process = start_process
 #     return rdm.model_dump(by_alias=True)
 
-import httpx
-
-
 async def delete_file(file_id: str):
+    import httpx
     logger(f"#####-----------------Deleting file {file_id}", LOG_LEVEL_DEBUG, LOG_NAME_PS)
     url = f'{settings.TUS_BASE_URL}/files/{file_id}'
     headers = {"accept": "application/json"}
@@ -371,6 +387,7 @@ async def delete_file(file_id: str):
 
 @router.patch("/inbox/files/{metadata_id}/{file_uuid}")
 async def update_file_metadata(metadata_id: str, file_uuid: str) -> {}:
+    dataset_id_var.set(metadata_id)
     logger(f'>>>>>>> PATCH file metadata for metadata_id: {metadata_id} and file_uuid: {file_uuid}', LOG_LEVEL_DEBUG,
            LOG_NAME_PS)
     tus_file = os.path.join(settings.DATA_TMP_BASE_TUS_FILES_DIR, file_uuid)
@@ -422,6 +439,8 @@ async def update_file_metadata(metadata_id: str, file_uuid: str) -> {}:
         new_name = f'{target}-{metadata_id}.{db_record_metadata.app_name}'
         os.rename(target, new_name)
         os.symlink(new_name, link_name)
+        # The upload is complete, its bytes are now accounted for in the used disk space.
+        await run_in_threadpool(disk_space.release, file_uuid, DiskReservationKind.TUS_UPLOAD)
         logger(f'Symlink created: {link_name} -> {target}', LOG_LEVEL_DEBUG, LOG_NAME_PS)
         logger(f'Deleting {source_file_path}.info', LOG_LEVEL_DEBUG, LOG_NAME_PS)
         await delete_file(file_uuid)
@@ -462,7 +481,7 @@ async def update_file_metadata(metadata_id: str, file_uuid: str) -> {}:
 def bridge_task(datasetId: str, msg: str) -> None:
     logger(f"Starting threading for {msg} with datasetId: {datasetId}", LOG_LEVEL_DEBUG, LOG_NAME_PS)
     try:
-        threading.Thread(target=follow_bridge, args=(datasetId,)).start()
+        threading.Thread(target=in_current_context(follow_bridge), args=(datasetId,)).start()
         logger(f"Threading for {datasetId} started successfully.", LOG_LEVEL_DEBUG, LOG_NAME_PS)
     except Exception as e:
         logger(f"Error starting thread for {datasetId}: {e}", 'error', LOG_NAME_PS)
@@ -481,28 +500,23 @@ def follow_bridge(datasetId) -> type(None):
 
 
 def execute_bridges(datasetId, targets) -> None:
-    logger("execute_bridges", LOG_LEVEL_DEBUG, LOG_NAME_PS)
-    results = []
-    for target_repo_rec in targets:
-        bridge_class = data[Target(**json.loads(target_repo_rec.config)).bridge_module_class]
-        logger(f'EXECUTING {bridge_class} for target_repo_id: {target_repo_rec.id}', LOG_LEVEL_DEBUG, LOG_NAME_PS)
+    with tracer.start_as_current_span('execute bridges', attributes={"ps.dataset_id": datasetId,
+                                                                     "ps.targets": len(targets)}), \
+            dataset_context(datasetId), track_bridge_thread():
+        _execute_bridges(datasetId, targets)
 
-        start = time.perf_counter()
-        bridge_instance = get_class(bridge_class)(dataset_id=datasetId,
-                                                  target=Target(**json.loads(target_repo_rec.config)))
-        deposit_result = bridge_instance.deposit()
-        deposit_result.response.duration = round(time.perf_counter() - start, 2)
 
-        logger(f'Result from Deposit: {deposit_result.model_dump_json()}', LOG_LEVEL_DEBUG, LOG_NAME_PS)
-        bridge_instance.save_state(deposit_result)
-
-        if deposit_result.deposit_status in [DepositStatus.FINISH, DepositStatus.ACCEPTED, DepositStatus.SUCCESS]:
-            results.append(deposit_result)
-        else:
-            send_mail(f'Executing {bridge_class} is FAILED.', f'Resp:\n {deposit_result.model_dump_json()}')
-            break
+def _execute_bridges(datasetId, targets) -> None:
+    logger("execute_bridges", LOG_LEVEL_DEBUG, LOG_NAME_PS)
+    bridge_classes = [bridge_registry.qualified_name(Target(**json.loads(t.config)).bridge_module_class)
+                      for t in targets]
+    with profiling.profiler(datasetId, bridge_classes) as profiler:
+        results = _deposit_to_targets(datasetId, targets, profiler)
 
-    if len(results) == len(targets):
+    if results and results[-1].deposit_status == DepositStatus.SUBMITTED:
+        logger(f'Awaiting the completion of {targets[len(results) - 1].name} for datasetId: {datasetId}',
+               LOG_LEVEL_DEBUG, LOG_NAME_PS)
+    elif len(results) == len(targets):
         dataset_folder = os.path.join(settings.DATA_TMP_BASE_DIR, db_manager.find_dataset(ds_id=datasetId).app_name,
                                       datasetId)
         logger(f'Ingest SUCCESSFULL, DELETE {dataset_folder}', LOG_LEVEL_DEBUG, LOG_NAME_PS)
@@ -517,14 +531,107 @@ def execute_bridges(datasetId, targets) -> None:
         logger(f'Ingest FAILED for datasetId: {datasetId}', LOG_LEVEL_DEBUG, LOG_NAME_PS)
 
 
+def _deposit_to_targets(datasetId, targets, profiler) -> list:
+    results = []
+    for target_repo_rec in targets:
+        with profiler.stage(f'deposit to {target_repo_rec.name}'):
+            bridge_name = Target(**json.loads(target_repo_rec.config)).bridge_module_class
+            bridge_class = bridge_registry.qualified_name(bridge_name)
+            logger(f'EXECUTING {bridge_class} for target_repo_id: {target_repo_rec.id}', LOG_LEVEL_DEBUG, LOG_NAME_PS)
+
+            start = time.perf_counter()
+            with tracer.start_as_current_span('deposit', attributes={"ps.target": target_repo_rec.name,
+                                                                     "ps.bridge": bridge_class}) as span:
+                bridge_instance = bridge_registry.get(bridge_name)(dataset_id=datasetId,
+                                                                   target=Target(**json.loads(target_repo_rec.config)))
+                try:
+                    deposit_result = bridge_instance.deposit()
+                except Exception:
+                    BRIDGE_ERRORS.labels(bridge_class).inc()
+                    raise
+                span.set_attribute("ps.deposit_status", deposit_result.deposit_status)
+            deposit_result.response.duration = round(time.perf_counter() - start, 2)
+            DEPOSIT_SECONDS.labels(target_repo_rec.name, bridge_class, deposit_result.deposit_status).observe(
+                time.perf_counter() - start)
+
+            logger(f'Result from Deposit: {deposit_result.model_dump_json()}', LOG_LEVEL_DEBUG, LOG_NAME_PS)
+            # Bridge.submit saved a SUBMITTED result already, saving it again could undo a completion in between.
+            if deposit_result.deposit_status != DepositStatus.SUBMITTED:
+                bridge_instance.save_state(deposit_result)
+
+            if deposit_result.deposit_status in [DepositStatus.FINISH, DepositStatus.ACCEPTED, DepositStatus.SUCCESS]:
+                results.append(deposit_result)
+            elif deposit_result.deposit_status == DepositStatus.SUBMITTED:
+                # complete_target continues with the next targets.
+                results.append(deposit_result)
+                break
+            else:
+                BRIDGE_ERRORS.labels(bridge_class).inc()
+                send_mail(f'Executing {bridge_class} is FAILED.', f'Resp:\n {deposit_result.model_dump_json()}')
+                break
+    return results
+
+
+def complete_target(datasetId: str, target_name: str, payload=None, error: Exception = None) -> DepositStatus:
+    """
+    Finalizes a SUBMITTED deposit (see Bridge.submit) and starts the deposits to the next targets of the dataset.
+
+    Returns:
+        DepositStatus: The final status, None when the target is not awaiting its completion (anymore).
+    """
+    if not db_manager.claim_submitted_target(datasetId, target_name):
+        return None
+    poll_scheduler.cancel(datasetId, target_name)
+    targets = db_manager.find_target_repos_by_dataset_id(datasetId)
+    index = next(i for i, t in enumerate(targets) if t.name == target_name)
+    target_repo_rec = targets[index]
+    bridge_name = Target(**json.loads(target_repo_rec.config)).bridge_module_class
+    with dataset_context(datasetId), tracer.start_as_current_span('complete deposit', attributes={
+            "ps.dataset_id": datasetId, "ps.target": target_name}) as span:
+        # The target stays FINALIZING until the completed state is saved.
+        bridge_instance = bridge_registry.get(bridge_name)(dataset_id=datasetId,
+                                                           target=Target(**json.loads(target_repo_rec.config)),
+                                                           new_deposit=False)
+        try:
+            if error:
+                raise error
+            deposit_result = bridge_instance.complete(
+                BridgeOutputDataModel.model_validate_json(target_repo_rec.target_output), payload)
+        except Exception as e:
+            logger(f'Completion of {target_name} for datasetId: {datasetId} failed: {e}', 'error', LOG_NAME_PS)
+            deposit_result = BridgeOutputDataModel(response=TargetResponse(error=str(e)))
+            deposit_result.deposit_status = DepositStatus.ERROR
+        span.set_attribute("ps.deposit_status", deposit_result.deposit_status)
+        if not deposit_result.response:
+            deposit_result.response = TargetResponse()
+        bridge_instance.save_state(deposit_result)
+
+    if deposit_result.deposit_status in [DepositStatus.FINISH, DepositStatus.ACCEPTED, DepositStatus.SUCCESS]:
+        threading.Thread(target=in_current_context(execute_bridges), args=(datasetId, targets[index + 1:])).start()
+    else:
+        BRIDGE_ERRORS.labels(bridge_registry.qualified_name(bridge_name)).inc()
+        send_mail(f'Completing {target_name} is FAILED.', f'Resp:\n {deposit_result.model_dump_json()}')
+        logger(f'Ingest FAILED for datasetId: {datasetId}', LOG_LEVEL_DEBUG, LOG_NAME_PS)
+    return deposit_result.deposit_status
+
+
+def complete_polled_target(dataset_id: str, target_name: str, context: dict, value, error: Exception) -> type(None):
+    """on_complete of the safety net poll of a submitted deposit."""
+    complete_target(dataset_id, target_name, value, error)
+
+
+@router.post("/inbox/callback/{datasetId}/{targetName}")
+def deposit_callback(datasetId: str, targetName: str, payload: dict):
+    logger(f'Callback of {targetName} for {datasetId}: {payload}', LOG_LEVEL_DEBUG, LOG_NAME_PS)
+    deposit_status = complete_target(datasetId, targetName, payload)
+    if deposit_status is None:
+        raise HTTPException(status_code=409, detail=f'{targetName} of {datasetId} is not awaiting a callback')
+    return {"dataset-id": datasetId, "target": targetName, "deposit-status": deposit_status}
+
+
 @handle_ps_exceptions
-def retrieve_targets_configuration(assistant_config_name: str) -> str:
-    repo_url = f'{settings.ASSISTANT_CONFIG_URL}/{assistant_config_name}'
-    logger(f'Retrieve targets configuration from {repo_url}', LOG_LEVEL_DEBUG, LOG_NAME_PS)
-    rsp = requests.get(repo_url, headers=assistant_repo_headers)
-    if rsp.status_code != 200:
-        raise HTTPException(status_code=404, detail=f"{repo_url} not found")
-    return rsp.json()
+def retrieve_targets_configuration(assistant_config_name: str) -> RepoAssistantDataModel:
+    return assistant_configs.get(assistant_config_name)
 
 
 @router.post("/inbox/resubmit/{datasetId}")
@@ -536,7 +643,8 @@ async def resubmit(datasetId: str):
 
     logger(f'Resubmitting {len(targets)}', LOG_LEVEL_DEBUG, LOG_NAME_PS)
     try:
-        execute_bridges_task = threading.Thread(target=execute_bridges, args=(datasetId, targets,))
+        execute_bridges_task = threading.Thread(target=in_current_context(execute_bridges),
+                                                args=(datasetId, targets,))
         execute_bridges_task.start()
         print(f'follow_bridge_task: {execute_bridges_task}')
     except Exception as e:
@@ -572,21 +680,111 @@ def delete_inbox(dir: str):
     return {"Deleted": "OK", "directory": directory}
 
 
+@router.get("/bag/{datasetId}", include_in_schema=False)
+def download_bag(datasetId: str, archive_format: str = 'zip'):
+    bag_builder = BagBuilder(datasetId)
+    if not os.path.isdir(bag_builder.bag_dir):
+        raise HTTPException(status_code=404, detail=f'No bag found for {datasetId}')
+    if archive_format not in ('zip', 'tar'):
+        raise HTTPException(status_code=400, detail='Unsupported archive format, use zip or tar')
+    logger(f'Streaming bag of {datasetId} as {archive_format}', LOG_LEVEL_DEBUG, LOG_NAME_PS)
+    return StreamingResponse(bag_builder.stream(archive_format),
+                             media_type='application/zip' if archive_format == 'zip' else 'application/x-tar',
+                             headers={'Content-Disposition': f'attachment; filename="{datasetId}.{archive_format}"'})
+
+
+@router.get("/orphan-collector", include_in_schema=False)
+def get_orphan_collector_stats():
+    return orphan_collector.stats
+
+
+@router.post("/orphan-collector/run", include_in_schema=False)
+def run_orphan_collector(batch_size: int | None = None):
+    logger(f'Run orphan collector, batch size: {batch_size}', LOG_LEVEL_DEBUG, LOG_NAME_PS)
+    return orphan_collector.collect(batch_size)
+
+
+@router.get("/profiling", include_in_schema=False)
+def get_profiling_requests():
+    return profiling.requests()
+
+
+@router.put("/profiling/{kind}/{key}", include_in_schema=False)
+def enable_profiling(kind: ProfilingKind, key: str, mode: str | None = 'cprofile', memory: bool = False,
+                     runs: int = 1):
+    """
+    Profiles the next runs of the bridges of a dataset (kind datasets) or of a bridge class (kind bridges). An empty
+    mode with memory=true only takes the memory snapshots.
+    """
+    logger(f'Enable profiling of {kind} {key}: mode {mode}, memory {memory}, runs {runs}', LOG_LEVEL_DEBUG,
+           LOG_NAME_PS)
+    try:
+        return profiling.enable(kind, key, mode or None, memory, runs)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+@router.delete("/profiling/{kind}/{key}", include_in_schema=False)
+def disable_profiling(kind: ProfilingKind, key: str):
+    return profiling.disable(kind, key)
+
+
+@router.get("/profiles/{datasetId}", include_in_schema=False)
+def list_profiles(datasetId: str):
+    return profiling.list(datasetId)
+
+
+@router.get("/profiles/{datasetId}/{name}", include_in_schema=False)
+def download_profile(datasetId: str, name: str):
+    if name not in profiling.list(datasetId):
+        raise HTTPException(status_code=404, detail=f'No profile {name} for {datasetId}')
+    return FileResponse(path=os.path.join(profiling.dataset_dir(datasetId), name), filename=name,
+                        media_type='text/plain' if name.endswith(('.txt', '.folded')) else 'application/octet-stream')
+
+
 # Endpoint to retrieve application settings
 @router.get("/settings-reload", include_in_schema=False)
 async def get_settings():
     logger(f"Getting settings Before Load: {settings.as_dict()}", "debug", "ps")
     logger("Reload settings", "debug", "ps")
     settings.reload()
+    try:
+        settings_snapshot.rebuild(settings)
+    except ValidationError as e:
+        logger(f"Invalid settings, the previous settings snapshot is kept: {e}", "error", "ps")
+        raise HTTPException(status_code=400, detail=f'Invalid settings: {e}')
+    assistant_configs.invalidate()
     logger(f"Getting settings After Load: {settings.as_dict()}", "debug", "ps")
     return settings.as_dict()
 
 
 @router.get('/logs/{app_name}', include_in_schema=False)
-def get_log(app_name: str):
-    logger('logs', LOG_LEVEL_DEBUG, 'ps')
-    return FileResponse(path=f"{os.environ['BASE_DIR']}/logs/{app_name}.log", filename=f"{app_name}.log",
-                        media_type='text/plain')
+def get_log(request: Request, app_name: str, tail: int | None = None, dataset_id: str | None = None):
+    """
+    Returns the log of the app: the lines of one dataset (dataset_id), the last lines (tail), or the file, of which a
+    byte range can be requested with a Range header. tail and dataset_id combined give the last lines of the dataset.
+    """
+    logger('logs %s tail=%s dataset_id=%s', LOG_LEVEL_DEBUG, 'ps', app_name, tail, dataset_id)
+    log_path = os.path.join(os.environ['BASE_DIR'], 'logs', f'{os.path.basename(app_name)}.log')
+    if not os.path.isfile(log_path):
+        raise HTTPException(status_code=404, detail=f'No log for {app_name}')
+    if dataset_id:
+        return Response(content=log_reader.log_index(log_path).lines(dataset_id, tail), media_type='text/plain')
+    if tail is not None:
+        return Response(content=log_reader.tail(log_path, tail), media_type='text/plain')
+
+    size = os.path.getsize(log_path)
+    try:
+        byte_range = log_reader.parse_range(request.headers.get('range'), size)
+    except ValueError as e:
+        raise HTTPException(status_code=416, detail=str(e), headers={'Content-Range': f'bytes */{size}'})
+    if byte_range is None:
+        return FileResponse(path=log_path, filename=f"{app_name}.log", media_type='text/plain',
+                            headers={'Accept-Ranges': 'bytes'})
+    start, end = byte_range
+    return StreamingResponse(log_reader.iter_range(log_path, start, end), status_code=206, media_type='text/plain',
+                             headers={'Accept-Ranges': 'bytes', 'Content-Range': f'bytes {start}-{end}/{size}',
+                                      'Content-Length': str(end - start + 1)})
 
 
 @router.get("/logs-list", include_in_schema=False)
@@ -598,8 +796,14 @@ def get_log_list():
 @router.get("/db-download", include_in_schema=False)
 def get_db():
     logger('db-download', LOG_LEVEL_DEBUG, 'ps')
-    return FileResponse(path=settings.DB_URL, filename="dans_packaging.db",
-                        media_type='application/octet-stream')
+    # A consistent snapshot, the live file can be mid-write. It is removed once it has been sent.
+    snapshot_path = os.path.join(settings.DATA_TMP_BASE_DIR, f'db-snapshot-{uuid.uuid4().hex}.db')
+    start = time.perf_counter()
+    db_manager.snapshot(snapshot_path)
+    logger('DB snapshot %s (%s bytes) made in %.2f seconds', LOG_LEVEL_DEBUG, 'ps', snapshot_path,
+           os.path.getsize(snapshot_path), time.perf_counter() - start)
+    return FileResponse(path=snapshot_path, filename="dans_packaging.db", media_type='application/octet-stream',
+                        background=BackgroundTask(os.remove, snapshot_path))
 
 
 @router.delete("/db-delete-all", include_in_schema=False)
@@ -4,7 +4,9 @@ from fastapi import APIRouter
 from starlette.responses import Response
 
 # from src import db
-from src.commons import logger, data, db_manager, LOG_LEVEL_DEBUG, LOG_NAME_PS, settings
+from src.commons import logger, db_manager, LOG_LEVEL_DEBUG, LOG_NAME_PS, settings
+from src.metrics import generate_metrics
+from src.bridge_registry import bridge_registry
 
 # import logging
 
@@ -13,7 +15,7 @@ router = APIRouter()
 
 @router.get("/available-modules")
 async def get_modules_list():
-    return sorted(list(data.keys()))
+    return bridge_registry.names()
 
 
 @router.get("/progress-state/{owner_id}")
@@ -53,4 +55,10 @@ async def find_dataset(datasetId: str):
 async def get_languages():
     with open(settings.LANGUAGES_PATH, "r") as f:
         j = json.load(f)
-    return j
\ No newline at end of file
+    return j
+
+
+@router.get("/metrics", include_in_schema=False)
+def get_metrics():
+    content, content_type = generate_metrics(db_manager)
+    return Response(content=content, media_type=content_type)
@@ -0,0 +1,79 @@
+"""
+Typed, immutable snapshot of the settings read on hot paths.
+
+Dynaconf lookups (``settings.get``, attribute access, ``settings.exists``) resolve the key, the environment and the
+lazy values on every call. The settings that are read for every request, file or chunk are validated once into a
+frozen ``SettingsSnapshot``, read as plain attributes of ``settings_snapshot.current``:
+
+    from src import settings_snapshot
+    timeout = settings_snapshot.current.DATAVERSE_RESPONSE_TIMEOUT
+
+The snapshot is built when ``commons`` is imported, so a wrong value stops the service at boot, and rebuilt by
+``/settings-reload``. ``rebuild`` replaces it in one assignment: a reader sees the old or the new snapshot, never a
+mix of both.
+"""
+from typing import Literal, Optional
+
+from pydantic import BaseModel, ConfigDict, Field
+
+
+class LoggerSettings(BaseModel):
+    model_config = ConfigDict(frozen=True)
+
+    name: str
+    log_file: str
+    log_level: int | str
+    log_format: str
+
+
+class SettingsSnapshot(BaseModel):
+    model_config = ConfigDict(frozen=True, extra='ignore')
+
+    DATA_TMP_BASE_DIR: str
+    DATA_TMP_BASE_TUS_FILES_DIR: str
+
+    LOGGERS: tuple[LoggerSettings, ...] = Field(min_length=1)
+    LOG_JSON: bool = False
+    LOG_PROGRESS_INTERVAL: float = Field(0, ge=0)
+
+    DATAVERSE_RESPONSE_TIMEOUT: float = Field(360000, gt=0)
+    MAX_INGEST_SIZE_USING_PYTHON: int = Field(100000000, ge=0)
+    DMZ_X_AUTHORIZATION_VALUE: Optional[str] = None
+
+    ZIP_COMPRESSION_LEVEL: int = Field(6, ge=0, le=9)
+    ZIP_COMPRESSION_WORKERS: int = Field(0, ge=0)
+    BAGIT_CHECKSUM_ALGORITHMS: tuple[Literal['md5', 'sha1', 'sha256', 'sha512'], ...] = ('md5', 'sha256')
+    BAGIT_HASH_WORKERS: int = Field(0, ge=0)
+
+    DISK_HIGH_WATERMARK: float = Field(0.9, gt=0, le=1)
+    DISK_RESERVATION_TTL: int = Field(86400, gt=0)
+
+    KEYCLOAK_JWKS_TTL: float = Field(3600, ge=0)
+    KEYCLOAK_JWKS_MIN_REFRESH: float = Field(60, ge=0)
+    KEYCLOAK_TOKEN_CACHE_TTL: float = Field(60, ge=0)
+    KEYCLOAK_LEEWAY: int = Field(30, ge=0)
+    KEYCLOAK_TIMEOUT: float = Field(10, gt=0)
+    KEYCLOAK_REMOTE_FALLBACK: bool = True
+
+
+current: SettingsSnapshot = None
+
+
+def build(settings) -> SettingsSnapshot:
+    """
+    Validates the snapshot fields of the (Dynaconf) settings.
+
+    Raises:
+        pydantic.ValidationError: When a setting is missing or has a wrong value.
+    """
+    # as_dict resolves the lazy (@format) values nested in lists as well, e.g. the log_file of LOGGERS.
+    values = settings.as_dict()
+    return SettingsSnapshot.model_validate({key: values[key] for key in SettingsSnapshot.model_fields
+                                            if values.get(key) is not None})
+
+
+def rebuild(settings) -> SettingsSnapshot:
+    """Builds the snapshot and makes it the current one, the current one is kept when validation fails."""
+    global current
+    current = build(settings)
+    return current
@@ -0,0 +1,143 @@
+"""
+Validation of Keycloak bearer tokens for ``main.auth_header``.
+
+JWT access tokens are verified locally: the signature against the JSON Web Key Set of the realm of the
+``keycloak_<env>`` setting (cached for ``KEYCLOAK_JWKS_TTL`` seconds, fetched again for an unknown key id), the
+issuer and the expiry. A valid token is remembered by its hash for ``KEYCLOAK_TOKEN_CACHE_TTL`` seconds (never past
+its expiry), so the chunks of an upload do not verify the same token over and over.
+
+Tokens that cannot be verified locally (not a JWT, or the keys cannot be fetched) are checked with Keycloak itself
+when ``KEYCLOAK_REMOTE_FALLBACK`` is on: token introspection when the env has a ``client_secret``, else userinfo.
+"""
+import hashlib
+import json
+import threading
+import time
+
+import requests
+from jwcrypto.common import JWException
+
+from src import settings_snapshot
+from src.commons import logger, LOG_LEVEL_DEBUG, LOG_NAME_PS
+
+MAX_CACHED_TOKENS = 10000
+
+
+class InvalidTokenError(Exception):
+    """Raised when a token is invalid (bad signature, expired, wrong issuer) or rejected by Keycloak."""
+
+
+class _Unverifiable(Exception):
+    # The token cannot be verified locally, e.g. an opaque token or the keys are not available.
+    pass
+
+
+class KeycloakTokenValidator:
+    def __init__(self):
+        self._jwks = {}
+        self._valid_tokens = {}
+        self._lock = threading.Lock()
+        self.stats = {"cached": 0, "verified": 0, "remote": 0, "rejected": 0}
+
+    def validate_token(self, env_name: str, keycloak_env, token: str) -> type(None):
+        """
+        Raises:
+            InvalidTokenError: When the token is not valid for the Keycloak realm of the env.
+        """
+        token_hash = hashlib.sha256(f'{env_name}\0{token}'.encode()).hexdigest()
+        valid_until = self._valid_tokens.get(token_hash)
+        if valid_until and valid_until > time.time():
+            self.stats["cached"] += 1
+            return
+
+        try:
+            try:
+                expiry = self._verify_locally(env_name, keycloak_env, token)
+                self.stats["verified"] += 1
+            except _Unverifiable as e:
+                if not settings_snapshot.current.KEYCLOAK_REMOTE_FALLBACK:
+                    raise InvalidTokenError(str(e))
+                logger(f'Token not verifiable locally ({e}), asking Keycloak {env_name}', LOG_LEVEL_DEBUG, LOG_NAME_PS)
+                expiry = self._verify_remotely(keycloak_env, token)
+                self.stats["remote"] += 1
+        except InvalidTokenError:
+            self.stats["rejected"] += 1
+            raise
+        self._remember(token_hash, expiry)
+
+    def _realm_url(self, keycloak_env) -> str:
+        return f'{keycloak_env.URL.rstrip("/")}/realms/{keycloak_env.REALMS}'
+
+    def _keys(self, env_name: str, keycloak_env, kid: str, refresh: bool = False):
+        from jwcrypto import jwk
+        cached = self._jwks.get(env_name)
+        if cached and not refresh and time.monotonic() - cached[1] < settings_snapshot.current.KEYCLOAK_JWKS_TTL:
+            return cached[0]
+        # An unknown key id must not make every request fetch the keys again.
+        if cached and refresh and time.monotonic() - cached[1] < settings_snapshot.current.KEYCLOAK_JWKS_MIN_REFRESH:
+            return cached[0]
+        try:
+            rsp = requests.get(f'{self._realm_url(keycloak_env)}/protocol/openid-connect/certs',
+                               timeout=settings_snapshot.current.KEYCLOAK_TIMEOUT)
+            rsp.raise_for_status()
+            keys = jwk.JWKSet.from_json(rsp.text)
+        except (requests.RequestException, JWException, ValueError) as e:
+            if cached:
+                return cached[0]
+            raise _Unverifiable(f'keys of {env_name} not available: {e}')
+        logger(f'Fetched the keys of Keycloak {env_name}, key id {kid} needed', LOG_LEVEL_DEBUG, LOG_NAME_PS)
+        self._jwks[env_name] = (keys, time.monotonic())
+        return keys
+
+    def _verify_locally(self, env_name: str, keycloak_env, token: str) -> float:
+        # jwcrypto (through cryptography) and keycloak are imported when a Keycloak token is seen, not at startup.
+        from jwcrypto import jws, jwt
+        try:
+            header = jws.JWS()
+            header.deserialize(token)
+            kid = header.jose_header.get('kid')
+        except (JWException, ValueError) as e:
+            raise _Unverifiable(f'not a JWT: {e}')
+
+        keys = self._keys(env_name, keycloak_env, kid)
+        if kid and not keys.get_key(kid):
+            keys = self._keys(env_name, keycloak_env, kid, refresh=True)
+            if not keys.get_key(kid):
+                raise _Unverifiable(f'unknown key id {kid}')
+        try:
+            verified = jwt.JWT(expected_type='JWS',
+                               check_claims={"exp": None,
+                                             "iss": keycloak_env.get('ISSUER', self._realm_url(keycloak_env))})
+            verified.leeway = settings_snapshot.current.KEYCLOAK_LEEWAY
+            verified.deserialize(token, keys)
+        except (JWException, ValueError) as e:
+            raise InvalidTokenError(f'{type(e).__name__}: {e}')
+        return json.loads(verified.claims)["exp"]
+
+    def _verify_remotely(self, keycloak_env, token: str) -> float:
+        from keycloak import KeycloakOpenID, KeycloakError
+        keycloak_openid = KeycloakOpenID(server_url=keycloak_env.URL, client_id=keycloak_env.CLIENT_ID,
+                                         realm_name=keycloak_env.REALMS,
+                                         client_secret_key=keycloak_env.get('CLIENT_SECRET'))
+        try:
+            if keycloak_env.get('CLIENT_SECRET'):
+                introspection = keycloak_openid.introspect(token)
+                if not introspection.get('active'):
+                    raise InvalidTokenError('token not active')
+                return introspection.get('exp', time.time())
+            keycloak_openid.userinfo(token)
+        except KeycloakError as e:
+            raise InvalidTokenError(f'{type(e).__name__}: {e}')
+        # Userinfo does not tell the expiry, the token is remembered for the cache TTL.
+        return float('inf')
+
+    def _remember(self, token_hash: str, expiry: float) -> type(None):
+        with self._lock:
+            if len(self._valid_tokens) >= MAX_CACHED_TOKENS:
+                now = time.time()
+                self._valid_tokens = {h: t for h, t in self._valid_tokens.items() if t > now}
+            if len(self._valid_tokens) < MAX_CACHED_TOKENS:
+                self._valid_tokens[token_hash] = min(expiry, time.time() + settings_snapshot.current.KEYCLOAK_TOKEN_CACHE_TTL)
+
+
+token_validator = KeycloakTokenValidator()
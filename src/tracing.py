@@ -0,0 +1,103 @@
+"""
+OpenTelemetry tracing of the deposit pipeline.
+
+With ``MELT_ENABLE`` the FastAPI requests are traced (see ``main.enable_otel``) and the spans are exported with the
+``MELT_EXPORTER``: ``jaeger`` (thrift over UDP to ``MELT_AGENT_HOST_NAME``, deprecated), ``otlp`` (OTLP over HTTP to
+``MELT_OTLP_ENDPOINT``) or ``console`` (stdout, for local use).
+
+The bridges run on their own threads, ``in_current_context`` hands the trace context of the triggering request to
+them so their spans (transform calls, file uploads, poll iterations, database statements, zip stages) are part of
+the same trace. Without ``MELT_ENABLE`` no tracer provider is set and all spans are no-ops.
+"""
+import contextvars
+import functools
+import time
+from contextlib import contextmanager
+
+from opentelemetry import trace
+from opentelemetry.trace import Status, StatusCode
+from sqlalchemy import event
+
+tracer = trace.get_tracer("packaging-service")
+
+
+def _create_exporter(exporter: str, agent_host_name: str, otlp_endpoint: str):
+    if exporter == 'otlp':
+        from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+        return OTLPSpanExporter(endpoint=otlp_endpoint)
+    if exporter == 'console':
+        from opentelemetry.sdk.trace.export import ConsoleSpanExporter
+        return ConsoleSpanExporter()
+    from opentelemetry.exporter.jaeger.thrift import JaegerExporter
+    return JaegerExporter(agent_host_name=agent_host_name, agent_port=6831, udp_split_oversized_batches=True)
+
+
+def configure_tracing(exporter: str = 'jaeger', agent_host_name: str = 'localhost',
+                      otlp_endpoint: str = 'http://localhost:4318/v1/traces') -> type(None):
+    """
+    Sets the global tracer provider, exporting the spans in batches with the given exporter.
+
+    Without the package of the exporter a warning is logged and the spans stay no-ops, tracing is not a reason to
+    refuse to start.
+    """
+    from opentelemetry.sdk.resources import SERVICE_NAME, Resource
+    from opentelemetry.sdk.trace import TracerProvider
+    from opentelemetry.sdk.trace.export import BatchSpanProcessor
+
+    try:
+        span_exporter = _create_exporter(exporter, agent_host_name, otlp_endpoint)
+    except ImportError as e:
+        # Imported here, commons imports this module.
+        from src.commons import logger, LOG_NAME_PS
+        logger(f'Tracing disabled, the {exporter} exporter is not installed: {e}', 'warning', LOG_NAME_PS)
+        return
+    tracer_provider = TracerProvider(resource=Resource.create({SERVICE_NAME: "Packaging Service"}))
+    tracer_provider.add_span_processor(BatchSpanProcessor(span_exporter))
+    trace.set_tracer_provider(tracer_provider)
+
+
+def in_current_context(fn):
+    """Returns fn bound to a copy of the current context (including the active span), to run on another thread."""
+    return functools.partial(contextvars.copy_context().run, fn)
+
+
+def trace_engine(engine) -> type(None):
+    """Adds a span for every statement executed through the SQLAlchemy engine within a trace."""
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        # Statements outside a trace (metrics scrapes, the orphan collector) would only be noise as root spans.
+        span = None
+        if trace.get_current_span().is_recording():
+            span = tracer.start_span(f'db {statement.split(None, 1)[0].upper()}',
+                                     attributes={"db.system": engine.dialect.name, "db.statement": statement})
+        conn.info.setdefault('ps_query_span', []).append(span)
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        span = conn.info['ps_query_span'].pop()
+        if span:
+            span.end()
+
+    @event.listens_for(engine, 'handle_error')
+    def handle_error(exception_context):
+        spans = exception_context.connection.info.get('ps_query_span') if exception_context.connection else None
+        span = spans.pop() if spans else None
+        if span:
+            span.record_exception(exception_context.original_exception)
+            span.set_status(Status(StatusCode.ERROR))
+            span.end()
+
+
+@contextmanager
+def file_upload_span(target: str, file_name: str, size: int):
+    """Span of a single file upload, with its size and rate."""
+    with tracer.start_as_current_span('file upload', attributes={"ps.target": target, "ps.file.name": file_name,
+                                                                 "ps.file.bytes": size or 0}) as span:
+        start = time.perf_counter()
+        try:
+            yield span
+        finally:
+            duration = time.perf_counter() - start
+            if size and duration > 0:
+                span.set_attribute("ps.file.bytes_per_second", round(size / duration))
@@ -1,11 +1,16 @@
 import os
 import shutil
+import uuid
 
-from fastapi import APIRouter
-from fastapi.responses import HTMLResponse
+from fastapi import APIRouter, Request
+from fastapi.responses import HTMLResponse, JSONResponse
 from fastapi_tusd import TusRouter
+from starlette import status
+from starlette.concurrency import run_in_threadpool
 
 from src.commons import settings
+from src.dbz import DiskReservationKind
+from src.disk_space import disk_space, InsufficientStorageError
 
 if not os.path.exists(settings.DATA_TMP_BASE_TUS_FILES_DIR):
     os.makedirs(settings.DATA_TMP_BASE_TUS_FILES_DIR)
@@ -15,6 +20,38 @@ router = APIRouter()
 router.include_router(upload_files, prefix="/files")
 
 
+async def reserve_tus_upload_space(request: Request, call_next):
+    """
+    HTTP middleware that reserves the announced ``Upload-Length`` of a new tus upload before it is created.
+
+    The upload is rejected with 507 when the reservation would pass the disk high watermark. The reservation is
+    released when the upload is deleted (see also ``update_file_metadata``), or when it expires. The reservations
+    are database writes under a file lock, they run on the thread pool to keep the event loop free.
+    """
+    path = request.url.path.rstrip('/')
+    upload_length = request.headers.get('Upload-Length', '')
+    if request.method == 'POST' and path == '/files' and upload_length.isdigit():
+        try:
+            reservation = await run_in_threadpool(disk_space.reserve, owner=f'pending-{uuid.uuid4().hex}',
+                                                  kind=DiskReservationKind.TUS_UPLOAD, size=int(upload_length))
+        except InsufficientStorageError as e:
+            return JSONResponse(status_code=status.HTTP_507_INSUFFICIENT_STORAGE, content={"detail": str(e)})
+        response = await call_next(request)
+        location = response.headers.get('Location')
+        if response.status_code in (status.HTTP_201_CREATED, status.HTTP_204_NO_CONTENT) and location:
+            file_uuid = location.rstrip('/').split('/')[-1]
+            await run_in_threadpool(disk_space.assign, reservation, file_uuid,
+                                    os.path.join(settings.DATA_TMP_BASE_TUS_FILES_DIR, file_uuid))
+        else:
+            await run_in_threadpool(disk_space.cancel, reservation)
+        return response
+
+    response = await call_next(request)
+    if request.method == 'DELETE' and path.startswith('/files/') and response.status_code == status.HTTP_204_NO_CONTENT:
+        await run_in_threadpool(disk_space.release, path.split('/')[-1], DiskReservationKind.TUS_UPLOAD)
+    return response
+
+
 @router.get("/upload.html", tags=["Files-Utils"])
 async def read_uppy():
     return HTMLResponse(html_content)
@@ -69,10 +106,12 @@ def delete_files():
 
 @router.get('/disk', tags=["Files-Utils"])
 def get_disk_files():
-    total, used, free = shutil.disk_usage("/")
+    usage = disk_space.usage()
 
-    t = ("Total: %d GiB" % (total // (2 ** 30)))
-    u = ("Used: %d GiB" % (used // (2 ** 30)))
-    f = ("Free: %d GiB" % (free // (2 ** 30)))
+    t = ("Total: %d GiB" % (usage["total"] // (2 ** 30)))
+    u = ("Used: %d GiB" % (usage["used"] // (2 ** 30)))
+    f = ("Free: %d GiB" % (usage["free"] // (2 ** 30)))
+    r = ("Reserved: %d GiB" % (usage["reserved"] // (2 ** 30)))
+    l = ("Limit: %d GiB" % (usage["limit"] // (2 ** 30)))
 
-    return {"Total:": t, "Used": u, "Free": f}
+    return {"Total:": t, "Used": u, "Free": f, "Reserved": r, "Limit": l}
@@ -0,0 +1,113 @@
+"""
+Coordination of the uvicorn workers of one deployment (``MULTIPLE_WORKERS_ENABLE``).
+
+The workers share the database and ``DATA_TMP_BASE_DIR``. Work that must happen once per deployment is serialized with
+``flock`` locks on files in ``WORKER_LOCK_DIR``:
+
+- ``file_lock`` is a blocking lock, e.g. around the creation and migration of the database tables;
+- ``leader`` is a lease: one worker holds the lock of ``leader.lock`` and runs the background jobs registered with
+  ``leader.add_job`` (e.g. the orphan collector). The other workers try to take over every
+  ``LEADER_RETRY_INTERVAL`` seconds, the kernel releases the lock when the leader's process ends.
+"""
+import fcntl
+import os
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+
+from src.commons import settings, logger, LOG_LEVEL_DEBUG, LOG_NAME_PS
+
+LOCK_DIR = settings.get("WORKER_LOCK_DIR", os.path.join(settings.DATA_TMP_BASE_DIR, 'locks'))
+
+
+@contextmanager
+def file_lock(name: str):
+    """Holds the exclusive lock of ``WORKER_LOCK_DIR/<name>.lock``, across threads and processes."""
+    os.makedirs(LOCK_DIR, exist_ok=True)
+    with open(os.path.join(LOCK_DIR, f'{name}.lock'), 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class LeaderLease:
+    """The lease of the worker that runs the once-per-deployment background jobs."""
+
+    def __init__(self, lock_path: str):
+        self.lock_path = lock_path
+        self._file = None
+        self._jobs = []
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def is_leader(self) -> bool:
+        return self._file is not None
+
+    def add_job(self, name: str, start, stop) -> type(None):
+        """Registers a background job, started when this worker becomes the leader and stopped when it resigns."""
+        self._jobs.append((name, start, stop))
+
+    def try_acquire(self) -> bool:
+        with self._lock:
+            if self._file:
+                return True
+            os.makedirs(os.path.dirname(self.lock_path), exist_ok=True)
+            f = open(self.lock_path, 'a+')
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                f.close()
+                return False
+            # Informative only, the lock is what counts.
+            f.truncate(0)
+            f.write(f'{os.getpid()} {datetime.utcnow().isoformat()}\n')
+            f.flush()
+            self._file = f
+        logger(f'Worker {os.getpid()} is the leader, starting {[name for name, _, _ in self._jobs]}',
+               LOG_LEVEL_DEBUG, LOG_NAME_PS)
+        for name, start, _ in self._jobs:
+            try:
+                start()
+            except Exception as e:
+                logger(f'Unable to start the leader job {name}: {e}', 'error', LOG_NAME_PS)
+        return True
+
+    def leader(self) -> str:
+        """Returns the pid and start time of the current leader, as written in the lock file."""
+        try:
+            with open(self.lock_path) as f:
+                return f.read().strip()
+        except OSError:
+            return ''
+
+    def _run(self, interval: float) -> type(None):
+        while not self.try_acquire() and not self._stop.wait(interval):
+            pass
+
+    def start(self) -> type(None):
+        """Runs the jobs now when the lease is free, otherwise keeps trying in the background."""
+        if self.try_acquire() or (self._thread and self._thread.is_alive()):
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, args=(settings.get("LEADER_RETRY_INTERVAL", 10),),
+                                        name='leader-election', daemon=True)
+        self._thread.start()
+
+    def resign(self) -> type(None):
+        self._stop.set()
+        with self._lock:
+            if not self._file:
+                return
+            for name, _, stop in self._jobs:
+                stop()
+            fcntl.flock(self._file, fcntl.LOCK_UN)
+            self._file.close()
+            self._file = None
+        logger(f'Worker {os.getpid()} resigned as leader', LOG_LEVEL_DEBUG, LOG_NAME_PS)
+
+
+leader = LeaderLease(os.path.join(LOCK_DIR, 'leader.lock'))
@@ -0,0 +1,273 @@
+"""
+Sequential (streaming) ZIP encoding.
+
+The archive is produced front to back without seeking: every entry is a local header flagged with a data
+descriptor, the entry data, and a ZIP64 data descriptor carrying the CRC and sizes. The archive ends with a ZIP64
+central directory. Because the layout is fixed, the exact size of an archive of stored entries is known before
+a single byte is read, so it can be used as an HTTP upload body with a Content-Length.
+
+ParallelZipCompressor writes such an archive with deflated entries, compressing blocks of each entry on a pool of
+processes.
+"""
+import contextlib
+import io
+import math
+import os
+import struct
+import time
+import zlib
+from collections import Counter, deque
+
+from src.process_pool import process_pool
+
+ZIP64_VERSION = 45
+FLAG_DATA_DESCRIPTOR = 0x08
+FLAG_UTF8 = 0x800
+MAX_32 = 0xFFFFFFFF
+MAX_16 = 0xFFFF
+
+LOCAL_HEADER = struct.Struct('<IHHHHHIIIHH')
+ZIP64_LOCAL_EXTRA = struct.Struct('<HHQQ')
+DATA_DESCRIPTOR = struct.Struct('<IIQQ')
+CENTRAL_HEADER = struct.Struct('<IHHHHHHIIIHHHHHII')
+ZIP64_CENTRAL_EXTRA = struct.Struct('<HHQQQ')
+ZIP64_END_RECORD = struct.Struct('<IQHHIIQQQQ')
+ZIP64_END_LOCATOR = struct.Struct('<IIQI')
+END_RECORD = struct.Struct('<IHHHHIIH')
+
+STORED = 0
+DEFLATED = 8
+
+
+def _dos_datetime(mtime: float) -> (int, int):
+    t = time.localtime(mtime)
+    year = max(t.tm_year, 1980)
+    return (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2), ((year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday
+
+
+def _strip_zip64_extra(extra: bytes) -> bytes:
+    """Removes the ZIP64 fields from an extra field of another archive, the encoder writes its own."""
+    fields = []
+    while len(extra) >= 4:
+        header_id, size = struct.unpack('<HH', extra[:4])
+        if header_id != 0x0001:
+            fields.append(extra[:4 + size])
+        extra = extra[4 + size:]
+    return b''.join(fields)
+
+
+class ZipStreamEncoder:
+    """
+    Builds the records of a sequentially written ZIP64 archive.
+
+    For every entry call ``start_entry`` (returns the local header), write the entry data yourself, then call
+    ``end_entry`` with the CRC and sizes (returns the data descriptor). ``finish`` returns the central directory.
+    The attributes, comment and extra field of a copied entry can be passed to ``start_entry`` to keep them.
+    The encoder only keeps the per-entry bookkeeping in memory, never the data.
+    """
+
+    def __init__(self):
+        self.offset = 0
+        self._entries = []
+        self._current = None
+
+    def start_entry(self, name: str, method: int = STORED, mtime: float = None, mode: int = 0o644,
+                    external_attr: int = None, create_system: int = 3, comment: bytes = b'',
+                    extra: bytes = b'') -> bytes:
+        encoded_name = name.encode('utf-8')
+        extra = _strip_zip64_extra(extra)
+        dos_time, dos_date = _dos_datetime(mtime if mtime is not None else time.time())
+        self._current = {"name": encoded_name, "method": method, "time": dos_time, "date": dos_date,
+                         "external_attr": external_attr if external_attr is not None else (0o100000 | mode) << 16,
+                         "create_system": create_system, "comment": comment, "extra": extra, "offset": self.offset}
+        header = LOCAL_HEADER.pack(0x04034b50, ZIP64_VERSION, FLAG_DATA_DESCRIPTOR | FLAG_UTF8, method, dos_time,
+                                   dos_date, 0, MAX_32, MAX_32, len(encoded_name), ZIP64_LOCAL_EXTRA.size + len(extra))
+        record = header + encoded_name + ZIP64_LOCAL_EXTRA.pack(0x0001, 16, 0, 0) + extra
+        self.offset += len(record)
+        return record
+
+    def end_entry(self, crc: int, compress_size: int, file_size: int) -> bytes:
+        self._current.update(crc=crc, compress_size=compress_size, file_size=file_size)
+        self._entries.append(self._current)
+        self._current = None
+        self.offset += compress_size
+        record = DATA_DESCRIPTOR.pack(0x08074b50, crc, compress_size, file_size)
+        self.offset += len(record)
+        return record
+
+    def finish(self, comment: bytes = b'') -> bytes:
+        records = []
+        for e in self._entries:
+            records.append(CENTRAL_HEADER.pack(
+                0x02014b50, (e["create_system"] << 8) | ZIP64_VERSION, ZIP64_VERSION, FLAG_DATA_DESCRIPTOR | FLAG_UTF8,
+                e["method"], e["time"], e["date"], e["crc"], MAX_32, MAX_32, len(e["name"]),
+                ZIP64_CENTRAL_EXTRA.size + len(e["extra"]), len(e["comment"]), 0, 0, e["external_attr"], MAX_32))
+            records.append(e["name"])
+            records.append(ZIP64_CENTRAL_EXTRA.pack(0x0001, 24, e["file_size"], e["compress_size"], e["offset"]))
+            records.append(e["extra"])
+            records.append(e["comment"])
+        central_directory = b''.join(records)
+        cd_offset = self.offset
+        zip64_end_offset = cd_offset + len(central_directory)
+        count = len(self._entries)
+        trailer = (ZIP64_END_RECORD.pack(0x06064b50, ZIP64_END_RECORD.size - 12, (3 << 8) | ZIP64_VERSION,
+                                         ZIP64_VERSION, 0, 0, count, count, len(central_directory), cd_offset)
+                   + ZIP64_END_LOCATOR.pack(0x07064b50, 0, zip64_end_offset, 1)
+                   + END_RECORD.pack(0x06054b50, 0, 0, min(count, MAX_16), min(count, MAX_16), MAX_32, MAX_32,
+                                     len(comment))
+                   + comment)
+        self.offset += len(central_directory) + len(trailer)
+        return central_directory + trailer
+
+    @staticmethod
+    def archive_size(entries: [(str, int)]) -> int:
+        """Returns the exact size of an archive of the given (name, compressed size) entries."""
+        fixed = (LOCAL_HEADER.size + ZIP64_LOCAL_EXTRA.size + DATA_DESCRIPTOR.size + CENTRAL_HEADER.size
+                 + ZIP64_CENTRAL_EXTRA.size)
+        return (sum(fixed + 2 * len(name.encode('utf-8')) + size for name, size in entries)
+                + ZIP64_END_RECORD.size + ZIP64_END_LOCATOR.size + END_RECORD.size)
+
+
+class StoredZipStream(io.RawIOBase):
+    """
+    A read-only file object producing a ZIP archive with ``file_path`` as its only, stored, entry.
+
+    The source file is read exactly once, while the archive is being read, so wrapping a file needs no extra
+    disk space and the consumer (e.g. an upload) can start immediately. ``len()`` returns the exact archive size.
+    """
+
+    def __init__(self, file_path: str, arcname: str = None, chunk_size: int = 8 * 1024 * 1024):
+        super().__init__()
+        self.file_path = file_path
+        self.arcname = arcname if arcname else os.path.basename(file_path)
+        self.chunk_size = chunk_size
+        self.size = ZipStreamEncoder.archive_size([(self.arcname, os.path.getsize(file_path))])
+        self._chunks = self._generate()
+        self._buffer = bytearray()
+        self._position = 0
+
+    def _generate(self):
+        encoder = ZipStreamEncoder()
+        stat = os.stat(self.file_path)
+        yield encoder.start_entry(self.arcname, STORED, stat.st_mtime, stat.st_mode & 0o777)
+        crc, size = 0, 0
+        with open(self.file_path, 'rb') as f:
+            while chunk := f.read(self.chunk_size):
+                crc = zlib.crc32(chunk, crc)
+                size += len(chunk)
+                yield chunk
+        yield encoder.end_entry(crc, size, size)
+        yield encoder.finish()
+
+    def __len__(self) -> int:
+        return self.size
+
+    def readable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._position
+
+    def read(self, size: int = -1) -> bytes:
+        while size < 0 or len(self._buffer) < size:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                break
+            self._buffer += chunk
+        if size < 0:
+            size = len(self._buffer)
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        self._position += len(data)
+        return data
+
+    def readinto(self, b) -> int:
+        data = self.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+
+def deflate_block(data: bytes, level: int, zdict: bytes, last: bool) -> bytes:
+    """
+    Raw-deflates one block of an entry. Blocks are primed with the last 32 KiB of the previous block and end with
+    a sync flush (the last one with a final block), so their concatenation is one valid deflate stream.
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15, zdict=zdict) if zdict else \
+        zlib.compressobj(level, zlib.DEFLATED, -15)
+    return compressor.compress(data) + compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+
+def entropy(sample: bytes) -> float:
+    """Shannon entropy of the sample in bits per byte, 8.0 means random (incompressible) data."""
+    if not sample:
+        return 0.0
+    length = len(sample)
+    return -sum(count / length * math.log2(count / length) for count in Counter(sample).values())
+
+
+class ParallelZipCompressor:
+    """
+    Writes a ZIP archive of deflated entries, compressing the blocks of every entry on the shared ``zip`` process
+    pool (see ``process_pool``), of ``workers`` processes.
+
+    Memory use is bounded by ``max_pending`` blocks in flight, independent of the size of the entries. The first
+    block of every entry is sampled: entries with an entropy of at least ``entropy_threshold`` bits per byte are
+    stored without compressing them.
+    """
+
+    def __init__(self, level: int = 6, workers: int = None, block_size: int = 1024 * 1024,
+                 entropy_threshold: float = 7.5, max_pending: int = None):
+        self.level = level
+        self.workers = workers if workers else os.cpu_count()
+        self.block_size = block_size
+        self.entropy_threshold = entropy_threshold
+        self.max_pending = max_pending if max_pending else self.workers * 2
+
+    def write(self, out, members, progress=None, comment: bytes = b'') -> type(None):
+        """
+        Writes the archive to the (sequentially written) file object out.
+
+        Args:
+            out: The writable file object.
+            members: Iterable of (arcname, readable file object, mtime, attributes) tuples. The file object is None
+                for a directory entry, the file objects are closed. The optional attributes are a dict of the
+                keyword arguments of ``ZipStreamEncoder.start_entry`` (e.g. external_attr, comment, extra).
+            progress: Optional callable, called with (arcname, bytes read so far) after every block.
+            comment: The archive comment.
+        """
+        encoder = ZipStreamEncoder()
+        pool = process_pool('zip', self.workers)
+        for arcname, fileobj, mtime, *attributes in members:
+            with fileobj if fileobj else contextlib.nullcontext():
+                self._write_member(pool, encoder, out, arcname, fileobj, mtime, attributes[0] if attributes else {},
+                                   progress)
+        out.write(encoder.finish(comment))
+
+    def _write_member(self, pool, encoder, out, arcname, fileobj, mtime, attributes, progress) -> type(None):
+        block = fileobj.read(self.block_size) if fileobj else b''
+        method = STORED if not block or entropy(block[:64 * 1024]) >= self.entropy_threshold else DEFLATED
+        out.write(encoder.start_entry(arcname, method, mtime, **attributes))
+        crc, file_size, compress_size = 0, 0, 0
+        pending = deque()
+        previous = b''
+        while True:
+            next_block = fileobj.read(self.block_size) if block else b''
+            last = not next_block
+            crc = zlib.crc32(block, crc)
+            file_size += len(block)
+            if method == STORED:
+                out.write(block)
+                compress_size += len(block)
+            else:
+                pending.append(pool.submit(deflate_block, block, self.level, previous[-32 * 1024:], last))
+                previous = block
+                while len(pending) >= self.max_pending or (last and pending):
+                    compressed = pending.popleft().result()
+                    out.write(compressed)
+                    compress_size += len(compressed)
+            if progress:
+                progress(arcname, file_size)
+            if last:
+                break
+            block = next_block
+        out.write(encoder.end_entry(crc, compress_size, file_size))